@@ -0,0 +1,126 @@
+"""
+Benchmark de la imagen adjunta al LLM en el modo "rich" (core/adk/adk_main.py).
+
+Compara tres formas de darle la imagen al LLM para verificar las detecciones:
+  * solo la URI `gs://` como texto (el LLM no puede abrirla),
+  * la imagen en línea reducida a BAYSAFE_LLM_IMAGE_MAX_SIDE (por defecto 384 px),
+  * la imagen en línea con la resolución que recibe Vertex AI (1280 px).
+
+Sin `--live` estima los tokens de imagen con la regla de Gemini: una imagen de
+384 px o menos por lado cuesta 258 tokens; una mayor se divide en bloques de
+768x768 de 258 tokens cada uno. Con `--live` llama de verdad al modelo
+(AGENT_MODEL, credenciales de GCP) y mide latencia y tokens reportados.
+
+Uso (desde la raíz del repositorio):
+    python benchmarks/bench_llm_image.py
+    AGENT_MODEL=gemini-2.5-flash python benchmarks/bench_llm_image.py --live --repeat 5
+"""
+
+import argparse
+import io
+import math
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("AGENT_MODEL", "gemini-2.5-flash")
+
+from PIL import Image  # noqa: E402
+from google.genai import types  # noqa: E402
+
+from core.adk import adk_main  # noqa: E402
+from core.adk.preprocessing import preprocess_image  # noqa: E402
+
+_DETECTIONS = ["bateria", "mesa_bordes", "silla"]
+
+
+def _synthetic_photo(width: int, height: int) -> bytes:
+    noise = Image.effect_noise((width, height), 40).convert("RGB")
+    gradient = Image.linear_gradient("L").resize((width, height)).convert("RGB")
+    buffer = io.BytesIO()
+    Image.blend(noise, gradient, 0.5).save(buffer, format="JPEG", quality=92)
+    return buffer.getvalue()
+
+
+def _estimated_image_tokens(width: int, height: int) -> int:
+    if width <= 384 and height <= 384:
+        return 258
+    return math.ceil(width / 768) * math.ceil(height / 768) * 258
+
+
+def _variants(photo: bytes):
+    query = adk_main.build_detections_query("gs://bucket/uploads/ejemplo.jpg", _DETECTIONS)
+    yield "solo URI", query, [], 0
+
+    start = time.perf_counter()
+    part = adk_main.build_image_part(photo)
+    build_ms = (time.perf_counter() - start) * 1000.0
+    with Image.open(io.BytesIO(part.inline_data.data)) as small:
+        size = small.size
+    yield f"en línea {max(size)} px", query, [part], build_ms
+
+    start = time.perf_counter()
+    prepared = preprocess_image(photo)
+    build_ms = (time.perf_counter() - start) * 1000.0
+    part = types.Part.from_bytes(data=prepared.data, mime_type=prepared.content_type)
+    yield f"en línea {max(prepared.width, prepared.height)} px", query, [part], build_ms
+
+
+def _offline(photo: bytes) -> None:
+    print(f"{'variante':<18} {'bytes imagen':>12} {'tokens imagen (est.)':>21} {'preparación':>12}")
+    for name, _, parts, build_ms in _variants(photo):
+        if not parts:
+            print(f"{name:<18} {0:>12,} {0:>21} {build_ms:>10.1f} ms")
+            continue
+        data = parts[0].inline_data.data
+        with Image.open(io.BytesIO(data)) as image:
+            tokens = _estimated_image_tokens(*image.size)
+        print(f"{name:<18} {len(data):>12,} {tokens:>21} {build_ms:>10.1f} ms")
+
+
+def _live(photo: bytes, repeat: int) -> None:
+    from google import genai
+
+    client = genai.Client(
+        vertexai=True,
+        project=os.environ.get("GOOGLE_CLOUD_PROJECT"),
+        location=os.environ.get("GOOGLE_CLOUD_LOCATION"),
+    )
+    config = types.GenerateContentConfig(system_instruction=adk_main.BAYSAFE_REPORT_INSTRUCTION)
+
+    print(f"{'variante':<18} {'latencia p50':>13} {'tokens entrada':>15} {'tokens salida':>14}")
+    for name, query, parts, _ in _variants(photo):
+        contents = [types.Content(role="user", parts=[types.Part(text=query)] + parts)]
+        latencies, prompt_tokens, output_tokens = [], [], []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            response = client.models.generate_content(model=os.environ["AGENT_MODEL"], contents=contents, config=config)
+            latencies.append(time.perf_counter() - start)
+            usage = response.usage_metadata
+            prompt_tokens.append(usage.prompt_token_count or 0)
+            output_tokens.append(usage.candidates_token_count or 0)
+        print(f"{name:<18} {statistics.median(latencies) * 1000:>10.0f} ms "
+              f"{statistics.fmean(prompt_tokens):>15.0f} {statistics.fmean(output_tokens):>14.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--width", type=int, default=4032)
+    parser.add_argument("--height", type=int, default=3024)
+    parser.add_argument("--live", action="store_true", help="Llamar al modelo real (requiere credenciales)")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    photo = _synthetic_photo(args.width, args.height)
+    print(f"Foto: {args.width}x{args.height}, {len(photo):,} bytes; omitida si todas las confianzas "
+          f">= {adk_main.LLM_IMAGE_SKIP_CONFIDENCE}")
+    if args.live:
+        _live(photo, args.repeat)
+    else:
+        _offline(photo)
+
+
+if __name__ == "__main__":
+    main()
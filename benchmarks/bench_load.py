@@ -0,0 +1,368 @@
+"""
+Benchmark de carga de extremo a extremo de `POST /api/chat/`.
+
+Lanza N peticiones con imagen a la aplicación de Django completa, con los
+backends simulados (BAYSAFE_BACKENDS=fake: almacenamiento en disco, detector
+determinista y LLM predefinido), así que mide nuestro propio código y no la red
+de GCP. Dos formas de servirla:
+
+  * `--server inproc` (por defecto): la app ASGI en este mismo proceso, vía
+    httpx.ASGITransport (cliente y servidor comparten el event loop),
+  * `--server gunicorn` o `--server uvicorn`: un servidor real con `--workers`
+    procesos en un puerto local.
+
+Reporta, por nivel de concurrencia: RPS, latencia p50/p95/p99, p50/p95/p99 de
+cada etapa (cabecera Server-Timing de la respuesta) y RSS pico por proceso. Con
+`--output` guarda el resultado en JSON (con el commit) y con `--compare` lo
+contrasta con uno anterior.
+
+Uso (desde la raíz del repositorio):
+    python benchmarks/bench_load.py --concurrency 1,8,32 --requests 200
+    python benchmarks/bench_load.py --server gunicorn --workers 4 --concurrency 64 --mode rich
+    python benchmarks/bench_load.py --labels silla,silla,silla,bateria --output nuevo.json --compare base.json
+"""
+
+import argparse
+import asyncio
+import contextlib
+import datetime
+import io
+import json
+import os
+import random
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import httpx  # noqa: E402
+from PIL import Image, ImageDraw  # noqa: E402
+
+
+def _backend_env(args, work_dir: str) -> Dict[str, str]:
+    """Variables de entorno de la app bajo prueba: backends simulados y cachés aisladas."""
+    env = {
+        "DJANGO_SETTINGS_MODULE": "benchmarks.load_settings",
+        "BAYSAFE_BACKENDS": "fake",
+        "BAYSAFE_FAKE_STORAGE_DIR": os.path.join(work_dir, "gcs"),
+        "BAYSAFE_FAKE_DETECTOR_LATENCY_MS": str(args.detector_ms),
+        "BAYSAFE_FAKE_DETECTOR_JITTER_MS": str(args.detector_jitter_ms),
+        "BAYSAFE_FAKE_DETECTOR_ERROR_RATE": str(args.error_rate),
+        "BAYSAFE_FAKE_LLM_LATENCY_MS": str(args.llm_ms),
+        "BAYSAFE_REPORT_MODE": args.mode,
+        "BAYSAFE_CACHE_DB": os.path.join(work_dir, "cache.sqlite3"),
+        "AGENT_MODEL": os.environ.get("AGENT_MODEL", "gemini-2.5-flash"),
+        "GOOGLE_CLOUD_PROJECT": os.environ.get("GOOGLE_CLOUD_PROJECT", "bench-project"),
+        "GOOGLE_CLOUD_LOCATION": os.environ.get("GOOGLE_CLOUD_LOCATION", "us-central1"),
+        "VERTEX_MODEL_ID": os.environ.get("VERTEX_MODEL_ID", "0"),
+        "BUCKET_NAME": os.environ.get("BUCKET_NAME", "bench-bucket"),
+    }
+    if not args.cache:
+        # TTL 0: las cachés se escriben (su coste se mide) pero nunca aciertan,
+        # así que cada petición recorre el pipeline completo en todos los niveles.
+        env.update(DETECTION_CACHE_TTL="0", REPORT_CACHE_TTL="0", NEAR_DUPLICATE_ENABLED="False")
+    if args.labels:
+        env["BAYSAFE_FAKE_DETECTOR_LABELS"] = args.labels
+    return env
+
+
+# --- IMÁGENES DE PRUEBA ---
+
+def _make_images(sizes: List[str], count: int, distinct: int, seed: int) -> List[bytes]:
+    """
+    Fotos sintéticas (ruido + degradado) repartidas entre los tamaños pedidos.
+
+    Cada una lleva un rectángulo aleatorio, así que son distintas byte a byte
+    (salvo con `--distinct` menor que N, para medir aciertos de caché con `--cache`).
+    """
+    rng = random.Random(seed)
+    bases = []
+    for size in sizes:
+        width, height = (int(value) for value in size.lower().split("x"))
+        noise = Image.effect_noise((width, height), 40).convert("RGB")
+        gradient = Image.linear_gradient("L").resize((width, height)).convert("RGB")
+        bases.append(Image.blend(noise, gradient, 0.5))
+
+    pool = []
+    for i in range(min(count, distinct) if distinct else count):
+        image = bases[i % len(bases)].copy()
+        x, y = rng.randrange(image.width // 2), rng.randrange(image.height // 2)
+        ImageDraw.Draw(image).rectangle(
+            (x, y, x + image.width // 4, y + image.height // 4),
+            fill=(rng.randrange(256), rng.randrange(256), rng.randrange(256)),
+        )
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=90)
+        pool.append(buffer.getvalue())
+    return [pool[i % len(pool)] for i in range(count)]
+
+
+# --- CARGA ---
+
+def _percentiles(samples: List[float]) -> Dict[str, float]:
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def rank(q: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 2)
+
+    return {"p50": rank(0.50), "p95": rank(0.95), "p99": rank(0.99), "max": round(ordered[-1], 2), "n": len(ordered)}
+
+
+def _parse_server_timing(header: Optional[str]) -> Dict[str, float]:
+    stages = {}
+    for item in (header or "").split(","):
+        name, _, params = item.strip().partition(";")
+        if params.startswith("dur="):
+            stages[name] = float(params[4:])
+    return stages
+
+
+async def _run_level(client: httpx.AsyncClient, images: List[bytes], concurrency: int, mode: str) -> Dict:
+    """Envía todas las imágenes con `concurrency` peticiones en vuelo como máximo."""
+    latencies: List[float] = []
+    stages: Dict[str, List[float]] = {}
+    errors: Dict[str, int] = {}
+    pending = iter(range(len(images)))
+
+    async def worker() -> None:
+        for index in pending:
+            start = time.perf_counter()
+            try:
+                response = await client.post(
+                    "/api/chat/",
+                    data={"tiene_imagen": "True", "modo": mode},
+                    files={"imagen": (f"foto-{index}.jpg", images[index], "image/jpeg")},
+                )
+                body = response.json()
+                if response.status_code != 200 or body.get("status") != "ok":
+                    kind = f"http_{response.status_code}"
+                elif str(body.get("respuesta", "")).startswith("Error"):
+                    kind = "analisis"
+                else:
+                    kind = None
+            except Exception as e:
+                kind, response = type(e).__name__, None
+            latencies.append((time.perf_counter() - start) * 1000.0)
+            if kind:
+                errors[kind] = errors.get(kind, 0) + 1
+            if response is not None:
+                for name, duration in _parse_server_timing(response.headers.get("server-timing")).items():
+                    stages.setdefault(name, []).append(duration)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    return {
+        "concurrency": concurrency,
+        "requests": len(images),
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "rps": round(len(images) / elapsed, 2),
+        "latency_ms": _percentiles(latencies),
+        "stages_ms": {name: _percentiles(samples) for name, samples in sorted(stages.items())},
+    }
+
+
+# --- SERVIDORES ---
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _child_pids(parent: int) -> List[int]:
+    pids = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as stat:
+                # El nombre del proceso va entre paréntesis y puede contener espacios.
+                if int(stat.read().rsplit(")", 1)[1].split()[1]) == parent:
+                    pids.append(int(entry))
+        except (OSError, IndexError, ValueError):
+            continue
+    return pids
+
+
+def _peak_rss_mb(pid: int) -> Optional[float]:
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        return None
+    return None
+
+
+def _start_server(args, env: Dict[str, str], log_path: str):
+    port = _free_port()
+    if args.server == "gunicorn":
+        command = [sys.executable, "-m", "gunicorn", "mi_proyecto.asgi:application",
+                   "-k", "uvicorn.workers.UvicornWorker", "-w", str(args.workers),
+                   "-b", f"127.0.0.1:{port}", "--timeout", "120"]
+    else:
+        command = [sys.executable, "-m", "uvicorn", "mi_proyecto.asgi:application",
+                   "--workers", str(args.workers), "--port", str(port),
+                   "--no-access-log", "--log-level", "warning"]
+    log = open(log_path, "wb")
+    process = subprocess.Popen(
+        command, cwd=REPO_ROOT, env={**os.environ, **env, "PYTHONPATH": REPO_ROOT},
+        stdout=log, stderr=subprocess.STDOUT,
+    )
+
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 90
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"El servidor terminó al arrancar; ver {log_path}")
+        try:
+            if httpx.get(base_url + "/", timeout=2).status_code < 500:
+                return process, base_url
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    process.terminate()
+    raise RuntimeError(f"El servidor no respondió en 90 s; ver {log_path}")
+
+
+# --- INFORME ---
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _print_level(result: Dict) -> None:
+    latency = result["latency_ms"]
+    errors = sum(result["errors"].values())
+    print(f"\nConcurrencia {result['concurrency']}: {result['rps']:.1f} RPS, {result['requests']} peticiones, "
+          f"{errors} errores | latencia p50 {latency['p50']:.0f} ms, p95 {latency['p95']:.0f} ms, "
+          f"p99 {latency['p99']:.0f} ms")
+    print(f"  {'etapa':<12} {'p50':>9} {'p95':>9} {'p99':>9} {'n':>6}")
+    for name, stats in result["stages_ms"].items():
+        print(f"  {name:<12} {stats['p50']:>9.1f} {stats['p95']:>9.1f} {stats['p99']:>9.1f} {stats['n']:>6}")
+    print("  RSS pico: " + ", ".join(f"{pid} {mb} MB" for pid, mb in result["peak_rss_mb"].items()))
+
+
+def _compare(previous_path: str, results: List[Dict]) -> None:
+    with open(previous_path, encoding="utf-8") as previous_file:
+        previous = json.load(previous_file)
+    by_level = {result["concurrency"]: result for result in previous["results"]}
+    print(f"\nComparación con {previous_path} (commit {previous.get('commit')}):")
+    for result in results:
+        old = by_level.get(result["concurrency"])
+        if old is None:
+            continue
+        rps_delta = (result["rps"] / old["rps"] - 1) * 100 if old["rps"] else 0.0
+        p95_delta = (result["latency_ms"]["p95"] / old["latency_ms"]["p95"] - 1) * 100 if old["latency_ms"] else 0.0
+        print(f"  concurrencia {result['concurrency']:>4}: RPS {old['rps']:.1f} -> {result['rps']:.1f} "
+              f"({rps_delta:+.1f}%), p95 {old['latency_ms']['p95']:.0f} -> {result['latency_ms']['p95']:.0f} ms "
+              f"({p95_delta:+.1f}%)")
+
+
+async def _run(args, images: List[bytes], levels: List[int], stack: contextlib.ExitStack) -> List[Dict]:
+    work_dir = tempfile.mkdtemp(prefix="baysafe-load-")
+    env = _backend_env(args, work_dir)
+    process = None
+    log_path = os.path.join(work_dir, "server.log")
+    if args.server == "inproc":
+        # Los print() de la app van al log, no a la salida del benchmark.
+        print(f"App en proceso (log: {log_path})")
+        log = stack.enter_context(open(log_path, "w", encoding="utf-8"))
+        stack.enter_context(contextlib.redirect_stdout(log))
+        os.environ.update(env)
+        from django.core.asgi import get_asgi_application
+        transport = httpx.ASGITransport(app=get_asgi_application())
+        client = httpx.AsyncClient(transport=transport, base_url="http://127.0.0.1", timeout=300)
+    else:
+        process, base_url = _start_server(args, env, log_path)
+        print(f"Servidor {args.server} con {args.workers} workers en {base_url} (log: {log_path})")
+        limits = httpx.Limits(max_connections=max(levels), max_keepalive_connections=max(levels))
+        client = httpx.AsyncClient(base_url=base_url, timeout=300, limits=limits)
+
+    results = []
+    try:
+        async with client:
+            if args.warmup:
+                await _run_level(client, images[:args.warmup], min(args.warmup, max(levels)), args.mode)
+            for concurrency in levels:
+                result = await _run_level(client, images, concurrency, args.mode)
+                if process is None:
+                    result["peak_rss_mb"] = {"inproc": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)}
+                else:
+                    result["peak_rss_mb"] = {str(pid): _peak_rss_mb(pid) for pid in _child_pids(process.pid)}
+                results.append(result)
+    finally:
+        if process is not None:
+            process.send_signal(signal.SIGTERM)
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--server", default="inproc", choices=["inproc", "gunicorn", "uvicorn"])
+    parser.add_argument("--workers", type=int, default=2, help="Procesos del servidor (gunicorn/uvicorn)")
+    parser.add_argument("--concurrency", default="1,8,32", help="Niveles de concurrencia, separados por comas")
+    parser.add_argument("--requests", type=int, default=100, help="Peticiones por nivel")
+    parser.add_argument("--warmup", type=int, default=5, help="Peticiones previas no medidas")
+    parser.add_argument("--sizes", default="1280x960,4032x3024", help="Tamaños de las fotos (AnchoxAlto)")
+    parser.add_argument("--distinct", type=int, default=0, help="Fotos distintas (0 = todas distintas)")
+    parser.add_argument("--labels", default="", help="Vocabulario del detector; repetir una etiqueta aumenta su peso")
+    parser.add_argument("--mode", default="fast", choices=["fast", "rich"])
+    parser.add_argument("--detector-ms", type=float, default=150)
+    parser.add_argument("--detector-jitter-ms", type=float, default=30)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--llm-ms", type=float, default=800)
+    parser.add_argument("--cache", action="store_true", help="Activar las cachés de detecciones e informes y el índice de casi-duplicados")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Guardar el resultado en este JSON")
+    parser.add_argument("--compare", help="JSON de una ejecución anterior para comparar")
+    args = parser.parse_args()
+
+    levels = [int(level) for level in args.concurrency.split(",")]
+    sizes = [size.strip() for size in args.sizes.split(",") if size.strip()]
+    print(f"Generando {args.requests} fotos ({', '.join(sizes)})...")
+    images = _make_images(sizes, args.requests, args.distinct, args.seed)
+
+    with contextlib.ExitStack() as stack:
+        results = asyncio.run(_run(args, images, levels, stack))
+    for result in results:
+        _print_level(result)
+
+    report = {
+        "benchmark": "bench_load",
+        "commit": _git_commit(),
+        "date": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "config": vars(args),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            json.dump(report, output_file, indent=2, ensure_ascii=False)
+        print(f"\nResultado guardado en {args.output}")
+    if args.compare:
+        _compare(args.compare, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""
+Benchmark del retraso del event loop con análisis concurrentes.
+
+Sustituye los clientes de GCS y Vertex por dobles que bloquean el hilo
+(`time.sleep`) durante la latencia configurada y lanza N análisis concurrentes:
+
+  * "en el loop": la herramienta síncrona llamada directamente desde corrutinas
+    (comportamiento anterior: cada llamada congela el loop),
+  * "pool de I/O": la herramienta asíncrona, que delega en `run_blocking`,
+  * "orquestador": `run_safety_analysis_stream` completo en modo "fast"
+    (validación, preprocesado, subida y detección de una foto por análisis).
+
+Antes de medir se hace un análisis de calentamiento (imports perezosos y
+arranque de los hilos del pool) y se mide el loop en reposo: en una máquina
+compartida el planificador del sistema ya añade unos milisegundos. El monitor
+muestrea el loop cada `--interval-ms`; si el p99 de "pool de I/O" u
+"orquestador" supera al de reposo en más de `--max-p99-ms`, el script termina
+con código 1. Con pocas CPU, las llegadas por segundo (`--rate`) deben dejar
+CPU libre para el preprocesado: saturada, el loop espera su turno de CPU.
+
+Uso (desde la raíz del repositorio):
+    python benchmarks/bench_loop_lag.py --concurrency 200 --download-ms 30 --predict-ms 150
+    python benchmarks/bench_loop_lag.py --concurrency 50 --max-p99-ms 5
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Configuración mínima para importar el módulo sin credenciales reales.
+os.environ.setdefault("AGENT_MODEL", "gemini-2.5-flash")
+os.environ.setdefault("GOOGLE_CLOUD_PROJECT", "bench-project")
+os.environ.setdefault("GOOGLE_CLOUD_LOCATION", "us-central1")
+os.environ.setdefault("VERTEX_MODEL_ID", "0")
+os.environ.setdefault("BUCKET_NAME", "bench-bucket")
+os.environ.setdefault("NEAR_DUPLICATE_ENABLED", "False")
+os.environ.setdefault("BAYSAFE_ARCHIVE_ORIGINALS", "False")
+os.environ.setdefault("BAYSAFE_CACHE_DB", os.path.join(tempfile.mkdtemp(), "bench.sqlite3"))
+# El ajuste recomendado para workers con preprocesado (ver README); se aplica
+# como en `mi_proyecto.asgi`.
+os.environ.setdefault("BAYSAFE_GIL_SWITCH_INTERVAL_MS", "1")
+
+from django.core.files.uploadedfile import SimpleUploadedFile  # noqa: E402
+from PIL import Image  # noqa: E402
+
+from core.adk import adk_main  # noqa: E402
+from core.adk.backends import gcp  # noqa: E402
+from core.adk.executor import LoopLagMonitor, apply_gil_switch_interval  # noqa: E402
+
+
+class _SlowBlob:
+    def __init__(self, delay):
+        self.delay = delay
+
+    def download_as_bytes(self):
+        time.sleep(self.delay)
+        return os.urandom(256 * 1024)
+
+    def upload_from_string(self, data, content_type=None):
+        time.sleep(self.delay)
+
+
+class _SlowStorageClient:
+    def __init__(self, delay):
+        self.delay = delay
+
+    def bucket(self, name):
+        return self
+
+    def blob(self, name):
+        return _SlowBlob(self.delay)
+
+
+class _SlowPredictionClient:
+    def __init__(self, delay):
+        self.delay = delay
+
+    def endpoint_path(self, project, location, endpoint):
+        return f"projects/{project}/locations/{location}/endpoints/{endpoint}"
+
+    def predict(self, endpoint, instances, parameters, timeout=None):
+        time.sleep(self.delay)
+        prediction = {"displayNames": ["mesa_bordes", "bateria"], "confidences": [0.9, 0.8]}
+        return type("Response", (), {"predictions": [prediction] * len(instances)})()
+
+
+def _photo(index: int, width: int) -> bytes:
+    """Foto distinta por análisis (el preprocesado y la caché trabajan de verdad)."""
+    height = width * 3 // 4
+    picture = Image.effect_noise((width // 10, height // 10), 40 + index % 50).convert("RGB").resize((width, height))
+    buffer = io.BytesIO()
+    picture.save(buffer, format="JPEG", quality=85)
+    return buffer.getvalue()
+
+
+async def _analyze(index: int, photo: bytes):
+    upload = SimpleUploadedFile(f"foto-{index}.jpg", photo, "image/jpeg")
+    async for _ in adk_main.run_safety_analysis_stream(upload, session_id=f"bench-{index}", mode="fast"):
+        pass
+
+
+async def _arrive(call, index: int, rate: float):
+    # Llegadas repartidas a `rate` por segundo (sin ritmo, todas en el mismo tick).
+    if rate > 0:
+        await asyncio.sleep(index / rate)
+    return await call(index)
+
+
+async def _idle(count: int):
+    await asyncio.sleep(2.0)
+
+
+async def _scenario(name, call, count, args, rate=0.0):
+    monitor = LoopLagMonitor(interval_ms=args.interval_ms)
+    monitor.start()
+    start = time.perf_counter()
+    # Los DEBUG de cada análisis no nos interesan aquí.
+    with contextlib.redirect_stdout(io.StringIO()):
+        await asyncio.gather(*(_arrive(call, i, rate) for i in range(count)))
+    elapsed = time.perf_counter() - start
+    # Dejamos despertar al monitor para que registre el último retraso.
+    await asyncio.sleep(monitor.interval * 2)
+    monitor.stop()
+    stats = monitor.stats()
+    print(f"  {name:<12} total {elapsed:6.2f} s | lag p50 {stats['p50_ms']:7.1f} ms | "
+          f"p99 {stats['p99_ms']:7.1f} ms | máx {stats['max_ms']:7.1f} ms")
+    return stats
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--download-ms", type=float, default=30)
+    parser.add_argument("--predict-ms", type=float, default=150)
+    parser.add_argument("--rate", type=float, default=20,
+                        help="Llegadas por segundo en los escenarios medidos (0 = todas a la vez)")
+    parser.add_argument("--photo-width", type=int, default=640,
+                        help="Ancho de las fotos del orquestador (más ancho = más CPU de preprocesado)")
+    parser.add_argument("--interval-ms", type=float, default=5, help="Periodo de muestreo del monitor")
+    parser.add_argument("--max-p99-ms", type=float, default=5,
+                        help="Exceso de p99 sobre el reposo aceptado fuera del loop")
+    args = parser.parse_args()
+
+    apply_gil_switch_interval()
+    storage_client = _SlowStorageClient(args.download_ms / 1000)
+    prediction_client = _SlowPredictionClient(args.predict_ms / 1000)
+    gcp.get_storage_client = lambda project=None: storage_client
+    gcp.get_prediction_client = lambda api_endpoint, project=None: prediction_client
+
+    async def on_loop(i):
+        return adk_main._predict_image_object_detection_sync(f"gs://bench-bucket/loop-{i}.jpg")
+
+    async def on_pool(i):
+        return await adk_main.predict_image_object_detection_sample(f"gs://bench-bucket/pool-{i}.jpg")
+
+    # Las fotos se generan antes de medir: no son parte del loop de la app.
+    photos = [_photo(i, args.photo_width) for i in range(args.concurrency + 1)]
+
+    async def on_orchestrator(i):
+        return await _analyze(i, photos[i])
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        await on_pool(-1)
+        await _analyze(-1, photos[-1])
+
+    print(f"{args.concurrency} análisis a {args.rate:g}/s, descarga {args.download_ms} ms, "
+          f"predict {args.predict_ms} ms, {os.cpu_count()} CPU")
+    idle = await _scenario("reposo", _idle, 1, args)
+    await _scenario("en el loop", on_loop, min(args.concurrency, 20), args)
+    results = {
+        "pool de I/O": await _scenario("pool de I/O", on_pool, args.concurrency, args, args.rate),
+        "orquestador": await _scenario("orquestador", on_orchestrator, args.concurrency, args, args.rate),
+    }
+
+    limit = idle["p99_ms"] + args.max_p99_ms
+    failed = [name for name, stats in results.items() if stats["p99_ms"] > limit]
+    if failed:
+        print(f"FALLO: p99 del retraso del loop > {limit:.1f} ms (reposo + {args.max_p99_ms:g}) en: {', '.join(failed)}")
+        sys.exit(1)
+    print(f"OK: p99 del retraso del loop <= {limit:.1f} ms (reposo + {args.max_p99_ms:g})")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
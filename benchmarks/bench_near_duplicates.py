@@ -0,0 +1,162 @@
+"""
+Benchmark del índice de casi-duplicados (core/adk/near_duplicates.py).
+
+Los dHash reales no son uniformes: las fotos oscuras, borrosas o lisas dan
+hashes cerca de 0, los buckets del índice crecen y habitaciones distintas
+quedan a menos de `--max-distance` bits. Por eso el benchmark usa, según
+`--hashes`:
+
+  * `scenes` (por defecto): dHash de fotos sintéticas de escenas distintas;
+    `--hard-ratio` de ellas son oscuras, borrosas y de poco contraste,
+  * `photos`: dHash de las fotos reales de `--photos DIR` (todas de escenas
+    distintas: cualquier coincidencia entre ellas es un falso positivo),
+  * `random`: hashes uniformes de 64 bits (el caso optimista).
+
+Guarda la mitad de los hashes en `MultiIndexHashIndex`, consulta con la otra
+mitad y mide, con y sin el filtro de contraste del worker
+(NEAR_DUPLICATE_MIN_CONTRAST_BITS): falsos positivos (fotos distintas que
+reutilizarían las etiquetas de otra), bucket más grande y latencia de consulta
+de vecinos reales (hash guardado con <= max_distance bits invertidos) y de
+fotos sin vecino.
+
+Uso (desde la raíz del repositorio):
+    python benchmarks/bench_near_duplicates.py --items 20000
+    python benchmarks/bench_near_duplicates.py --hashes photos --photos ~/fotos
+    python benchmarks/bench_near_duplicates.py --hashes random --items 1000000
+"""
+
+import argparse
+import io
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image, ImageDraw, ImageFilter  # noqa: E402
+
+from core.adk.near_duplicates import (  # noqa: E402
+    HASH_BITS,
+    NEAR_DUPLICATE_MIN_CONTRAST_BITS,
+    MultiIndexHashIndex,
+    dhash_with_contrast,
+)
+
+PHOTO_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp"}
+
+
+def _scene(rng: random.Random, hard: bool, size=(144, 108)) -> bytes:
+    """Foto sintética: muchas formas nítidas o, si `hard`, pocas, oscuras y borrosas."""
+    if hard:
+        level = int(255 * rng.betavariate(1.2, 6))
+        contrast, shapes, blur = rng.uniform(0, 0.08), rng.randint(1, 4), rng.uniform(2, 10)
+    else:
+        level = rng.randrange(40, 220)
+        contrast, shapes, blur = rng.uniform(0.2, 0.8), rng.randint(15, 40), rng.uniform(0, 1.5)
+    image = Image.new("L", size, level)
+    draw = ImageDraw.Draw(image)
+    for _ in range(shapes):
+        x, y = rng.randrange(size[0]), rng.randrange(size[1])
+        box = (x, y, x + rng.randrange(4, size[0] // 2), y + rng.randrange(4, size[1] // 2))
+        fill = max(0, min(255, int(level + contrast * rng.uniform(-255, 255))))
+        (draw.rectangle if rng.random() < 0.6 else draw.ellipse)(box, fill=fill)
+    buffer = io.BytesIO()
+    image.filter(ImageFilter.GaussianBlur(blur)).convert("RGB").save(buffer, format="JPEG", quality=80)
+    return buffer.getvalue()
+
+
+def _load_hashes(args, rng: random.Random):
+    """Lista de (hash, bits fiables) de escenas distintas."""
+    if args.hashes == "random":
+        return [(rng.getrandbits(HASH_BITS), HASH_BITS) for _ in range(args.items)]
+    if args.hashes == "photos":
+        if not args.photos:
+            sys.exit("--hashes photos necesita --photos DIR")
+        hashes = []
+        for root, _, names in os.walk(os.path.expanduser(args.photos)):
+            for name in sorted(names):
+                if os.path.splitext(name.lower())[1] in PHOTO_EXTENSIONS:
+                    with open(os.path.join(root, name), "rb") as photo:
+                        hashes.append(dhash_with_contrast(photo.read()))
+        rng.shuffle(hashes)
+        return hashes[:args.items]
+    return [dhash_with_contrast(_scene(rng, rng.random() < args.hard_ratio)) for _ in range(args.items)]
+
+
+def _flip_bits(value: int, count: int, rng: random.Random) -> int:
+    for bit in rng.sample(range(HASH_BITS), count):
+        value ^= 1 << bit
+    return value
+
+
+def _measure(index: MultiIndexHashIndex, queries):
+    timings = []
+    hits = 0
+    for value in queries:
+        start = time.perf_counter()
+        match = index.query(value)
+        timings.append(time.perf_counter() - start)
+        hits += match is not None
+    timings.sort()
+    return {
+        "mean_us": statistics.fmean(timings) * 1e6,
+        "p50_us": timings[len(timings) // 2] * 1e6,
+        "p99_us": timings[int(len(timings) * 0.99)] * 1e6,
+        "max_us": timings[-1] * 1e6,
+        "hit_ratio": hits / len(queries),
+    }
+
+
+def _largest_bucket(index: MultiIndexHashIndex) -> int:
+    return max((len(ids) for table in index._tables for ids in table.values()), default=0)
+
+
+def _run(name: str, hashes, args, rng: random.Random) -> None:
+    half = len(hashes) // 2
+    stored, unrelated = [value for value, _ in hashes[:half]], [value for value, _ in hashes[half:]]
+    index = MultiIndexHashIndex(max_distance=args.max_distance)
+    for value in stored:
+        index.add(value, ["mesa_bordes"])
+    near = [_flip_bits(rng.choice(stored), rng.randint(0, args.max_distance), rng) for _ in range(args.queries)]
+
+    print(f"\n{name}: {len(index):,} hashes guardados, bucket más grande {_largest_bucket(index):,}")
+    for label, queries in (("casi-duplicados", near), ("fotos distintas", unrelated)):
+        result = _measure(index, queries)
+        print(f"  {label:<16} media {result['mean_us']:8.1f} µs | p50 {result['p50_us']:8.1f} µs | "
+              f"p99 {result['p99_us']:8.1f} µs | máx {result['max_us']:8.1f} µs | "
+              f"aciertos {result['hit_ratio']:.3f}")
+    print("  (los aciertos de 'fotos distintas' son falsos positivos: etiquetas de otra foto)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--hashes", choices=("scenes", "photos", "random"), default="scenes")
+    parser.add_argument("--photos", help="Directorio con fotos reales de escenas distintas")
+    parser.add_argument("--items", type=int, default=20_000, help="Hashes en total (mitad índice, mitad consultas)")
+    parser.add_argument("--hard-ratio", type=float, default=0.3, help="Fracción de fotos oscuras o borrosas")
+    parser.add_argument("--queries", type=int, default=10_000)
+    parser.add_argument("--max-distance", type=int, default=4)
+    parser.add_argument("--min-contrast-bits", type=int, default=NEAR_DUPLICATE_MIN_CONTRAST_BITS)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    start = time.perf_counter()
+    hashes = _load_hashes(args, rng)
+    if len(hashes) < 2:
+        sys.exit("Se necesitan al menos 2 hashes")
+    print(f"{len(hashes):,} hashes ({args.hashes}) en {time.perf_counter() - start:.1f} s, "
+          f"distancia máx. {args.max_distance}")
+
+    _run("Sin filtro", hashes, args, rng)
+    distinctive = [item for item in hashes if item[1] >= args.min_contrast_bits]
+    print(f"\nFiltro de contraste (>= {args.min_contrast_bits} bits fiables): "
+          f"{len(distinctive) / len(hashes):.1%} de las fotos son reutilizables")
+    if len(distinctive) >= 2:
+        _run("Con filtro", distinctive, args, rng)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Benchmark del post-procesado de detecciones (core/adk/postprocessing.py).
+
+Genera predicciones sintéticas con el formato de Vertex AI (`displayNames`,
+`confidences`, `bboxes`) y mide, para N cajas por imagen:
+  * `legacy`: el recorrido anterior en Python (mejor confianza por etiqueta,
+    sin cajas ni NMS), como referencia,
+  * `numpy`: decodificación, umbral y NMS por clase vectorizados.
+
+Las cajas se agrupan alrededor de unos pocos objetos (caso típico de un
+detector: muchas cajas casi iguales por objeto) o, con `--spread`, se reparten
+al azar por la imagen (peor caso para la NMS: casi todas sobreviven).
+
+Uso (desde la raíz del repositorio):
+    python benchmarks/bench_postprocessing.py --boxes 10,100,1000,5000
+    python benchmarks/bench_postprocessing.py --boxes 1000,5000 --spread
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+from typing import Any, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core.adk.postprocessing import postprocess_predictions  # noqa: E402
+
+LABELS = ["mesa_bordes", "bateria", "jarron", "silla", "planta", "lampara", "sofa", "cadenilla"]
+
+
+def _prediction(boxes: int, objects: int, spread: bool, rng: random.Random) -> Dict[str, Any]:
+    centers = [(rng.random() * 0.7, rng.random() * 0.7, rng.choice(LABELS)) for _ in range(objects)]
+    names, confidences, bboxes = [], [], []
+    for _ in range(boxes):
+        if spread:
+            x, y, label = rng.random() * 0.9, rng.random() * 0.9, rng.choice(LABELS)
+            width = height = 0.02 + rng.random() * 0.08
+        else:
+            x, y, label = rng.choice(centers)
+            x, y = x + rng.gauss(0, 0.01), y + rng.gauss(0, 0.01)
+            width = height = 0.2
+        names.append(label)
+        confidences.append(rng.random())
+        bboxes.append([x, x + width, y, y + height])
+    return {"displayNames": names, "confidences": confidences, "bboxes": bboxes}
+
+
+def _legacy(predictions: List[Dict[str, Any]], min_confidence: float) -> List[str]:
+    best_confidence: Dict[str, float] = {}
+    for prediction in predictions:
+        pred_dict = dict(prediction)
+        for index in [i for i, x in enumerate(pred_dict["confidences"]) if x > min_confidence]:
+            label = pred_dict["displayNames"][index]
+            confidence = float(pred_dict["confidences"][index])
+            best_confidence[label] = max(confidence, best_confidence.get(label, 0.0))
+    return list(best_confidence)
+
+
+def _measure(function, repeat: int) -> Dict[str, float]:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return {"p50_ms": statistics.median(timings) * 1000, "max_ms": max(timings) * 1000, "result": result}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--boxes", default="10,100,1000,5000", help="Cajas por imagen, separadas por coma")
+    parser.add_argument("--objects", type=int, default=12, help="Objetos reales por imagen (sin --spread)")
+    parser.add_argument("--spread", action="store_true", help="Cajas repartidas al azar (peor caso de la NMS)")
+    parser.add_argument("--min-confidence", type=float, default=0.5)
+    parser.add_argument("--iou", type=float, default=0.5)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    print(f"{'cajas':>7}{'legacy p50 (ms)':>17}{'numpy p50 (ms)':>16}{'numpy max (ms)':>16}{'detecciones':>13}")
+    for boxes in [int(value) for value in args.boxes.split(",")]:
+        predictions = [_prediction(boxes, args.objects, args.spread, rng)]
+        legacy = _measure(lambda: _legacy(predictions, args.min_confidence), args.repeat)
+        vectorized = _measure(
+            lambda: postprocess_predictions(predictions, args.min_confidence, args.iou), args.repeat
+        )
+        detections, _ = vectorized["result"]
+        print(f"{boxes:>7}{legacy['p50_ms']:>17.3f}{vectorized['p50_ms']:>16.3f}"
+              f"{vectorized['max_ms']:>16.3f}{len(detections):>13}")
+
+
+if __name__ == "__main__":
+    main()
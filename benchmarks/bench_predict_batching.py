@@ -0,0 +1,72 @@
+"""
+Benchmark del agrupamiento de llamadas `predict` (core/adk/batching.py).
+
+Lanza una ráfaga de N detecciones concurrentes (hilos, como el pool de I/O)
+contra un cliente de predicción simulado cuya latencia es `--rpc-ms` más
+`--per-instance-ms` por instancia, y compara el número de RPCs y el tiempo
+total con lotes de distinto tamaño.
+
+Uso (desde la raíz del repositorio):
+    python benchmarks/bench_predict_batching.py --requests 200 --threads 16
+"""
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from google.protobuf.struct_pb2 import Value  # noqa: E402
+
+from core.adk.batching import PredictBatcher  # noqa: E402
+
+
+class _FakePredictionClient:
+    def __init__(self, rpc_ms, per_instance_ms):
+        self.rpc = rpc_ms / 1000
+        self.per_instance = per_instance_ms / 1000
+
+    def predict(self, endpoint, instances, parameters, timeout=None):
+        time.sleep(self.rpc + self.per_instance * len(instances))
+        prediction = {"displayNames": ["mesa_bordes"], "confidences": [0.9]}
+        return type("Response", (), {"predictions": [prediction] * len(instances)})()
+
+
+def _run(batch_size, args):
+    client = _FakePredictionClient(args.rpc_ms, args.per_instance_ms)
+    batcher = PredictBatcher(max_batch_size=batch_size, max_wait_ms=args.wait_ms)
+    parameters = {"confidence_threshold": 0.5, "max_predictions": 5}
+
+    def call(_):
+        future = batcher.submit(client, "projects/p/locations/l/endpoints/e", Value(), parameters, args.instance_kb * 1024)
+        return batcher.result(future)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        list(pool.map(call, range(args.requests)))
+    elapsed = time.perf_counter() - start
+    stats = batcher.stats()
+    print(f"  lote máx {batch_size:>2} | RPCs {stats['rpcs']:>4} | lote medio {stats['mean_batch_size']:4.1f} | "
+          f"total {elapsed:5.2f} s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--rpc-ms", type=float, default=120)
+    parser.add_argument("--per-instance-ms", type=float, default=10)
+    parser.add_argument("--wait-ms", type=float, default=10)
+    parser.add_argument("--instance-kb", type=int, default=150)
+    args = parser.parse_args()
+
+    print(f"{args.requests} detecciones, {args.threads} hilos, RPC {args.rpc_ms} ms "
+          f"+ {args.per_instance_ms} ms/instancia, instancias de {args.instance_kb} KB")
+    for batch_size in (1, 4, 8):
+        _run(batch_size, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Benchmark del preprocesado de imágenes (core/adk/preprocessing.py).
+
+Genera una foto sintética del tamaño de una cámara de móvil (ruido + degradados,
+difícil de comprimir, con orientación EXIF) y compara, por imagen:
+  * bytes subidos a GCS y bytes del payload base64 enviado a Vertex AI,
+  * tiempo de preprocesado frente al tiempo de transferencia ahorrado
+    (a un ancho de banda de subida dado).
+
+Uso (desde la raíz del repositorio):
+    python benchmarks/bench_preprocessing.py --width 4032 --height 3024 --mbps 20
+"""
+
+import argparse
+import base64
+import io
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image  # noqa: E402
+
+from core.adk.preprocessing import PREPROCESS_MAX_BYTES, PREPROCESS_MAX_SIDE, preprocess_image  # noqa: E402
+
+
+def _synthetic_photo(width: int, height: int, quality: int) -> bytes:
+    noise = Image.effect_noise((width, height), 40).convert("RGB")
+    gradient = Image.linear_gradient("L").resize((width, height)).convert("RGB")
+    image = Image.blend(noise, gradient, 0.5)
+    exif = Image.Exif()
+    exif[0x0112] = 6  # Orientación: rotada 90° (foto en vertical)
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality, exif=exif)
+    return buffer.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--width", type=int, default=4032)
+    parser.add_argument("--height", type=int, default=3024)
+    parser.add_argument("--quality", type=int, default=95, help="Calidad JPEG de la foto original")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--mbps", type=float, default=20.0, help="Ancho de banda de subida (Mbit/s)")
+    parser.add_argument("--format", default="JPEG", choices=["JPEG", "WEBP"])
+    args = parser.parse_args()
+
+    original = _synthetic_photo(args.width, args.height, args.quality)
+
+    timings = []
+    prepared = None
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        prepared = preprocess_image(original, image_format=args.format)
+        timings.append(time.perf_counter() - start)
+
+    def transfer_ms(size: int) -> float:
+        return size * 8 / (args.mbps * 1e6) * 1000.0
+
+    original_b64 = len(base64.b64encode(original))
+    prepared_b64 = len(base64.b64encode(prepared.data))
+    preprocess_ms = statistics.fmean(timings) * 1000.0
+    # Sin preprocesado la imagen se sube a GCS y su base64 viaja a Vertex AI.
+    saved_ms = (transfer_ms(len(original)) + transfer_ms(original_b64)
+                - transfer_ms(len(prepared.data)) - transfer_ms(prepared_b64))
+
+    print(f"Original:     {args.width}x{args.height}, {len(original):>10,} bytes, base64 {original_b64:>10,} bytes")
+    print(f"Preprocesada: {prepared.width}x{prepared.height} {args.format}, {len(prepared.data):>10,} bytes, "
+          f"base64 {prepared_b64:>10,} bytes (lado máx. {PREPROCESS_MAX_SIDE}, presupuesto {PREPROCESS_MAX_BYTES:,})")
+    print(f"Ahorro:       {1 - len(prepared.data) / len(original):.1%} de bytes por imagen")
+    print(f"Preprocesado: media {preprocess_ms:.1f} ms | p50 {sorted(timings)[len(timings) // 2] * 1000:.1f} ms")
+    print(f"Transferencia ahorrada a {args.mbps:g} Mbit/s: {saved_ms:.0f} ms "
+          f"(neto {saved_ms - preprocess_ms:.0f} ms por imagen)")
+
+
+if __name__ == "__main__":
+    main()
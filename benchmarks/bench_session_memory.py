@@ -0,0 +1,93 @@
+"""
+Benchmark de memoria y tamaño de prompt en una conversación larga.
+
+Simula N turnos de chat (mensaje del usuario con la URI, llamada a la
+herramienta de detección, respuesta de la herramienta e informe final) sobre:
+
+  * `InMemorySessionService` (historial sin límite, comportamiento anterior),
+  * `CompactingSessionService` (historial acotado con resumen).
+
+Para cada servicio reporta, cada 20 turnos, la memoria Python asignada
+(tracemalloc), el número de eventos y el tamaño del historial que el Runner
+reenvía al LLM en el siguiente turno.
+
+Uso (desde la raíz del repositorio):
+    python benchmarks/bench_session_memory.py --turns 200
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from google.adk.events import Event  # noqa: E402
+from google.adk.sessions import InMemorySessionService  # noqa: E402
+from google.genai import types  # noqa: E402
+
+from core.adk.sessions import (  # noqa: E402
+    APP_NAME,
+    DETECTION_TOOL_NAME,
+    CompactingSessionService,
+    _event_size,
+)
+
+REPORT = (
+    "Detecté los siguientes objetos: mesa_bordes, bateria y juguete_madera. "
+    "La mesa con bordes es PELIGROSA porque un bebé puede golpearse la cabeza. "
+    "La batería es PELIGROSA porque puede ser ingerida. "
+    "El juguete de madera es PELIGROSO por sus piezas pequeñas. "
+    "Conclusión: la zona NO es segura para un bebé hasta retirar estos objetos. "
+) * 3
+
+
+async def _turn(service, session, turn: int) -> None:
+    invocation = f"inv-{turn}"
+    events = [
+        Event(author="user", invocation_id=invocation, content=types.Content(
+            role="user", parts=[types.Part(text=f"gs://bench-bucket/uploads/{turn:04d}.jpg")])),
+        Event(author="BaySafe_Unified", invocation_id=invocation, content=types.Content(
+            role="model", parts=[types.Part(function_call=types.FunctionCall(
+                name=DETECTION_TOOL_NAME, args={"gcs_source": f"gs://bench-bucket/uploads/{turn:04d}.jpg"}))])),
+        Event(author="BaySafe_Unified", invocation_id=invocation, content=types.Content(
+            role="user", parts=[types.Part(function_response=types.FunctionResponse(
+                name=DETECTION_TOOL_NAME, response={"result": ["mesa_bordes", "bateria", "juguete_madera"]}))])),
+        Event(author="BaySafe_Unified", invocation_id=invocation, content=types.Content(
+            role="model", parts=[types.Part(text=REPORT)])),
+    ]
+    for event in events:
+        await service.append_event(session=session, event=event)
+
+
+async def _run(name, service, turns: int) -> None:
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    session = await service.create_session(app_name=APP_NAME, user_id="bench", session_id="chat")
+
+    print(f"\n{name}")
+    print(f"  {'turno':>5} | {'memoria KiB':>11} | {'eventos':>7} | {'prompt (bytes)':>14}")
+    for turn in range(1, turns + 1):
+        # El Runner relee la sesión al inicio de cada turno (copia profunda).
+        session = await service.get_session(app_name=APP_NAME, user_id="bench", session_id="chat")
+        await _turn(service, session, turn)
+        if turn % 20 == 0 or turn == 1:
+            stored = await service.get_session(app_name=APP_NAME, user_id="bench", session_id="chat")
+            memory = (tracemalloc.get_traced_memory()[0] - baseline) / 1024
+            prompt = sum(_event_size(event) for event in stored.events)
+            print(f"  {turn:>5} | {memory:>11.1f} | {len(stored.events):>7} | {prompt:>14}")
+    tracemalloc.stop()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, default=200)
+    args = parser.parse_args()
+
+    await _run("InMemorySessionService (sin límite)", InMemorySessionService(), args.turns)
+    await _run("CompactingSessionService", CompactingSessionService(), args.turns)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
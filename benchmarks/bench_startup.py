@@ -0,0 +1,176 @@
+"""
+Benchmark del arranque de un worker y de los comandos de `manage.py`.
+
+Cada repetición corre en un intérprete nuevo y mide, fase a fase, el tiempo y
+el RSS del proceso (VmRSS):
+
+  * `settings`: `django.setup()` (lo que paga cualquier `manage.py` y el
+    arranque de cada worker de gunicorn),
+  * `urls`: importar el URLconf y las vistas (primera petición o `manage.py check`),
+  * `warmup`: el calentamiento explícito del worker (`core.adk.warmup.warm_up`:
+    agente, Runner y clientes). En un árbol sin ese módulo se mide lo
+    equivalente, importar `core.adk.adk_main`.
+
+Además mide el tiempo total de `python manage.py check`. Con `--output` guarda
+el resultado en JSON (con el commit) y con `--compare` lo contrasta con uno
+anterior, p.ej. el de otro commit.
+
+Uso (desde la raíz del repositorio):
+    python benchmarks/bench_startup.py --repeat 5 --output antes.json
+    python benchmarks/bench_startup.py --repeat 5 --compare antes.json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PHASES = ("settings", "urls", "warmup")
+
+# Se ejecuta en un intérprete nuevo por repetición; imprime una línea JSON.
+_CHILD = r"""
+import importlib, json, os, sys, time
+sys.path.insert(0, os.getcwd())
+
+def rss_mb():
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+result = {"baseline_rss_mb": rss_mb()}
+start = time.perf_counter()
+import django
+django.setup()
+result["settings"] = {"s": time.perf_counter() - start, "rss_mb": rss_mb()}
+
+from django.conf import settings
+start = time.perf_counter()
+importlib.import_module(settings.ROOT_URLCONF)
+result["urls"] = {"s": time.perf_counter() - start, "rss_mb": rss_mb()}
+
+start = time.perf_counter()
+try:
+    from core.adk.warmup import warm_up
+except ImportError:
+    importlib.import_module("core.adk.adk_main")
+else:
+    warm_up()
+result["warmup"] = {"s": time.perf_counter() - start, "rss_mb": rss_mb()}
+print("BENCH " + json.dumps(result))
+"""
+
+
+def _env(args) -> Dict[str, str]:
+    env = dict(os.environ)
+    env.setdefault("DJANGO_SETTINGS_MODULE", "mi_proyecto.settings")
+    env["BAYSAFE_BACKENDS"] = args.backends
+    # Configuración mínima (la de un .env real) para que el agente se pueda construir.
+    env.setdefault("AGENT_MODEL", "gemini-2.0-flash")
+    env.setdefault("GOOGLE_CLOUD_PROJECT", "baysafe-bench")
+    env.setdefault("GOOGLE_CLOUD_LOCATION", "us-central1")
+    env.setdefault("VERTEX_MODEL_ID", "0")
+    env.setdefault("BUCKET_NAME", "baysafe-bench")
+    # Sin credenciales ni red: el calentamiento de los clientes de GCP falla
+    # rápido en lugar de esperar al canal.
+    env.setdefault("BAYSAFE_WARMUP_CONNECT_TIMEOUT", "1")
+    return env
+
+
+def _run_child(args) -> Dict:
+    output = subprocess.run(
+        [sys.executable, "-c", _CHILD], cwd=ROOT, env=_env(args),
+        capture_output=True, text=True, check=True,
+    ).stdout
+    line = next(line for line in output.splitlines() if line.startswith("BENCH "))
+    return json.loads(line[len("BENCH "):])
+
+
+def _manage_check(args) -> float:
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, "manage.py", "check"], cwd=ROOT, env=_env(args),
+        capture_output=True, check=True,
+    )
+    return time.perf_counter() - start
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "desconocido"
+
+
+def _summary(runs: List[Dict], checks: List[float]) -> Dict:
+    summary = {
+        phase: {
+            "s": round(statistics.median(run[phase]["s"] for run in runs), 3),
+            "rss_mb": round(statistics.median(run[phase]["rss_mb"] for run in runs), 1),
+        }
+        for phase in PHASES
+    }
+    summary["manage_check_s"] = round(statistics.median(checks), 3)
+    return summary
+
+
+def _print(summary: Dict) -> None:
+    print(f"  {'fase':<10}{'tiempo (s)':>12}{'RSS (MB)':>12}")
+    for phase in PHASES:
+        print(f"  {phase:<10}{summary[phase]['s']:>12.3f}{summary[phase]['rss_mb']:>12.1f}")
+    print(f"  manage.py check: {summary['manage_check_s']:.3f} s")
+
+
+def _compare(path: str, summary: Dict) -> None:
+    with open(path, encoding="utf-8") as base_file:
+        base = json.load(base_file)
+    old = base["summary"]
+    print(f"\nComparación con {path} (commit {base.get('commit', '?')}):")
+    for phase in PHASES:
+        print(f"  {phase:<10} {old[phase]['s']:.3f} -> {summary[phase]['s']:.3f} s, "
+              f"RSS {old[phase]['rss_mb']:.1f} -> {summary[phase]['rss_mb']:.1f} MB")
+    print(f"  manage.py check {old['manage_check_s']:.3f} -> {summary['manage_check_s']:.3f} s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5, help="Intérpretes nuevos por medición (se reporta la mediana)")
+    parser.add_argument("--backends", default="gcp", choices=["gcp", "fake"])
+    parser.add_argument("--output", help="Guardar el resultado en este JSON")
+    parser.add_argument("--compare", help="JSON de una ejecución anterior para comparar")
+    args = parser.parse_args()
+
+    runs = [_run_child(args) for _ in range(args.repeat)]
+    checks = [_manage_check(args) for _ in range(args.repeat)]
+    summary = _summary(runs, checks)
+    print(f"Arranque (mediana de {args.repeat}, backends {args.backends}):")
+    _print(summary)
+
+    report = {
+        "benchmark": "bench_startup",
+        "commit": _git_commit(),
+        "date": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "config": vars(args),
+        "summary": summary,
+        "runs": runs,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            json.dump(report, output_file, indent=2, ensure_ascii=False)
+        print(f"\nResultado guardado en {args.output}")
+    if args.compare:
+        _compare(args.compare, summary)
+
+
+if __name__ == "__main__":
+    main()
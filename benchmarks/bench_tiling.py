@@ -0,0 +1,217 @@
+"""
+Benchmark de la inferencia por teselas (core/adk/tiling.py): latencia vs. recall.
+
+Genera escenas sintéticas (una foto con ruido, del tamaño de la de un móvil)
+con objetos pequeños y grandes y las analiza con la imagen completa y con cada
+tamaño de tesela indicado, recortando las teselas del original (como el
+orquestador) y, para comparar, de la copia reducida a `--preprocess-side`.
+Recorte, compresión y post-procesado (traslado de cajas + NMS por clase) son
+el código real. El detector es un modelo de resolución:
+  * reduce cada instancia a `--model-input` píxeles por lado (una instancia
+    más pequeña no gana detalle al ampliarse) y solo ve los objetos que, así
+    reducidos, miden al menos `--min-pixels` y caen enteros (o en su mayor
+    parte) dentro de la instancia,
+  * tarda `--rpc-ms` por llamada más `--instance-ms` por instancia.
+
+Un objeto cuenta como encontrado si alguna detección de su etiqueta lo cubre
+con IoU >= 0.5. Se reportan recall (pequeños y grandes), detecciones por
+imagen, instancias y payload por llamada, y la latencia: medida (teselas y
+post-procesado) más la modelada del detector.
+
+Uso (desde la raíz del repositorio):
+    python benchmarks/bench_tiling.py --tile-sizes 512,640,1024 --images 20
+    python benchmarks/bench_tiling.py --width 2560 --height 1920 --max-tiles 12
+"""
+
+import argparse
+import io
+import os
+import random
+import statistics
+import sys
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image  # noqa: E402
+
+from core.adk.postprocessing import postprocess_predictions  # noqa: E402
+from core.adk.tiling import FULL_REGION, make_tiles  # noqa: E402
+
+SMALL_LABELS = ["bateria", "cadenilla", "moneda"]
+LARGE_LABELS = ["mesa_bordes", "sofa", "silla", "jarron"]
+
+# Objeto de la escena: (etiqueta, x_min, y_min, x_max, y_max normalizadas, pequeño)
+SceneObject = Tuple[str, float, float, float, float, bool]
+
+
+def _scene(width: int, height: int, small: int, large: int, rng: random.Random) -> Tuple[bytes, List[SceneObject]]:
+    objects: List[SceneObject] = []
+    for count, labels, low, high, is_small in ((small, SMALL_LABELS, 0.01, 0.03, True),
+                                               (large, LARGE_LABELS, 0.15, 0.4, False)):
+        for _ in range(count):
+            side = rng.uniform(low, high)
+            x, y = rng.uniform(0, 1 - side), rng.uniform(0, 1 - side * width / height)
+            objects.append((rng.choice(labels), x, y, x + side, y + side * width / height, is_small))
+    # Ruido de baja frecuencia: se comprime como una foto, no como ruido blanco.
+    picture = Image.merge("RGB", [
+        Image.effect_noise((max(1, width // 16), max(1, height // 16)), 60).resize((width, height), Image.BICUBIC)
+        for _ in range(3)
+    ])
+    buffer = io.BytesIO()
+    picture.save(buffer, format="JPEG", quality=85)
+    return buffer.getvalue(), objects
+
+
+def _synthetic_prediction(
+        region: Tuple[float, float, float, float],
+        instance_side: int,
+        objects: List[SceneObject],
+        args,
+        rng: random.Random
+) -> Dict[str, Any]:
+    """Lo que el modelo de resolución ve en una instancia (formato de Vertex AI)."""
+    rx0, ry0, rx1, ry1 = region
+    region_px = max((rx1 - rx0) * args.width, (ry1 - ry0) * args.height)
+    scale = min(args.model_input, instance_side) / region_px
+    names, confidences, bboxes = [], [], []
+    for label, x0, y0, x1, y1, _ in objects:
+        cx0, cy0, cx1, cy1 = max(x0, rx0), max(y0, ry0), min(x1, rx1), min(y1, ry1)
+        if cx1 <= cx0 or cy1 <= cy0:
+            continue
+        visible = (cx1 - cx0) * (cy1 - cy0) / ((x1 - x0) * (y1 - y0))
+        apparent = min((x1 - x0) * args.width, (y1 - y0) * args.height) * scale
+        if visible < 0.6 or apparent < args.min_pixels:
+            continue
+        # Más confianza cuanto más grande y completo se ve; cajas con algo de ruido.
+        confidence = min(0.99, 0.5 + 0.2 * visible + 0.3 * min(1.0, apparent / (4 * args.min_pixels)))
+        tx0, tx1 = (cx0 - rx0) / (rx1 - rx0), (cx1 - rx0) / (rx1 - rx0)
+        ty0, ty1 = (cy0 - ry0) / (ry1 - ry0), (cy1 - ry0) / (ry1 - ry0)
+        # La caja y un par de duplicadas (las que la NMS debe fusionar), con un
+        # error del 3% del tamaño del objeto.
+        for copy in range(3):
+            dx, dy = 0.03 * (tx1 - tx0), 0.03 * (ty1 - ty0)
+            names.append(label)
+            confidences.append(round(confidence * (rng.uniform(0.8, 0.98) if copy else 1.0), 4))
+            bboxes.append([tx0 + rng.gauss(0, dx), tx1 + rng.gauss(0, dx), ty0 + rng.gauss(0, dy), ty1 + rng.gauss(0, dy)])
+    return {"displayNames": names, "confidences": confidences, "bboxes": bboxes}
+
+
+def _iou(a, b) -> float:
+    width = max(0.0, min(a[2], b[2]) - max(a[0], b[0]))
+    height = max(0.0, min(a[3], b[3]) - max(a[1], b[1]))
+    intersection = width * height
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+def _side(image_bytes: bytes) -> int:
+    with Image.open(io.BytesIO(image_bytes)) as picture:
+        return max(picture.size)
+
+
+def _preprocessed(image_bytes: bytes, max_side: int) -> bytes:
+    """La copia que sube el orquestador (solo el tamaño importa aquí)."""
+    with Image.open(io.BytesIO(image_bytes)) as picture:
+        picture = picture.convert("RGB")
+    picture.thumbnail((max_side, max_side), Image.LANCZOS)
+    buffer = io.BytesIO()
+    picture.save(buffer, format="JPEG", quality=85)
+    return buffer.getvalue()
+
+
+def _run(
+        image_bytes: bytes,
+        preprocessed: bytes,
+        objects: List[SceneObject],
+        tile_size: Optional[int],
+        tile_source: bytes,
+        args,
+        rng: random.Random
+):
+    start = time.perf_counter()
+    tiles = make_tiles(tile_source, tile_size, args.overlap, args.max_tiles, not args.no_full) if tile_size else None
+    regions = [tile.region for tile in tiles] if tiles else [FULL_REGION]
+    instances = [tile.data for tile in tiles] if tiles else [preprocessed]
+    payload = sum(len(instance) for instance in instances)
+    predictions = [
+        _synthetic_prediction(region, _side(instance), objects, args, rng)
+        for region, instance in zip(regions, instances)
+    ]
+    detections, _ = postprocess_predictions(predictions, args.min_confidence, args.iou, regions=regions)
+    measured = time.perf_counter() - start
+    modeled = (args.rpc_ms + args.instance_ms * len(regions)) / 1000
+
+    found = {True: 0, False: 0}
+    for label, x0, y0, x1, y1, is_small in objects:
+        if any(d.label == label and d.box and _iou(d.box, (x0, y0, x1, y1)) >= 0.5 for d in detections):
+            found[is_small] += 1
+    return {
+        "latency_s": measured + modeled,
+        "measured_s": measured,
+        "instances": len(regions),
+        "payload_kb": payload * 4 / 3 / 1024,
+        "detections": len(detections),
+        "found_small": found[True],
+        "found_large": found[False],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", type=int, default=10)
+    parser.add_argument("--width", type=int, default=4032, help="Foto original (las teselas se recortan de ella)")
+    parser.add_argument("--height", type=int, default=3024)
+    parser.add_argument("--preprocess-side", type=int, default=1280,
+                        help="Lado mayor de la copia preprocesada (imagen completa y comparación)")
+    parser.add_argument("--small", type=int, default=6, help="Objetos pequeños por escena")
+    parser.add_argument("--large", type=int, default=3, help="Objetos grandes por escena")
+    parser.add_argument("--tile-sizes", default="512,640,1024", help="Lados de tesela a comparar")
+    parser.add_argument("--overlap", type=float, default=0.2)
+    parser.add_argument("--max-tiles", type=int, default=8)
+    parser.add_argument("--no-full", action="store_true", help="No añadir la imagen completa a las teselas")
+    parser.add_argument("--model-input", type=int, default=512, help="Resolución de entrada del detector")
+    parser.add_argument("--min-pixels", type=float, default=12, help="Tamaño mínimo visible para el detector")
+    parser.add_argument("--rpc-ms", type=float, default=150, help="Latencia modelada por llamada")
+    parser.add_argument("--instance-ms", type=float, default=40, help="Latencia modelada por instancia")
+    parser.add_argument("--min-confidence", type=float, default=0.5)
+    parser.add_argument("--iou", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    scenes = []
+    for _ in range(args.images):
+        image_bytes, objects = _scene(args.width, args.height, args.small, args.large, rng)
+        scenes.append((image_bytes, _preprocessed(image_bytes, args.preprocess_side), objects))
+    # (nombre, lado de tesela, teselas del original o de la copia preprocesada)
+    configs = [("imagen completa", None, False)]
+    for tile_size in [int(value) for value in args.tile_sizes.split(",")]:
+        configs.append((f"teselas {tile_size}", tile_size, True))
+        configs.append(("  (preproc.)", tile_size, False))
+
+    print(f"{args.images} escenas de {args.width}x{args.height} (preprocesadas a {args.preprocess_side} px), "
+          f"{args.small} objetos pequeños y {args.large} grandes; detector a {args.model_input} px")
+    print(f"{'modo':<16}{'inst.':>6}{'payload KB':>12}{'latencia ms':>13}{'medida ms':>11}"
+          f"{'recall peq.':>13}{'recall gr.':>12}{'det./img':>10}")
+    for name, tile_size, from_original in configs:
+        runs = [
+            _run(image_bytes, preprocessed, objects, tile_size, image_bytes if from_original else preprocessed,
+                 args, rng)
+            for image_bytes, preprocessed, objects in scenes
+        ]
+        small_total = args.small * len(runs) or 1
+        large_total = args.large * len(runs) or 1
+        print(f"{name:<16}"
+              f"{statistics.median(r['instances'] for r in runs):>6.0f}"
+              f"{statistics.median(r['payload_kb'] for r in runs):>12.0f}"
+              f"{statistics.median(r['latency_s'] for r in runs) * 1000:>13.0f}"
+              f"{statistics.median(r['measured_s'] for r in runs) * 1000:>11.1f}"
+              f"{sum(r['found_small'] for r in runs) / small_total:>13.2f}"
+              f"{sum(r['found_large'] for r in runs) / large_total:>12.2f}"
+              f"{statistics.mean(r['detections'] for r in runs):>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+"""
+Benchmark de la memoria de un worker en régimen estable y cota por límites.
+
+El RSS tras el calentamiento (bench_startup.py) no incluye lo que crece con
+el uso: sesiones del agente, caché de blobs, cachés de resultados e índice de
+casi-duplicados. Este script, con los backends simulados y en un solo proceso:
+
+  1. calienta el worker (`core.adk.warmup.warm_up`) y mide el RSS,
+  2. lanza `--analyses` análisis en modo "rich" con `--concurrency` en vuelo,
+     fotos distintas y `--users` chats distintos, y muestrea el RSS en 10
+     puntos: la curva muestra si la memoria se estabiliza,
+  3. llena el índice de casi-duplicados hasta `--index-items` hashes
+     (NEAR_DUPLICATE_MAX_ITEMS por defecto; sería lento llegar con análisis) y
+     mide cuánto ocupa cada hash,
+  4. calcula la cota por worker con los límites configurados: RSS calentado +
+     lo medido para los análisis en vuelo + BLOB_CACHE_MAX_BYTES +
+     BAYSAFE_SESSION_MEMORY_BUDGET + índice lleno (NEAR_DUPLICATE_MAX_ITEMS),
+     y, con `--host-memory-mb`, cuántos workers caben en el host.
+
+Las cachés de resultados no se cuentan aparte: en memoria guardan pocas
+entradas pequeñas (su cola en SQLite está en disco) y ya están en la curva.
+
+Uso (desde la raíz del repositorio):
+    python benchmarks/bench_worker_memory.py --analyses 2000 --users 500
+    python benchmarks/bench_worker_memory.py --index-items 200000 --host-memory-mb 4096
+"""
+
+import argparse
+import asyncio
+import io
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from typing import Dict
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+_WORK_DIR = tempfile.mkdtemp(prefix="baysafe_memory_")
+# Backends simulados y cachés aisladas (antes de importar Django y la app).
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "benchmarks.load_settings")
+os.environ["BAYSAFE_BACKENDS"] = "fake"
+os.environ["BAYSAFE_FAKE_STORAGE_DIR"] = os.path.join(_WORK_DIR, "gcs")
+os.environ["BAYSAFE_CACHE_DB"] = os.path.join(_WORK_DIR, "cache.sqlite3")
+os.environ.setdefault("BAYSAFE_FAKE_DETECTOR_LATENCY_MS", "20")
+os.environ.setdefault("BAYSAFE_FAKE_LLM_LATENCY_MS", "20")
+os.environ.setdefault("BAYSAFE_ARCHIVE_ORIGINALS", "False")
+# Sin aciertos en las cachés de informes: cada análisis pasa por el agente.
+os.environ.setdefault("REPORT_CACHE_TTL", "0")
+os.environ.setdefault("AGENT_MODEL", "gemini-2.5-flash")
+os.environ.setdefault("GOOGLE_CLOUD_PROJECT", "bench-project")
+os.environ.setdefault("GOOGLE_CLOUD_LOCATION", "us-central1")
+os.environ.setdefault("VERTEX_MODEL_ID", "0")
+os.environ.setdefault("BUCKET_NAME", "bench-bucket")
+
+MB = 1024 * 1024
+
+
+def rss_mb() -> float:
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+import django  # noqa: E402
+
+django.setup()
+# Antes de importar la app (el agente y los SDK se cargan con adk_main).
+DJANGO_RSS_MB = rss_mb()
+
+from django.core.files.uploadedfile import SimpleUploadedFile  # noqa: E402
+from PIL import Image, ImageDraw  # noqa: E402
+
+from core.adk import adk_main  # noqa: E402
+from core.adk.blob_cache import BLOB_CACHE_MAX_BYTES, blob_cache  # noqa: E402
+from core.adk.near_duplicates import HASH_BITS, NEAR_DUPLICATE_MAX_ITEMS, near_duplicate_store  # noqa: E402
+from core.adk.sessions import SESSION_MEMORY_BUDGET, session_registry  # noqa: E402
+from core.adk.warmup import warm_up  # noqa: E402
+
+
+def _photo(base: Image.Image, rng: random.Random) -> bytes:
+    """Una foto distinta byte a byte y para el dHash (rectángulo al azar)."""
+    image = base.copy()
+    x, y = rng.randrange(image.width // 2), rng.randrange(image.height // 2)
+    ImageDraw.Draw(image).rectangle(
+        (x, y, x + image.width // 3, y + image.height // 3),
+        fill=(rng.randrange(256), rng.randrange(256), rng.randrange(256)),
+    )
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=85)
+    return buffer.getvalue()
+
+
+def _sample(done: int) -> Dict[str, float]:
+    sessions = session_registry.stats()
+    return {
+        "analyses": done,
+        "rss_mb": rss_mb(),
+        "sessions": sessions["active"],
+        "session_mb": sessions["memory_bytes"] / MB,
+        "index_items": near_duplicate_store.stats()["items"],
+        "blobs": blob_cache.stats()["items"],
+    }
+
+
+async def _load(args, rng: random.Random):
+    width = args.photo_width
+    base = Image.blend(
+        Image.effect_noise((width, width * 3 // 4), 40).convert("RGB"),
+        Image.linear_gradient("L").resize((width, width * 3 // 4)).convert("RGB"),
+        0.5,
+    )
+    checkpoints = {max(1, args.analyses * step // 10) for step in range(1, 11)}
+    samples = []
+    done = 0
+    next_index = 0
+    # Salida de depuración de cada análisis: no interesa aquí.
+    quiet = io.StringIO()
+
+    async def worker():
+        nonlocal done, next_index
+        while next_index < args.analyses:
+            index = next_index
+            next_index += 1
+            upload = SimpleUploadedFile(f"foto-{index}.jpg", _photo(base, rng), "image/jpeg")
+            await adk_main.run_safety_analysis(
+                upload, user_id=f"user-{index % args.users}", session_id=f"chat-{index % args.users}", mode="rich"
+            )
+            done += 1
+            if done in checkpoints:
+                samples.append(_sample(done))
+                quiet.seek(0)
+                quiet.truncate()
+
+    stdout = sys.stdout
+    sys.stdout = quiet
+    try:
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    finally:
+        sys.stdout = stdout
+    return samples
+
+
+def _fill_index(items: int, rng: random.Random) -> float:
+    """
+    Llena el índice de casi-duplicados por su camino real (tabla SQLite +
+    sincronización), que es lo que hace un worker nuevo al arrancar; el RSS por
+    hash incluye por tanto las filas leídas de una vez en esa sincronización.
+    """
+    conn = sqlite3.connect(near_duplicate_store.db_path)
+    near_duplicate_store._connection()  # crea la tabla si aún no existe
+    existing = near_duplicate_store.stats()["items"]
+    rows = ((
+        "bench", rng.getrandbits(HASH_BITS) - (1 << (HASH_BITS - 1)), "mesa_bordes\nbateria", time.time()
+    ) for _ in range(max(0, items - existing)))
+    with conn:
+        conn.executemany("INSERT INTO near_duplicates (namespace, hash, labels, created_at) VALUES (?, ?, ?, ?)", rows)
+    conn.close()
+    before = rss_mb()
+    near_duplicate_store._last_sync = 0.0
+    near_duplicate_store._sync()
+    added = near_duplicate_store.stats()["items"] - existing
+    return (rss_mb() - before) * MB / max(1, added)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--analyses", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--users", type=int, default=500, help="Chats distintos (sesiones del agente)")
+    parser.add_argument("--photo-width", type=int, default=1024)
+    parser.add_argument("--index-items", type=int, default=NEAR_DUPLICATE_MAX_ITEMS,
+                        help="Hashes del índice de casi-duplicados lleno (0 = no llenarlo)")
+    parser.add_argument("--host-memory-mb", type=float, default=0, help="Memoria del host para repartir entre workers")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    warm_up()
+    warm = rss_mb()
+    print(f"RSS: intérprete + Django {DJANGO_RSS_MB:.0f} MB, calentado {warm:.0f} MB")
+
+    print(f"\n{args.analyses} análisis (rich), {args.concurrency} en vuelo, {args.users} chats:")
+    print(f"  {'análisis':>9}{'RSS MB':>9}{'sesiones':>10}{'sesiones MB':>13}{'índice':>9}{'blobs':>7}")
+    samples = asyncio.run(_load(args, rng))
+    for sample in samples:
+        print(f"  {sample['analyses']:>9}{sample['rss_mb']:>9.0f}{sample['sessions']:>10}"
+              f"{sample['session_mb']:>13.1f}{sample['index_items']:>9}{sample['blobs']:>7}")
+    half = samples[len(samples) // 2 - 1] if len(samples) > 1 else samples[0]
+    growth = (samples[-1]["rss_mb"] - half["rss_mb"]) / max(1, samples[-1]["analyses"] - half["analyses"]) * 1000
+    print(f"  crecimiento en la segunda mitad: {growth:.1f} MB por 1000 análisis")
+
+    index_mb = 0.0
+    if args.index_items:
+        bytes_per_hash = _fill_index(args.index_items, rng)
+        index_mb = bytes_per_hash * NEAR_DUPLICATE_MAX_ITEMS / MB
+        print(f"\nÍndice de casi-duplicados con {near_duplicate_store.stats()['items']:,} hashes: "
+              f"RSS {rss_mb():.0f} MB ({bytes_per_hash:.0f} B por hash)")
+
+    # Lo que ocupa atender `--concurrency` análisis a la vez (buffers de las
+    # fotos, arenas de malloc de los hilos...), sin las sesiones ya contadas.
+    working = max(0.0, samples[-1]["rss_mb"] - warm - samples[-1]["session_mb"])
+    terms = [
+        ("calentado", warm),
+        (f"análisis en vuelo ({args.concurrency}, medido)", working),
+        ("caché de blobs (BLOB_CACHE_MAX_BYTES)", BLOB_CACHE_MAX_BYTES / MB),
+        ("sesiones (BAYSAFE_SESSION_MEMORY_BUDGET)", SESSION_MEMORY_BUDGET / MB),
+        (f"índice ({NEAR_DUPLICATE_MAX_ITEMS:,} hashes)", index_mb),
+    ]
+    bound = sum(mb for _, mb in terms)
+    print("\nCota por worker con los límites configurados:")
+    for name, mb in terms + [("total", bound)]:
+        print(f"  {name:<44}{mb:>8.0f} MB")
+    if args.host_memory_mb:
+        print(f"  workers que caben en {args.host_memory_mb:.0f} MB: {int(args.host_memory_mb // bound)}")
+
+if __name__ == "__main__":
+    main()
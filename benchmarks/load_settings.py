@@ -0,0 +1,12 @@
+"""
+Settings de Django para benchmarks/bench_load.py.
+
+Son los del proyecto con DEBUG desactivado (como en producción) y las sesiones
+del chat en cookies firmadas, para no depender de una base de datos migrada.
+"""
+
+from mi_proyecto.settings import *  # noqa: F401,F403
+
+DEBUG = False
+ALLOWED_HOSTS = ["*"]
+SESSION_ENGINE = "django.contrib.sessions.backends.signed_cookies"
@@ -1,32 +1,74 @@
-import base64
-import datetime
+import asyncio
+import hashlib
+import json
 import os
-import re
+import time
 import uuid
-import sys
-from typing import List, Optional, Dict, Any
-from zoneinfo import ZoneInfo
+from typing import Any, AsyncIterator, BinaryIO, Dict, List, Optional, Tuple
 
 # Third-party imports
-from django.core.files.uploadedfile import InMemoryUploadedFile
-from google.cloud import aiplatform
-from google.cloud import storage
-from google.protobuf import json_format
-from google.protobuf.struct_pb2 import Value
+from django.core.files.uploadedfile import InMemoryUploadedFile, UploadedFile
 from google.genai import types
 
 # Google ADK imports
 from google.adk.agents import Agent
+from google.adk.agents.run_config import RunConfig, StreamingMode
 from google.adk.runners import Runner
-from google.adk.sessions import InMemorySessionService
+
+from .backends import get_blob_store, get_detector, get_report_model, report_model_name, split_gcs_uri
+from .blob_cache import blob_cache
+from .executor import ensure_loop_lag_monitor, run_blocking
+from .hazards import HAZARD_TABLE_VERSION, build_error_report, build_report, dangerous_labels
+from .ingestion import IngestionError, extension_for, ingest_upload, open_upload, validate_upload
+from .metrics import dec, inc, register_collector
+from .near_duplicates import NEAR_DUPLICATE_ENABLED, distinctive_hash, near_duplicate_store
+from .postprocessing import DETECTION_MIN_CONFIDENCE, DETECTION_NMS_IOU, detection_labels, postprocess_predictions
+from .preprocessing import ARCHIVE_ORIGINALS, PREPROCESS_ENABLED, PREPROCESS_MAX_BYTES, preprocess_image
+from .result_cache import detection_cache, make_cache_key, make_label_set_key, report_cache
+from .sessions import APP_NAME, DETECTIONS_PREFIX, session_registry
+from .tiling import TILING_ENABLED, TILING_SIGNATURE, make_tiles
+from .timing import record_stage, stage_timer
+from .tracing import add_span, annotate, close_span, open_span, span
 
 # --- CONFIGURACIÓN Y CONSTANTES ---
 PROJECT_ID = os.environ.get("GOOGLE_CLOUD_PROJECT")
 LOCATION = os.environ.get("GOOGLE_CLOUD_LOCATION")
 ENDPOINT_ID = os.environ.get("VERTEX_MODEL_ID")
+VERTEX_API_ENDPOINT = "us-central1-aiplatform.googleapis.com"
 AGENT_MODEL = os.environ.get("AGENT_MODEL")
+# Modelo efectivo de los agentes: AGENT_MODEL o el LLM simulado (BAYSAFE_LLM_BACKEND=fake)
+REPORT_MODEL = get_report_model(AGENT_MODEL)
 BUCKET_NAME = os.environ.get("BUCKET_NAME")
 
+# Parámetros de la detección (forman parte de la clave de la caché de resultados)
+CONFIDENCE_THRESHOLD = float(os.environ.get("VERTEX_CONFIDENCE_THRESHOLD", "0.5"))
+MAX_PREDICTIONS = int(os.environ.get("VERTEX_MAX_PREDICTIONS", "5"))
+
+# Modo del informe: "fast" lo genera la tabla de riesgos (sin LLM); "rich" lo
+# redacta el agente. Cada petición puede elegirlo con el campo `modo`.
+REPORT_MODE_FAST = "fast"
+REPORT_MODE_RICH = "rich"
+REPORT_MODE = os.environ.get("BAYSAFE_REPORT_MODE", REPORT_MODE_FAST)
+# Orquestación del modo "rich": "direct" detecta en Python y hace un único turno
+# del LLM con las detecciones en el prompt; "tool" deja que el agente llame a la
+# herramienta (dos turnos del LLM).
+AGENT_PIPELINE_DIRECT = "direct"
+AGENT_PIPELINE_TOOL = "tool"
+AGENT_PIPELINE = os.environ.get("BAYSAFE_AGENT_PIPELINE", AGENT_PIPELINE_DIRECT)
+
+# Imagen adjunta al LLM para verificar las detecciones. A 384 px o menos por
+# lado, Gemini la cobra como un único bloque de 258 tokens. Se omite cuando todas
+# las detecciones superan LLM_IMAGE_SKIP_CONFIDENCE.
+LLM_IMAGE_ENABLED = os.environ.get("BAYSAFE_LLM_IMAGE_ENABLED", "True") == "True"
+LLM_IMAGE_MAX_SIDE = int(os.environ.get("BAYSAFE_LLM_IMAGE_MAX_SIDE", "384"))
+LLM_IMAGE_MAX_BYTES = int(os.environ.get("BAYSAFE_LLM_IMAGE_MAX_BYTES", str(80_000)))
+LLM_IMAGE_SKIP_CONFIDENCE = float(os.environ.get("BAYSAFE_LLM_IMAGE_SKIP_CONFIDENCE", "0.8"))
+
+# Versión del formato de las detecciones guardadas en caché (lista de
+# {"label", "confidence", "box"}, una por objeto tras la NMS); cambiarla ignora
+# las entradas con el formato anterior.
+DETECTION_SCHEMA = 3
+
 VERTEX_ENDPOINT_URI = (
     f"projects/{PROJECT_ID}/locations/{LOCATION}/endpoints/{ENDPOINT_ID}"
 )
@@ -34,15 +76,70 @@ VERTEX_ENDPOINT_URI = (
 
 # --- FUNCIONES DE UTILIDAD (GCS & BASE64) ---
 
-def upload_django_file_to_gcs(
+def build_gcs_blob_path(
         file_obj: InMemoryUploadedFile,
+        destination_folder: str = "uploads"
+) -> str:
+    """
+    Genera la ruta única del blob (uuid + extensión original) para un archivo de Django.
+
+    Args:
+        file_obj: El objeto proveniente de request.FILES['tu_input']
+        destination_folder: Carpeta destino dentro del bucket.
+
+    Returns:
+        str: Ruta relativa al bucket, ej: 'uploads/<uuid>.jpg'.
+    """
+    # file_obj.name suele ser "foto.jpg"
+    _, extension = os.path.splitext(file_obj.name or "")
+    if not extension:
+        extension = ".jpg"  # Fallback
+
+    unique_filename = f"{uuid.uuid4()}{extension}"
+    return f"{destination_folder}/{unique_filename}"
+
+
+def upload_bytes_to_gcs(
+        data: bytes,
+        bucket_name: str,
+        blob_path: str,
+        content_type: Optional[str] = None,
+        project_id: Optional[str] = None
+) -> Optional[str]:
+    """
+    Sube bytes ya leídos al almacenamiento configurado (GCS o el local simulado).
+
+    Args:
+        data: Contenido del archivo.
+        bucket_name: Nombre del bucket en GCS.
+        blob_path: Ruta destino dentro del bucket.
+        content_type: MIME type (ej: "image/jpeg").
+        project_id: ID del proyecto (opcional).
+
+    Returns:
+        str: La URI 'gs://bucket/archivo', o None si falla.
+    """
+    try:
+        # Cliente compartido del worker (sin nuevo handshake por petición)
+        with stage_timer("upload"):
+            gcs_uri = get_blob_store(project_id).upload(bucket_name, blob_path, data, content_type)
+        print(f"Imagen subida exitosamente: {gcs_uri}")
+        return gcs_uri
+
+    except Exception as e:
+        print(f"Error subiendo archivo a GCS: {e}")
+        return None
+
+
+def upload_django_file_to_gcs(
+        file_obj: UploadedFile,
         bucket_name: str,
         destination_folder: str = "uploads",
         project_id: Optional[str] = None
 ) -> Optional[str]:
     """
-    Toma un archivo subido desde Django (InMemoryUploadedFile), lee sus bytes
-    y lo sube directamente a GCS.
+    Toma un archivo subido desde Django (en memoria o temporal en disco) y lo
+    sube a GCS por bloques, sin cargarlo entero en memoria.
 
     Args:
         file_obj: El objeto proveniente de request.FILES['tu_input']
@@ -55,135 +152,267 @@ def upload_django_file_to_gcs(
     """
 
     try:
-        # 1. OBTENER METADATOS DEL ARCHIVO DE DJANGO
-        # file_obj.name suele ser "foto.jpg"
-        original_filename = file_obj.name
-        content_type = file_obj.content_type  # ej: "image/jpeg"
-
-        # Extraer extensión de forma segura (ej: .jpg)
-        _, extension = os.path.splitext(original_filename)
-        if not extension:
-            extension = ".jpg"  # Fallback
-
-        # Quitamos el punto de la extensión para limpieza si es necesario,
-        # aunque para el nombre de archivo solemos querer conservarlo.
-        # Aquí generamos un nombre único: uuid + extensión original
-        unique_filename = f"{uuid.uuid4()}{extension}"
-        blob_path = f"{destination_folder}/{unique_filename}"
-
-        # 2. LEER LOS BYTES
-        # Aseguramos que el puntero del archivo esté al inicio (buena práctica en Django)
-        file_obj.seek(0)
-        file_data = file_obj.read()
-
-        # 3. SUBIDA A GCS
-        # Instanciar cliente
-        storage_client = storage.Client(project=project_id)
-        bucket = storage_client.bucket(bucket_name)
-        blob = bucket.blob(blob_path)
-
-        # Subir bytes directamente (upload_from_string acepta bytes)
-        blob.upload_from_string(
-            data=file_data,
-            content_type=content_type
-        )
+        blob_path = build_gcs_blob_path(file_obj, destination_folder)
+        ingested = ingest_upload(file_obj, bucket_name, blob_path, project_id)
+        print(f"Imagen subida exitosamente: {ingested.gcs_uri}")
+        return ingested.gcs_uri
 
-        # 4. RETORNAR URI
-        gcs_uri = f"gs://{bucket_name}/{blob_path}"
-        print(f"Imagen subida exitosamente: {gcs_uri}")
-        return gcs_uri
+    except IngestionError as e:
+        print(f"Archivo rechazado: {e}")
+        return None
 
     except Exception as e:
-        print(f"Error subiendo archivo Django a GCS: {e}")
+        print(f"Error subiendo archivo a GCS: {e}")
         return None
 
 
+def load_image_bytes(gcs_source: str, project: Optional[str] = None) -> bytes:
+    """
+    Obtiene los bytes de una URI `gs://`.
+
+    Primero consulta la caché local que llena el orquestador (la imagen que se
+    acaba de recibir); si no está, la descarga de GCS de forma transparente.
+    """
+    image_bytes = blob_cache.get(gcs_source)
+    if image_bytes is not None:
+        return image_bytes
+
+    # Si el orquestador la está subiendo todavía, el objeto aún no existe en GCS.
+    if not blob_cache.wait_upload(gcs_source):
+        print(f"Advertencia: la subida de {gcs_source} no terminó a tiempo; se intenta leer de GCS.")
+
+    bucket_name_local, blob_name = split_gcs_uri(gcs_source)
+
+    # Descargar como bytes
+    with stage_timer("download"):
+        return get_blob_store(project).download(bucket_name_local, blob_name)
+
+
+# --- MÉTRICAS DE LAS CACHÉS ---
+
+def _cache_metrics():
+    """Aciertos y fallos de las cachés del worker, leídos de sus propios contadores al exportar."""
+    for cache_name, stats in (
+            ("detections", detection_cache.stats()),
+            ("reports", report_cache.stats()),
+    ):
+        hits = stats["memory_hits"] + stats["disk_hits"]
+        yield "baysafe_cache_requests_total", {"cache": cache_name, "result": "hit"}, hits
+        yield "baysafe_cache_requests_total", {"cache": cache_name, "result": "miss"}, stats["misses"]
+    for cache_name, stats in (("near_duplicates", near_duplicate_store.stats()), ("blobs", blob_cache.stats())):
+        yield "baysafe_cache_requests_total", {"cache": cache_name, "result": "hit"}, stats["hits"]
+        yield "baysafe_cache_requests_total", {"cache": cache_name, "result": "miss"}, stats["misses"]
+
+
+register_collector(_cache_metrics)
+
+
 # --- HERRAMIENTAS (TOOLS) PARA EL AGENTE ---
 
-def predict_image_object_detection_sample(
+class DetectionError(RuntimeError):
+    """La imagen no se pudo obtener o el detector falló: no hay resultado que informar."""
+
+
+# Lo que recibe el agente de su herramienta cuando la detección falla.
+DETECTION_ERROR_RESULT = "Error: no se pudo analizar la imagen"
+
+
+def _detect_objects_sync(
         gcs_source: str,
         project: str = PROJECT_ID,
         endpoint_id: str = ENDPOINT_ID,
         location: str = LOCATION,
-        api_endpoint: str = "us-central1-aiplatform.googleapis.com",
-) -> List[str]:
+        api_endpoint: str = VERTEX_API_ENDPOINT,
+        original: Optional[BinaryIO] = None,
+) -> List[Dict[str, Any]]:
     """
-    Descarga una imagen de GCS, la convierte a Base64 y detecta objetos en Vertex AI.
+    Obtiene una imagen (caché local o GCS) y detecta objetos con el detector
+    configurado (Vertex AI o el simulado).
+
+    Hace llamadas de red bloqueantes: desde corrutinas debe ejecutarse en el pool de I/O.
+
+    Args:
+        original: Lector del original sin preprocesar, si lo hay (el orquestador):
+            con teselas, se recortan de él y no de la copia reducida de `gcs_source`.
+
+    Returns:
+        list: Una detección por objeto tras la NMS, de mayor a menor confianza:
+        `{"label": str, "confidence": float | None, "box": [x_min, y_min, x_max, y_max] | None}`
+        (confianza y caja None si vienen de un casi-duplicado). Una etiqueta puede
+        repetirse si hay varios objetos de esa clase.
+
+    Raises:
+        DetectionError: Si no se pudo obtener la imagen o falló la predicción
+            (una lista vacía significa siempre "ningún objeto").
     """
     print(f"DEBUG: Procesando imagen desde {gcs_source}")
 
-    # --- Paso 1: Descargar de GCS ---
+    # --- Paso 1: Obtener bytes (caché local del orquestador o GCS) ---
     try:
-        if not gcs_source.startswith("gs://"):
-            return ["Error: La URI debe comenzar con gs://"]
-
-        path_parts = gcs_source.replace("gs://", "").split("/", 1)
-        bucket_name_local = path_parts[0]
-        blob_name = path_parts[1]
+        image_bytes = load_image_bytes(gcs_source, project)
 
-        storage_client = storage.Client(project=project)
-        bucket = storage_client.bucket(bucket_name_local)
-        blob = bucket.blob(blob_name)
+    except Exception as e:
+        print(f"Error obteniendo la imagen: {e}")
+        annotate(error=f"Error obteniendo la imagen: {e}")
+        raise DetectionError(f"Error obteniendo la imagen: {e}") from e
+
+    # Las imágenes del chat ya llegan preprocesadas; una URI externa con una foto
+    # a tamaño completo superaría el límite de payload de Vertex AI (las teselas
+    # se recortan de esa foto antes de reducirla).
+    tile_source = original if original is not None else image_bytes
+    if len(image_bytes) > PREPROCESS_MAX_BYTES:
+        prepared = preprocess_image(image_bytes)
+        if prepared is not None:
+            image_bytes = prepared.data
 
-        # Descargar como bytes
-        image_bytes = blob.download_as_bytes()
+    parameters_dict = {
+        "confidence_threshold": CONFIDENCE_THRESHOLD,
+        "max_predictions": MAX_PREDICTIONS,
+    }
 
-        # Convertir a Base64 string (UTF-8) para enviar en JSON
-        encoded_content = base64.b64encode(image_bytes).decode("utf-8")
+    # --- Paso 2: Caché por contenido (misma imagen + mismos parámetros) ---
+    # El backend forma parte de la clave: las detecciones simuladas nunca se
+    # sirven como reales.
+    detector = get_detector(project, endpoint_id, location, api_endpoint)
+    cache_key = make_cache_key(
+        image_bytes, endpoint_id=endpoint_id, schema=DETECTION_SCHEMA, backend=detector.name,
+        min_confidence=DETECTION_MIN_CONFIDENCE, nms_iou=DETECTION_NMS_IOU, tiling=TILING_SIGNATURE,
+        **parameters_dict
+    )
+    cached_detections = detection_cache.get(cache_key)
+    if cached_detections is not None:
+        print(f"DEBUG: Detección servida desde caché ({cache_key[:12]})")
+        annotate(cache="exact")
+        return cached_detections
+
+    # --- Paso 3: Casi-duplicados (misma escena, otra toma o recompresión) ---
+    near_namespace = (
+        f"{detector.name}:{endpoint_id}:{CONFIDENCE_THRESHOLD}:{MAX_PREDICTIONS}:"
+        f"{DETECTION_MIN_CONFIDENCE}:{TILING_SIGNATURE}"
+    )
+    image_hash = None
+    if NEAR_DUPLICATE_ENABLED:
+        try:
+            image_hash = distinctive_hash(image_bytes)
+            if image_hash is None:
+                # Foto oscura, borrosa o lisa: su hash no distingue escenas.
+                annotate(near_duplicate="low_contrast")
+            else:
+                similar_objects = near_duplicate_store.lookup(image_hash, near_namespace)
+                if similar_objects is not None:
+                    # El índice solo guarda etiquetas: la confianza es desconocida.
+                    detections = [{"label": label, "confidence": None, "box": None} for label in similar_objects]
+                    detection_cache.set(cache_key, detections)
+                    annotate(cache="near_duplicate")
+                    return detections
+        except Exception as e:
+            print(f"Error calculando hash perceptual: {e}")
+
+    # --- Paso 4: Predecir (en Vertex AI la instancia se agrupa con las de otros
+    # análisis concurrentes en una sola RPC `predict`; con teselas, todas las de
+    # la imagen van juntas en su propia RPC) ---
+    try:
+        tiles = None
+        if TILING_ENABLED:
+            with span("tiling"):
+                tiles = make_tiles(tile_source)
+        with stage_timer("predict"):
+            if tiles:
+                predictions = detector.predict_batch([tile.data for tile in tiles], parameters_dict)
+            else:
+                predictions = [detector.predict(image_bytes, parameters_dict)]
+
+        # Una detección por objeto: cajas de las teselas en coordenadas de la
+        # imagen, umbral y NMS por clase (y recordarla para peticiones repetidas)
+        with span("postprocess"):
+            found, labels = postprocess_predictions(
+                predictions, regions=[tile.region for tile in tiles] if tiles else None
+            )
+        detections = [detection.as_dict() for detection in found]
+        detection_cache.set(cache_key, detections)
+        if image_hash is not None:
+            near_duplicate_store.add(image_hash, near_namespace, labels)
+        return detections
 
     except Exception as e:
-        print(f"Error descargando de GCS: {e}")
-        return []
+        print(f"Error en la detección ({detector.name}): {e}")
+        annotate(error=f"Error en la detección ({detector.name}): {e}")
+        raise DetectionError(f"Error en la detección ({detector.name}): {e}") from e
 
-    # --- Paso 2: Configurar Cliente Vertex AI ---
-    client_options = {"api_endpoint": api_endpoint}
-    client = aiplatform.gapic.PredictionServiceClient(client_options=client_options)
 
-    # --- Paso 3: Crear Instancia ---
-    instance_dict = {"content": encoded_content}
-    instance_value = Value()
-    json_format.ParseDict(instance_dict, instance_value)
+def _predict_image_object_detection_sync(
+        gcs_source: str,
+        project: str = PROJECT_ID,
+        endpoint_id: str = ENDPOINT_ID,
+        location: str = LOCATION,
+        api_endpoint: str = VERTEX_API_ENDPOINT,
+) -> List[str]:
+    """Lista única de objetos detectados (lo que recibe el agente de su herramienta)."""
+    if not gcs_source.startswith("gs://"):
+        return ["Error: La URI debe comenzar con gs://"]
+    try:
+        detections = _detect_objects_sync(gcs_source, project, endpoint_id, location, api_endpoint)
+    except DetectionError:
+        return [DETECTION_ERROR_RESULT]
+    return detection_labels(detections)
 
-    instances = [instance_value]
 
-    parameters_dict = {
-        "confidence_threshold": 0.5,
-        "max_predictions": 5,
-    }
-    parameters_value = Value()
-    json_format.ParseDict(parameters_dict, parameters_value)
+async def detect_objects(gcs_source: str, original: Optional[BinaryIO] = None) -> List[Dict[str, Any]]:
+    """Detecciones (etiqueta, confianza y caja), sin bloquear el event loop (para el orquestador)."""
+    with span("detect_objects"):
+        return await run_blocking(_detect_objects_sync, gcs_source, original=original)
 
-    endpoint = client.endpoint_path(
-        project=project, location=location, endpoint=endpoint_id
-    )
 
-    # --- Paso 4: Predecir ---
-    try:
-        response = client.predict(
-            endpoint=endpoint, instances=instances, parameters=parameters_value
+async def predict_image_object_detection_sample(
+        gcs_source: str,
+        project: str = PROJECT_ID,
+        endpoint_id: str = ENDPOINT_ID,
+        location: str = LOCATION,
+        api_endpoint: str = VERTEX_API_ENDPOINT,
+) -> List[str]:
+    """
+    Obtiene una imagen (caché local o GCS), la convierte a Base64 y detecta objetos en Vertex AI.
+    """
+    # La descarga, el hash y `client.predict` son bloqueantes: van al pool de I/O
+    # para no detener el event loop que comparten todos los análisis del worker.
+    with span("tool:predict_image_object_detection_sample"):
+        return await run_blocking(
+            _predict_image_object_detection_sync,
+            gcs_source,
+            project,
+            endpoint_id,
+            location,
+            api_endpoint
         )
 
-        predictions = response.predictions
-        objects_detected = list()
-        for prediction in predictions:
-            pred_dict = dict(prediction)
-            min_confidence = 0.4
-            if "displayNames" and "confidences" in pred_dict:
-                for indices in [i for i, x in enumerate(pred_dict["confidences"]) if x > min_confidence]:
-                    objects_detected.append(pred_dict["displayNames"][indices])
 
-        # Retornar lista única de objetos
-        return list(set(objects_detected))
+def needs_visual_check(detections: List[Dict[str, Any]]) -> bool:
+    """
+    True si conviene adjuntar la imagen al LLM: alguna detección tiene confianza
+    baja o desconocida. Sin detecciones no hay nada que verificar.
+    """
+    return LLM_IMAGE_ENABLED and any(
+        detection["confidence"] is None or detection["confidence"] < LLM_IMAGE_SKIP_CONFIDENCE
+        for detection in detections
+    )
 
-    except Exception as e:
-        print(f"Error en Vertex AI Predict: {e}")
-        return []
+
+def build_image_part(image_bytes: bytes) -> Optional[types.Part]:
+    """Imagen reducida a LLM_IMAGE_MAX_SIDE como `types.Part` con bytes en línea."""
+    prepared = preprocess_image(image_bytes, max_side=LLM_IMAGE_MAX_SIDE, max_bytes=LLM_IMAGE_MAX_BYTES)
+    if prepared is None:
+        return None
+    return types.Part.from_bytes(data=prepared.data, mime_type=prepared.content_type)
 
 
 # --- DEFINICIÓN DEL AGENTE ---
 
 # Instrucciones del sistema para el agente
-BAYSAFE_INSTRUCTION = """
+# La lista de objetos peligrosos sale de la tabla de riesgos (core/adk/hazards.py),
+# la misma que usa el modo "fast": ambos modos clasifican igual.
+_DANGEROUS_LABELS = ", ".join(f"'{label}'" for label in dangerous_labels())
+
+BAYSAFE_INSTRUCTION = f"""
     Eres BaySafe, un experto en seguridad infantil automatizado.
 
     TU OBJETIVO: 
@@ -196,9 +425,9 @@ BAYSAFE_INSTRUCTION = """
     1. NUNCA SALUDES, TEN EN CUENTA QUE ESTA YA ES UNA CONVERSACIÓN EN CURSO
     1.  **DETECCIÓN:** Cuando recibas la imagen (base64 o URI), llama INMEDIATAMENTE a tu herramienta `predict_image_object_detection_sample`.
     2.  **ANÁLISIS INTERNO:** Una vez recibas la lista de objetos de la herramienta, clasifícalos mentalmente:
-        * **PELIGROSO:** 'mesa_bordes', 'bateria', 'jarron', 'cadenilla', 'juguete_madera', 'Cojin_Suave', 'tela_colgante'.
+        * **PELIGROSO:** {_DANGEROUS_LABELS}.
         * **SEGURO:** Cualquier otro objeto.
-    3.  **ANÁLISIS CRUZADOS:** Analiza la imagen en la URI de GCS para garantizar que los objetos detectados sí corresponden a los mencionados en la lista de objetos, elimina de la lista aquellos que realmente no están.
+    3.  **ANÁLISIS CRUZADOS:** Si el mensaje trae la imagen adjunta, obsérvala para garantizar que los objetos detectados sí corresponden a los mencionados en la lista de objetos, elimina de la lista aquellos que realmente no están. Si no trae imagen, la detección es de alta confianza: úsala tal cual.
     3.  **RESPUESTA FINAL (OBLIGATORIA):**
         Genera una respuesta de texto natural dirigida al usuario. 
         NO devuelvas solo JSON. Habla con el usuario.
@@ -211,35 +440,184 @@ BAYSAFE_INSTRUCTION = """
     REGLA DE ORO:
     ¡Nunca termines la conversación después de llamar a la herramienta! 
     SIEMPRE debes usar la información que te devuelve la herramienta para escribir tu respuesta final.
+    Si la herramienta devuelve un "Error", responde que no se pudo analizar la imagen y pide
+    que la envíen de nuevo: NUNCA concluyas que la zona es segura.
 """
 
+# Instrucciones del agente de un solo turno: las detecciones ya vienen en el mensaje.
+BAYSAFE_REPORT_INSTRUCTION = f"""
+    Eres BaySafe, un experto en seguridad infantil automatizado.
+
+    TU OBJETIVO: 
+    Generar un informe de seguridad para padres a partir de los objetos que un
+    modelo de visión ya detectó en una imagen.
+
+    CADA MENSAJE TRAE:
+    - La URI de la imagen en GCS.
+    - Una línea "{DETECTIONS_PREFIX} [...]" con la lista de objetos detectados.
+    - A veces, la imagen adjunta (cuando alguna detección es dudosa).
+
+    SIGUE ESTOS PASOS ESTRICTAMENTE:
+    1. NUNCA SALUDES, TEN EN CUENTA QUE ESTA YA ES UNA CONVERSACIÓN EN CURSO
+    2.  **VERIFICACIÓN:** Si la imagen viene adjunta, comprueba que cada objeto detectado aparece realmente en ella y descarta los que no estén.
+    3.  **ANÁLISIS INTERNO:** Clasifica los objetos detectados:
+        * **PELIGROSO:** {_DANGEROUS_LABELS}.
+        * **SEGURO:** Cualquier otro objeto.
+    4.  **RESPUESTA FINAL (OBLIGATORIA):**
+        Genera una respuesta de texto natural dirigida al usuario. 
+        NO devuelvas solo JSON. Habla con el usuario.
+
+        Estructura tu respuesta así:
+        - Un resumen de los objetos detectados.
+        - Para cada objeto detectado, explica en una frase por qué es SEGURO o PELIGROSO.
+        - Una conclusión final sobre si la zona es segura para un bebé.
+"""
+
+# Versión del informe "rich": cambia sola al editar las instrucciones, el modelo
+# o la tabla de riesgos, invalidando los informes cacheados con la anterior.
+REPORT_VERSION = hashlib.sha256(
+    "\n".join([
+        BAYSAFE_INSTRUCTION, BAYSAFE_REPORT_INSTRUCTION, report_model_name(REPORT_MODEL), HAZARD_TABLE_VERSION
+    ]).encode("utf-8")
+).hexdigest()[:16]
+
 baysafe_agent = Agent(
     name="BaySafe_Unified",
-    model=AGENT_MODEL,
+    model=REPORT_MODEL,
     tools=[predict_image_object_detection_sample],
     description="Experto en seguridad infantil que detecta objetos y explica riesgos.",
     instruction=BAYSAFE_INSTRUCTION
 )
 
+baysafe_report_agent = Agent(
+    name="BaySafe_Informe",
+    model=REPORT_MODEL,
+    description="Experto en seguridad infantil que explica los riesgos de objetos ya detectados.",
+    instruction=BAYSAFE_REPORT_INSTRUCTION
+)
+
 
 # --- ORQUESTACIÓN Y EJECUCIÓN (RUNNER) ---
 
-async def call_agent_async(query: str, runner: Runner, user_id: str, session_id: str) -> str:
-    """Envía una consulta al agente y retorna la respuesta final."""
+_runners: Dict[str, Runner] = {}
+
+
+def resolve_agent_pipeline(pipeline: Optional[str] = None) -> str:
+    """Normaliza la orquestación pedida ("direct" o "tool"); si no es válida usa BAYSAFE_AGENT_PIPELINE."""
+    pipeline = (pipeline or AGENT_PIPELINE).strip().lower()
+    return pipeline if pipeline in (AGENT_PIPELINE_DIRECT, AGENT_PIPELINE_TOOL) else AGENT_PIPELINE_DIRECT
+
+
+def get_runner(pipeline: Optional[str] = None) -> Runner:
+    """
+    Runner de larga vida del worker para la orquestación indicada.
+
+    Se construye una sola vez (por orquestación) alrededor de `baysafe_agent` o
+    `baysafe_report_agent` y del servicio de sesiones compartido; cada análisis
+    solo aporta su (user_id, session_id).
+    """
+    pipeline = resolve_agent_pipeline(pipeline)
+    runner = _runners.get(pipeline)
+    if runner is None:
+        runner = _runners[pipeline] = Runner(
+            agent=baysafe_report_agent if pipeline == AGENT_PIPELINE_DIRECT else baysafe_agent,
+            app_name=APP_NAME,
+            session_service=session_registry.session_service
+        )
+    return runner
+
+
+def build_detections_query(uri: str, objects_detected: List[str]) -> str:
+    """Mensaje del turno único: URI de la imagen + detecciones ya calculadas."""
+    return f"Imagen: {uri}\n{DETECTIONS_PREFIX} {json.dumps(sorted(objects_detected), ensure_ascii=False)}"
+
+
+async def stream_agent_events(
+        query: str,
+        runner: Runner,
+        user_id: str,
+        session_id: str,
+        streaming: bool = False,
+        attachments: Optional[List[types.Part]] = None
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Envía una consulta al agente y emite sus etapas a medida que ocurren.
+
+    Args:
+        query: Mensaje para el agente (la URI de la imagen).
+        runner: Runner del ADK.
+        user_id: ID del usuario para la sesión.
+        session_id: ID de la sesión.
+        streaming: Si es True, pide al LLM la respuesta en fragmentos (SSE)
+            y se emiten eventos `texto` con cada fragmento.
+        attachments: Partes adicionales del mensaje (p.ej. la imagen en línea).
+
+    Yields:
+        dict: Eventos con clave `evento`: `herramienta`, `detecciones`,
+        `texto` y, al final, `final` con la respuesta (`completa` es False
+        si el agente no llegó a escribir un informe).
+    """
     print(f"\n>>> User Query: {query}")
 
-    content = types.Content(role='user', parts=[types.Part(text=query)])
+    content = types.Content(role='user', parts=[types.Part(text=query)] + list(attachments or []))
     final_response_text = "Agent did not produce a final response."
-
-    async for event in runner.run_async(user_id=user_id, session_id=session_id, new_message=content):
-        if event.is_final_response():
-            if event.content and event.content.parts:
-                final_response_text = event.content.parts[0].text
-            elif event.actions and event.actions.escalate:
-                final_response_text = f"Agent escalated: {event.error_message or 'No specific message.'}"
-            break
+    completed = False
+    run_config = RunConfig(streaming_mode=StreamingMode.SSE) if streaming else None
+    # Cada turno del LLM va desde el mensaje (o la respuesta de la herramienta)
+    # hasta su llamada a herramienta o su respuesta final. En la traza, cada turno
+    # es un span `llm` y el resto de eventos del ADK un span `adk.event` desde el
+    # evento anterior.
+    with span("stream_agent_events", streaming=streaming):
+        turn_start = last_event = time.perf_counter()
+        chunks = 0
+        async for event in runner.run_async(
+                user_id=user_id, session_id=session_id, new_message=content, run_config=run_config
+        ):
+            if event.partial:
+                chunks += 1
+                if event.content and event.content.parts and event.content.parts[0].text:
+                    yield {"evento": "texto", "parcial": event.content.parts[0].text}
+                continue
+
+            now = time.perf_counter()
+            function_calls = event.get_function_calls()
+            function_responses = event.get_function_responses()
+            if function_calls or event.is_final_response():
+                record_stage("llm", now - turn_start)
+                add_span("llm", turn_start, now, author=event.author, chunks=chunks,
+                         tools=[function_call.name for function_call in function_calls])
+                chunks = 0
+            else:
+                add_span("adk.event", last_event, now, author=event.author,
+                         tools=[function_response.name for function_response in function_responses])
+            last_event = now
+            for function_call in function_calls:
+                yield {"evento": "herramienta", "nombre": function_call.name}
+            for function_response in function_responses:
+                result = (function_response.response or {}).get("result")
+                yield {"evento": "detecciones", "nombre": function_response.name, "objetos": result}
+            if function_responses:
+                turn_start = time.perf_counter()
+
+            if event.is_final_response():
+                if event.content and event.content.parts and event.content.parts[0].text:
+                    final_response_text = event.content.parts[0].text
+                    completed = True
+                elif event.actions and event.actions.escalate:
+                    final_response_text = f"Agent escalated: {event.error_message or 'No specific message.'}"
+                break
 
     print(f"<<< Agent Response: {final_response_text}")
+    yield {"evento": "final", "respuesta": final_response_text, "completa": completed}
+
+
+async def call_agent_async(query: str, runner: Runner, user_id: str, session_id: str) -> str:
+    """Envía una consulta al agente y retorna la respuesta final."""
+    final_response_text = "Agent did not produce a final response."
+    with span("call_agent_async"):
+        async for event in stream_agent_events(query, runner, user_id, session_id):
+            if event["evento"] == "final":
+                final_response_text = event["respuesta"]
     return final_response_text
 
 
@@ -247,10 +625,241 @@ async def call_agent_async(query: str, runner: Runner, user_id: str, session_id:
 
 # --- FUNCIÓN PÚBLICA PARA SER LLAMADA DESDE FUERA ---
 
+def resolve_report_mode(mode: Optional[str] = None) -> str:
+    """Normaliza el modo pedido ("fast" o "rich"); si no es válido usa BAYSAFE_REPORT_MODE."""
+    mode = (mode or REPORT_MODE).strip().lower()
+    return mode if mode in (REPORT_MODE_FAST, REPORT_MODE_RICH) else REPORT_MODE_FAST
+
+
+async def run_safety_analysis_stream(
+        image_file: InMemoryUploadedFile,
+        user_id: str = "default_user",
+        session_id: str = "default_session",
+        ephemeral_session: bool = False,
+        streaming: bool = True,
+        mode: Optional[str] = None,
+        pipeline: Optional[str] = None
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Orquestador principal en modo streaming: emite cada etapa del análisis.
+
+    Args:
+        image_file (InMemoryUploadedFile): Objeto del archivo recibido en request.FILES.
+        user_id (str): ID del usuario para la sesión.
+        session_id (str): ID de la sesión.
+        ephemeral_session (bool): Borra la sesión del agente al terminar.
+        streaming (bool): Emitir el informe del LLM en fragmentos.
+        mode (str): "fast" (informe de la tabla de riesgos, sin LLM) o "rich"
+            (informe del agente). Por defecto BAYSAFE_REPORT_MODE.
+        pipeline (str): En modo "rich", "direct" (un turno del LLM con las
+            detecciones) o "tool" (el agente llama a la herramienta). Por
+            defecto BAYSAFE_AGENT_PIPELINE.
+
+    Yields:
+        dict: `subida` (imagen recibida y URI asignada), los eventos de
+        `stream_agent_events` y siempre un último evento `final`.
+    """
+
+    # 1. Validación básica
+    if not image_file:
+        yield {"evento": "final", "respuesta": "Error: No se recibió un archivo válido."}
+        return
+
+    ensure_loop_lag_monitor()
+
+    report_mode = resolve_report_mode(mode)
+    inc("baysafe_analyses_total", mode=report_mode)
+    inc("baysafe_analyses_in_flight")
+    started = time.perf_counter()
+    # Span que agrupa en la traza todas las etapas de este análisis (en los lotes
+    # comparten traza varios análisis).
+    analysis_span = open_span("run_safety_analysis", mode=report_mode, nombre=getattr(image_file, "name", None))
+
+    uri = None
+    upload_task = None
+    archive_task = None
+    tile_reader = None
+    try:
+        # 2. Validación previa (tamaño declarado y firma real de la imagen; la
+        # cabecera puede leerse de disco, así que va al pool de I/O) y reserva
+        # de la URI de destino en GCS
+        content_type = await run_blocking(validate_upload, image_file)
+        blob_path = build_gcs_blob_path(image_file)
+        blob_stem = os.path.splitext(blob_path)[0]
+
+        # Lector propio para el preprocesado: la ingesta del original recorre
+        # `image_file` en paralelo (un TemporaryUploadedFile se reabre desde disco).
+        reader = await run_blocking(open_upload, image_file)
+        # Con teselas, el detector las recorta del original (con su resolución
+        # completa), no de la copia preprocesada: otro lector independiente.
+        if TILING_ENABLED:
+            tile_reader = await run_blocking(open_upload, image_file)
+
+        # 2b. El original se archiva en una sola pasada por bloques (hash + subida
+        # reanudable a `originales/`), en paralelo con el análisis.
+        if ARCHIVE_ORIGINALS:
+            archive_task = asyncio.create_task(run_blocking(
+                ingest_upload,
+                image_file,
+                BUCKET_NAME,
+                f"originales/{os.path.basename(blob_stem)}{extension_for(content_type)}",
+                PROJECT_ID
+            ))
+
+        # 2c. Preprocesado: orientación EXIF, lado mayor acotado, sin metadatos y
+        # recomprimida. Es la copia que se sube y se envía a Vertex AI.
+        try:
+            with stage_timer("preprocess"):
+                prepared = await run_blocking(preprocess_image, reader) if PREPROCESS_ENABLED else None
+            if prepared is not None:
+                print(f"DEBUG: Imagen preprocesada {prepared.original_bytes} -> {len(prepared.data)} bytes "
+                      f"({prepared.width}x{prepared.height})")
+                image_bytes = prepared.data
+                content_type = prepared.content_type
+                blob_path = f"{blob_stem}{prepared.extension}"
+            else:
+                reader.seek(0)
+                image_bytes = await run_blocking(reader.read)
+        finally:
+            reader.close()
+
+        uri = f"gs://{BUCKET_NAME}/{blob_path}"
+
+        # 3. Handoff local: la herramienta resolverá la URI desde memoria,
+        # así que la subida de archivo a GCS corre en paralelo con la detección.
+        # La entrada queda fijada hasta el `discard` del final; quien lea la URI
+        # sin encontrarla en la caché espera a que termine la subida.
+        blob_cache.upload_started(uri)
+        cached = blob_cache.put(uri, image_bytes)
+        upload_task = asyncio.create_task(run_blocking(
+            upload_bytes_to_gcs,
+            image_bytes,
+            BUCKET_NAME,
+            blob_path,
+            content_type,
+            PROJECT_ID
+        ))
+        upload_task.add_done_callback(lambda _task, finished_uri=uri: blob_cache.upload_finished(finished_uri))
+
+        if not cached:
+            # La caché está llena con los análisis en curso: la herramienta
+            # leerá de GCS, por lo que la subida debe completarse antes.
+            if not await upload_task:
+                yield {"evento": "final", "respuesta": "Error: Falló la subida de la imagen a GCS."}
+                return
+
+        yield {"evento": "subida", "uri": uri}
+
+        # 4. Detección directa: el modo "fast" arma el informe con ella y el
+        # modo "rich" la usa como clave de la caché de informes (cuando el agente
+        # llame a la herramienta, la detección ya estará en su caché).
+        tool_name = predict_image_object_detection_sample.__name__
+        yield {"evento": "herramienta", "nombre": tool_name}
+        try:
+            detections = await detect_objects(uri, original=tile_reader)
+        except DetectionError:
+            # Sin detección no hay veredicto: ni informe "seguro" ni LLM.
+            inc("baysafe_stage_errors_total", stage="detection")
+            yield {"evento": "final", "respuesta": build_error_report()}
+            return
+        finally:
+            if tile_reader is not None:
+                tile_reader.close()
+        objects_detected = detection_labels(detections)
+        for label in objects_detected:
+            inc("baysafe_detected_labels_total", label=label)
+        yield {"evento": "detecciones", "nombre": tool_name, "objetos": objects_detected}
+
+        # 5a. Modo "fast": informe determinista, sin LLM
+        if report_mode == REPORT_MODE_FAST:
+            yield {"evento": "final", "respuesta": build_report(objects_detected)}
+            return
+
+        # 5b. Modo "rich": el mismo conjunto de objetos con el mismo prompt y modelo
+        # produce el mismo informe, así que se sirve de la caché sin llamar al LLM.
+        # Un conjunto dudoso no se cachea: su informe depende de la imagen. (Una
+        # detección fallida ya terminó arriba; aquí un conjunto vacío es "nada".)
+        visual_check = needs_visual_check(detections)
+        cacheable = not visual_check
+        report_key = make_label_set_key(objects_detected, version=REPORT_VERSION)
+        if cacheable:
+            cached_report = await run_blocking(report_cache.get, report_key)
+            if cached_report is not None:
+                print(f"DEBUG: Informe servido desde caché ({report_key[:12]})")
+                yield {"evento": "final", "respuesta": cached_report}
+                return
+
+        # 5c. Ejecutar con el Runner compartido del worker, dentro de la sesión
+        # del chat (se crea la primera vez y se reutiliza en los siguientes turnos).
+        # Un informe cacheable se servirá a otros chats: se genera en una sesión
+        # efímera y sin historial, para que su texto no dependa de esta conversación.
+        # En "direct" el agente recibe las detecciones y responde en un solo turno;
+        # en "tool" recibe solo la URI de GCS y llama él mismo a la herramienta.
+        pipeline = resolve_agent_pipeline(pipeline)
+        if pipeline == AGENT_PIPELINE_DIRECT:
+            query = build_detections_query(uri, objects_detected)
+        else:
+            query = uri
+
+        # Si alguna detección es dudosa, el LLM recibe la imagen reducida en línea
+        # para verificarla (en lugar de una URI que no puede abrir). Al terminar
+        # el turno, la sesión la sustituye por un texto en el historial del chat.
+        attachments = []
+        if visual_check:
+            image_part = await run_blocking(build_image_part, image_bytes)
+            if image_part is not None:
+                attachments.append(image_part)
+        if cacheable:
+            agent_session_id, agent_ephemeral = f"{session_id}-informe-{uuid.uuid4().hex[:8]}", True
+        else:
+            agent_session_id, agent_ephemeral = session_id, ephemeral_session
+        async with session_registry.session(user_id, agent_session_id, agent_ephemeral) as active_session_id:
+            async for event in stream_agent_events(
+                    query=query,
+                    runner=get_runner(pipeline),
+                    user_id=user_id,
+                    session_id=active_session_id,
+                    streaming=streaming,
+                    attachments=attachments
+            ):
+                if event["evento"] == "final" and cacheable and event.get("completa"):
+                    await run_blocking(report_cache.set, report_key, event["respuesta"])
+                yield event
+
+    except IngestionError as e:
+        inc("baysafe_stage_errors_total", stage="ingestion")
+        annotate(error=f"{type(e).__name__}: {e}")
+        yield {"evento": "final", "respuesta": f"Error: {e}"}
+
+    except Exception as e:
+        inc("baysafe_stage_errors_total", stage="analysis")
+        annotate(error=f"{type(e).__name__}: {e}")
+        yield {"evento": "final", "respuesta": f"Error crítico durante la ejecución del agente: {str(e)}"}
+
+    finally:
+        dec("baysafe_analyses_in_flight")
+        record_stage("total", time.perf_counter() - started)
+        if tile_reader is not None:
+            tile_reader.close()
+        if uri:
+            blob_cache.discard(uri)
+        if upload_task is not None and not await upload_task:
+            print(f"Advertencia: no se pudo archivar {uri} en GCS.")
+        if archive_task is not None:
+            try:
+                original = await archive_task
+                print(f"Original archivado: {original.gcs_uri} ({original.size} bytes, sha256 {original.sha256[:12]})")
+            except Exception as e:
+                print(f"Advertencia: no se pudo archivar el original en GCS: {e}")
+        close_span(analysis_span)
+
+
 async def run_safety_analysis(
         image_file: InMemoryUploadedFile,
         user_id: str = "default_user",
-        session_id: str = "default_session"
+        session_id: str = "default_session",
+        ephemeral_session: bool = False,
+        mode: Optional[str] = None
 ) -> str:
     """
     Orquestador principal que recibe un archivo de Django y ejecuta el análisis.
@@ -259,54 +868,67 @@ async def run_safety_analysis(
         image_file (InMemoryUploadedFile): Objeto del archivo recibido en request.FILES.
         user_id (str): ID del usuario para la sesión.
         session_id (str): ID de la sesión.
+        ephemeral_session (bool): Borra la sesión del agente al terminar.
+        mode (str): "fast" (sin LLM) o "rich"; por defecto BAYSAFE_REPORT_MODE.
 
     Returns:
         str: La respuesta final del agente.
     """
+    response_text = "Agent did not produce a final response."
+    async for event in run_safety_analysis_stream(
+            image_file, user_id, session_id, ephemeral_session, streaming=False, mode=mode
+    ):
+        if event["evento"] == "final":
+            response_text = event["respuesta"]
+    return response_text
 
-    # 1. Validación básica
-    if not image_file:
-        return "Error: No se recibió un archivo válido."
 
-    try:
-        # 2. Subir a GCS (Directamente el objeto en memoria)
-        # Nota: Ya no necesitamos convertir a base64 aquí.
-        uri = upload_django_file_to_gcs(
-            file_obj=image_file,
-            bucket_name=BUCKET_NAME,
-            project_id=PROJECT_ID
-        )
+# --- ANÁLISIS POR LOTE ---
 
-        if not uri:
-            return "Error: Falló la subida de la imagen a GCS."
+BULK_CONCURRENCY = int(os.environ.get("BAYSAFE_BULK_CONCURRENCY", "8"))
 
-        # 3. Configurar Sesión
-        session_service = InMemorySessionService()
-        app_name = "agents"
 
-        await session_service.create_session(
-            app_name=app_name,
-            user_id=user_id,
-            session_id=session_id
-        )
-
-        # 4. Configurar Runner
-        runner = Runner(
-            agent=baysafe_agent,
-            app_name=app_name,
-            session_service=session_service
-        )
+async def run_bulk_safety_analysis(
+        image_files: List[InMemoryUploadedFile],
+        user_id: str = "default_user",
+        session_id: str = "default_session",
+        concurrency: int = BULK_CONCURRENCY,
+        mode: Optional[str] = None
+) -> AsyncIterator[Tuple[int, str]]:
+    """
+    Analiza varias imágenes en paralelo (como mucho `concurrency` a la vez).
 
-        # 5. Ejecutar y retornar
-        # El agente recibe la URI de GCS y hace su trabajo
-        response_text = await call_agent_async(
-            query=uri,
-            runner=runner,
-            user_id=user_id,
-            session_id=session_id
-        )
+    Cada imagen usa su propia sesión efímera del agente, derivada de la del
+    chat, para que los informes no se mezclen entre sí.
 
-        return response_text
+    Args:
+        image_files: Archivos a analizar.
+        user_id (str): ID del usuario para la sesión.
+        session_id (str): ID de la sesión del chat.
+        concurrency (int): Análisis simultáneos máximos.
+        mode (str): "fast" (sin LLM) o "rich"; por defecto BAYSAFE_REPORT_MODE.
 
-    except Exception as e:
-        return f"Error crítico durante la ejecución del agente: {str(e)}"
+    Yields:
+        tuple: (índice de la imagen, respuesta del agente) en orden de finalización.
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def analyze(index: int, image_file: InMemoryUploadedFile) -> Tuple[int, str]:
+        async with semaphore:
+            response_text = await run_safety_analysis(
+                image_file=image_file,
+                user_id=user_id,
+                session_id=f"{session_id}-lote-{index}",
+                ephemeral_session=True,
+                mode=mode
+            )
+            return index, response_text
+
+    tasks = [asyncio.create_task(analyze(i, f)) for i, f in enumerate(image_files)]
+    try:
+        for finished in asyncio.as_completed(tasks):
+            yield await finished
+    finally:
+        # Si el cliente se desconecta, no dejamos análisis huérfanos.
+        for task in tasks:
+            task.cancel()
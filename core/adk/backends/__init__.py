@@ -0,0 +1,91 @@
+import os
+import threading
+from typing import Dict, Optional, Tuple, Union
+
+from .base import BlobStore, Detector, split_gcs_uri
+
+
+# --- SELECCIÓN DE BACKENDS ---
+# "gcp" usa Cloud Storage, Vertex AI y Gemini; "fake" usa los dobles en proceso
+# de `fakes.py` (sin red ni credenciales). Se eligen en settings.py
+# (BAYSAFE_STORAGE_BACKEND, BAYSAFE_DETECTOR_BACKEND, BAYSAFE_LLM_BACKEND) o, fuera
+# de Django (benchmarks), con variables de entorno del mismo nombre.
+BACKEND_GCP = "gcp"
+BACKEND_FAKE = "fake"
+
+_lock = threading.Lock()
+_instances: Dict[Tuple, object] = {}
+
+
+def _setting(name: str) -> str:
+    value = None
+    if os.environ.get("DJANGO_SETTINGS_MODULE"):
+        from django.conf import settings
+        value = getattr(settings, name, None)
+    if value is None:
+        value = os.environ.get(name) or os.environ.get("BAYSAFE_BACKENDS", BACKEND_GCP)
+    value = str(value).strip().lower()
+    return value if value in (BACKEND_GCP, BACKEND_FAKE) else BACKEND_GCP
+
+
+def _shared(key: Tuple, factory):
+    """Una instancia por clave y proceso (los dobles guardan estado: semilla, latencias)."""
+    instance = _instances.get(key)
+    if instance is None:
+        with _lock:
+            instance = _instances.get(key)
+            if instance is None:
+                instance = _instances[key] = factory()
+    return instance
+
+
+def storage_backend() -> str:
+    return _setting("BAYSAFE_STORAGE_BACKEND")
+
+
+def detector_backend() -> str:
+    return _setting("BAYSAFE_DETECTOR_BACKEND")
+
+
+def llm_backend() -> str:
+    return _setting("BAYSAFE_LLM_BACKEND")
+
+
+def get_blob_store(project: Optional[str] = None) -> BlobStore:
+    """Almacenamiento de imágenes configurado (GCS o directorio local)."""
+    if storage_backend() == BACKEND_FAKE:
+        from .fakes import LocalBlobStore
+        return _shared(("storage", BACKEND_FAKE), LocalBlobStore)
+
+    from .gcp import GcsBlobStore
+    return _shared(("storage", BACKEND_GCP, project), lambda: GcsBlobStore(project))
+
+
+def get_detector(project: str, endpoint_id: str, location: str, api_endpoint: str) -> Detector:
+    """Detector de objetos configurado (endpoint de Vertex AI o determinista local)."""
+    if detector_backend() == BACKEND_FAKE:
+        from .fakes import FakeDetector
+        return _shared(("detector", BACKEND_FAKE), FakeDetector)
+
+    from .gcp import VertexDetector
+    return _shared(
+        ("detector", BACKEND_GCP, project, endpoint_id, location, api_endpoint),
+        lambda: VertexDetector(project, endpoint_id, location, api_endpoint),
+    )
+
+
+def get_report_model(model_name: Optional[str]):
+    """
+    Modelo de los agentes del informe: el nombre del modelo de Gemini o, con el
+    backend "fake", un `CannedLlm` del ADK.
+    """
+    if llm_backend() == BACKEND_FAKE:
+        from .fakes import CannedLlm
+        return _shared(("llm", BACKEND_FAKE), CannedLlm)
+    return model_name
+
+
+def report_model_name(model: Union[str, object, None]) -> str:
+    """Nombre del modelo (forma parte de la versión de los informes cacheados)."""
+    return str(getattr(model, "model", model))
+
@@ -0,0 +1,70 @@
+from abc import ABC, abstractmethod
+from typing import Any, Dict, List, Optional, Tuple
+
+
+def split_gcs_uri(uri: str) -> Tuple[str, str]:
+    """Separa una URI `gs://bucket/ruta` en (bucket, ruta)."""
+    bucket_name, _, blob_path = uri.replace("gs://", "", 1).partition("/")
+    return bucket_name, blob_path
+
+
+class BlobStore(ABC):
+    """
+    Almacenamiento de las imágenes, direccionado por (bucket, ruta).
+
+    Todas las implementaciones se exponen con URIs `gs://bucket/ruta`, así que
+    el resto del pipeline no sabe qué backend hay detrás.
+    """
+
+    name = "base"
+
+    @abstractmethod
+    def upload(self, bucket_name: str, blob_path: str, data: bytes, content_type: Optional[str] = None) -> str:
+        """Sube bytes ya leídos y retorna la URI `gs://`."""
+
+    @abstractmethod
+    def open_writer(self, bucket_name: str, blob_path: str, content_type: str, chunk_size: int):
+        """
+        Abre una escritura por bloques.
+
+        Returns:
+            Objeto con `write(bytes)`, `close()` (confirma el objeto) y
+            `terminate()` (lo descarta sin dejar nada a medias).
+        """
+
+    @abstractmethod
+    def download(self, bucket_name: str, blob_path: str) -> bytes:
+        """Descarga el objeto completo."""
+
+    def warm_up(self, timeout: float) -> None:
+        """Crea por adelantado clientes y conexiones (calentamiento del worker)."""
+
+
+class Detector(ABC):
+    """Detector de objetos sobre los bytes de una imagen (bloqueante)."""
+
+    name = "base"
+
+    @abstractmethod
+    def predict(self, image_bytes: bytes, parameters: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Predicción en el formato de AutoML de Vertex AI.
+
+        Args:
+            image_bytes: Imagen (ya preprocesada).
+            parameters: `confidence_threshold` y `max_predictions`.
+
+        Returns:
+            dict: `displayNames`, `confidences` y `bboxes`
+            ([xMin, xMax, yMin, yMax] normalizados), alineados por índice.
+        """
+
+    def predict_batch(self, images: List[bytes], parameters: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """
+        Varias imágenes (p.ej. las teselas de una foto) en una sola llamada al
+        detector; una predicción por imagen, en el mismo orden.
+        """
+        return [self.predict(image_bytes, parameters) for image_bytes in images]
+
+    def warm_up(self, timeout: float) -> None:
+        """Crea por adelantado clientes y conexiones (calentamiento del worker)."""
@@ -0,0 +1,265 @@
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+import uuid
+from typing import Any, AsyncGenerator, Dict, List, Optional
+
+# Third-party imports
+from google.adk.models.base_llm import BaseLlm
+from google.adk.models.llm_request import LlmRequest
+from google.adk.models.llm_response import LlmResponse
+from google.genai import types
+
+from ..hazards import HAZARDS, build_error_report, build_report
+from ..sessions import DETECTIONS_PREFIX
+from .base import BlobStore, Detector
+
+
+# --- CONFIGURACIÓN ---
+# Backends en proceso y sin red, para pruebas de carga y perfilado sin GCP.
+FAKE_STORAGE_DIR = os.environ.get(
+    "BAYSAFE_FAKE_STORAGE_DIR", os.path.join(tempfile.gettempdir(), "baysafe_fake_gcs")
+)
+FAKE_STORAGE_LATENCY_MS = float(os.environ.get("BAYSAFE_FAKE_STORAGE_LATENCY_MS", "0"))
+# Latencia del detector: media ± jitter uniforme (ms).
+FAKE_DETECTOR_LATENCY_MS = float(os.environ.get("BAYSAFE_FAKE_DETECTOR_LATENCY_MS", "150"))
+FAKE_DETECTOR_JITTER_MS = float(os.environ.get("BAYSAFE_FAKE_DETECTOR_JITTER_MS", "0"))
+# Latencia extra por cada instancia adicional de una misma llamada (teselas).
+FAKE_DETECTOR_INSTANCE_MS = float(os.environ.get("BAYSAFE_FAKE_DETECTOR_INSTANCE_MS", "0"))
+# Fracción de predicciones que fallan (0.0 a 1.0).
+FAKE_DETECTOR_ERROR_RATE = float(os.environ.get("BAYSAFE_FAKE_DETECTOR_ERROR_RATE", "0"))
+# Vocabulario del detector: las etiquetas de la tabla de riesgos y algunas seguras.
+FAKE_DETECTOR_LABELS = [
+    label.strip() for label in os.environ.get(
+        "BAYSAFE_FAKE_DETECTOR_LABELS", ",".join(list(HAZARDS) + ["silla", "sofa", "planta", "lampara"])
+    ).split(",") if label.strip()
+]
+# Latencia total del LLM simulado; en streaming, la mitad es el primer fragmento.
+FAKE_LLM_LATENCY_MS = float(os.environ.get("BAYSAFE_FAKE_LLM_LATENCY_MS", "400"))
+# Semilla del jitter y de la inyección de errores (ejecuciones reproducibles).
+FAKE_SEED = int(os.environ.get("BAYSAFE_FAKE_SEED", "0"))
+
+
+class FakeBackendError(RuntimeError):
+    """Error inyectado por un backend simulado."""
+
+
+def _sleep_ms(milliseconds: float) -> None:
+    if milliseconds > 0:
+        time.sleep(milliseconds / 1000.0)
+
+
+# --- ALMACENAMIENTO EN DISCO LOCAL ---
+
+class _LocalBlobWriter:
+    """Escritura por bloques a un archivo temporal que se renombra al cerrar."""
+
+    def __init__(self, final_path: str):
+        self.final_path = final_path
+        self.temp_path = f"{final_path}.{uuid.uuid4().hex}.part"
+        self._file = open(self.temp_path, "wb")
+
+    def write(self, data: bytes) -> int:
+        return self._file.write(data)
+
+    def close(self) -> None:
+        self._file.close()
+        os.replace(self.temp_path, self.final_path)
+
+    def terminate(self) -> None:
+        self._file.close()
+        try:
+            os.remove(self.temp_path)
+        except FileNotFoundError:
+            pass
+
+
+class LocalBlobStore(BlobStore):
+    """
+    Almacenamiento en un directorio local: `gs://bucket/ruta` se guarda en
+    `<root>/bucket/ruta`. Las escrituras son atómicas (archivo temporal + rename).
+    """
+
+    name = "local"
+
+    def __init__(self, root: str = FAKE_STORAGE_DIR, latency_ms: float = FAKE_STORAGE_LATENCY_MS):
+        self.root = root
+        self.latency_ms = latency_ms
+
+    def _path(self, bucket_name: str, blob_path: str) -> str:
+        path = os.path.realpath(os.path.join(self.root, bucket_name or "_", blob_path))
+        if not path.startswith(os.path.realpath(self.root) + os.sep):
+            raise ValueError(f"Ruta fuera del almacenamiento local: {blob_path}")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def upload(self, bucket_name: str, blob_path: str, data: bytes, content_type: Optional[str] = None) -> str:
+        _sleep_ms(self.latency_ms)
+        writer = _LocalBlobWriter(self._path(bucket_name, blob_path))
+        try:
+            writer.write(data)
+        except BaseException:
+            writer.terminate()
+            raise
+        writer.close()
+        return f"gs://{bucket_name}/{blob_path}"
+
+    def open_writer(self, bucket_name: str, blob_path: str, content_type: str, chunk_size: int):
+        _sleep_ms(self.latency_ms)
+        return _LocalBlobWriter(self._path(bucket_name, blob_path))
+
+    def download(self, bucket_name: str, blob_path: str) -> bytes:
+        _sleep_ms(self.latency_ms)
+        with open(self._path(bucket_name, blob_path), "rb") as blob_file:
+            return blob_file.read()
+
+
+# --- DETECTOR DETERMINISTA ---
+
+class FakeDetector(Detector):
+    """
+    Detector sin red: las detecciones salen del SHA-256 de la imagen (la misma
+    imagen produce siempre las mismas), con latencia y errores configurables.
+
+    El jitter y los errores usan un generador con semilla, así que una misma
+    secuencia de peticiones se reproduce exactamente.
+    """
+
+    name = "fake"
+
+    def __init__(
+            self,
+            latency_ms: float = FAKE_DETECTOR_LATENCY_MS,
+            jitter_ms: float = FAKE_DETECTOR_JITTER_MS,
+            instance_ms: float = FAKE_DETECTOR_INSTANCE_MS,
+            error_rate: float = FAKE_DETECTOR_ERROR_RATE,
+            labels: Optional[List[str]] = None,
+            seed: int = FAKE_SEED
+    ):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.instance_ms = instance_ms
+        self.error_rate = error_rate
+        self.labels = labels or FAKE_DETECTOR_LABELS
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _call(self, instances: int) -> None:
+        # Una llamada simulada: latencia (más el coste de cada instancia extra) y error.
+        with self._lock:
+            delay = self.latency_ms + self._random.uniform(-self.jitter_ms, self.jitter_ms)
+            fail = self._random.random() < self.error_rate
+        _sleep_ms(delay + self.instance_ms * (instances - 1))
+        if fail:
+            raise FakeBackendError("Error inyectado por el detector simulado")
+
+    def predict(self, image_bytes: bytes, parameters: Dict[str, Any]) -> Dict[str, Any]:
+        self._call(1)
+        return self._detections(image_bytes, parameters)
+
+    def predict_batch(self, images: List[bytes], parameters: Dict[str, Any]) -> List[Dict[str, Any]]:
+        self._call(len(images))
+        return [self._detections(image_bytes, parameters) for image_bytes in images]
+
+    def _detections(self, image_bytes: bytes, parameters: Dict[str, Any]) -> Dict[str, Any]:
+        digest = hashlib.sha256(image_bytes).digest()
+        max_predictions = int(parameters.get("max_predictions", 5))
+        threshold = float(parameters.get("confidence_threshold", 0.0))
+
+        names, confidences, bboxes = [], [], []
+        for i in range(1 + digest[0] % 4):
+            block = digest[1 + i * 7: 8 + i * 7]
+            confidence = round(0.3 + block[1] / 255 * 0.69, 4)
+            if confidence < threshold:
+                continue
+            x_min, y_min = block[2] / 255 * 0.7, block[3] / 255 * 0.7
+            names.append(self.labels[block[0] % len(self.labels)])
+            confidences.append(confidence)
+            bboxes.append([
+                round(x_min, 4), round(x_min + 0.1 + block[4] / 255 * 0.2, 4),
+                round(y_min, 4), round(y_min + 0.1 + block[5] / 255 * 0.2, 4),
+            ])
+
+        order = sorted(range(len(names)), key=lambda k: -confidences[k])[:max_predictions]
+        return {
+            "displayNames": [names[k] for k in order],
+            "confidences": [confidences[k] for k in order],
+            "bboxes": [bboxes[k] for k in order],
+        }
+
+
+# --- LLM CON RESPUESTAS PREDEFINIDAS ---
+
+_URI_PATTERN = re.compile(r"gs://\S+")
+
+
+def _last_labels(llm_request: LlmRequest) -> Optional[List[str]]:
+    """
+    Objetos del turno en curso: respuesta de la herramienta o línea de detecciones.
+    None si la herramienta informó de un error (no hay nada que clasificar).
+    """
+    for content in reversed(llm_request.contents):
+        for part in content.parts or []:
+            if part.function_response is not None:
+                result = (part.function_response.response or {}).get("result") or []
+                if any(str(label).startswith("Error") for label in result):
+                    return None
+                return list(result)
+            if part.text and DETECTIONS_PREFIX in part.text:
+                line = part.text.split(DETECTIONS_PREFIX, 1)[1].splitlines()[0]
+                try:
+                    return list(json.loads(line))
+                except ValueError:
+                    return []
+    return []
+
+
+class CannedLlm(BaseLlm):
+    """
+    Modelo del ADK sin red: responde con el informe de la tabla de riesgos
+    tras una latencia fija.
+
+    Si el agente tiene herramientas y el turno aún no trae su respuesta, primero
+    pide la herramienta con la URI del mensaje (como hace Gemini en "tool").
+    """
+
+    model: str = "baysafe-canned-llm"
+    latency_ms: float = FAKE_LLM_LATENCY_MS
+
+    async def generate_content_async(
+            self, llm_request: LlmRequest, stream: bool = False
+    ) -> AsyncGenerator[LlmResponse, None]:
+        last_parts = (llm_request.contents[-1].parts or []) if llm_request.contents else []
+        answered = any(part.function_response is not None for part in last_parts)
+
+        if llm_request.tools_dict and not answered:
+            await asyncio.sleep(self.latency_ms / 2000.0)
+            text = " ".join(part.text for part in last_parts if part.text)
+            match = _URI_PATTERN.search(text)
+            function_call = types.FunctionCall(
+                name=next(iter(llm_request.tools_dict)),
+                args={"gcs_source": match.group(0) if match else ""},
+            )
+            yield LlmResponse(content=types.Content(role="model", parts=[types.Part(function_call=function_call)]))
+            return
+
+        labels = _last_labels(llm_request)
+        report = build_report(labels) if labels is not None else build_error_report()
+        if not stream:
+            await asyncio.sleep(self.latency_ms / 1000.0)
+            yield LlmResponse(content=types.Content(role="model", parts=[types.Part(text=report)]))
+            return
+
+        # Streaming: primer fragmento a mitad de la latencia y el resto repartido por líneas.
+        chunks = [line + "\n" for line in report.split("\n")]
+        await asyncio.sleep(self.latency_ms / 2000.0)
+        for chunk in chunks:
+            yield LlmResponse(content=types.Content(role="model", parts=[types.Part(text=chunk)]), partial=True)
+            await asyncio.sleep(self.latency_ms / 2000.0 / len(chunks))
+        yield LlmResponse(content=types.Content(role="model", parts=[types.Part(text=report)]))
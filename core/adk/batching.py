@@ -0,0 +1,270 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Any, Dict, List, Optional, Tuple
+
+# Third-party imports
+from google.protobuf import json_format
+from google.protobuf.struct_pb2 import Value
+
+from .metrics import register_collector
+
+
+# --- CONFIGURACIÓN ---
+# Instancias máximas por llamada a `predict` (1 desactiva el agrupamiento).
+BATCH_MAX_SIZE = int(os.environ.get("VERTEX_BATCH_MAX_SIZE", "8"))
+# Tiempo máximo que una instancia espera a que se llene su lote.
+BATCH_MAX_WAIT_MS = float(os.environ.get("VERTEX_BATCH_MAX_WAIT_MS", "10"))
+# Límite de payload de la predicción online de Vertex AI (1.5 MB por petición).
+BATCH_MAX_PAYLOAD_BYTES = int(os.environ.get("VERTEX_BATCH_MAX_PAYLOAD_BYTES", str(1_500_000)))
+# Hilos propios para emitir los `predict` agrupados. Son independientes del pool
+# de I/O: los llamadores bloqueados esperando su resultado viven en ese pool.
+BATCH_DISPATCH_THREADS = int(os.environ.get("VERTEX_BATCH_DISPATCH_THREADS", "16"))
+# Plazo de cada RPC `predict` (segundos). Quien espera su predicción se rinde
+# tras ese plazo más la espera del lote y un margen: un predict colgado falla
+# las instancias de su lote en lugar de bloquear sus hilos indefinidamente.
+BATCH_PREDICT_TIMEOUT_S = float(os.environ.get("VERTEX_PREDICT_TIMEOUT_S", "30"))
+BATCH_RESULT_GRACE_S = 2.0
+
+
+class _Pending:
+    """Instancia en espera de ser enviada dentro de un lote."""
+
+    __slots__ = ("instance", "size", "future")
+
+    def __init__(self, instance: Value, size: int):
+        self.instance = instance
+        self.size = size
+        self.future: Future = Future()
+
+
+class _Group:
+    """Lote en construcción para un mismo (cliente, endpoint, parámetros)."""
+
+    __slots__ = ("client", "endpoint", "parameters", "items", "size", "deadline")
+
+    def __init__(self, client: Any, endpoint: str, parameters: Value, deadline: float):
+        self.client = client
+        self.endpoint = endpoint
+        self.parameters = parameters
+        self.items: List[_Pending] = []
+        self.size = 0
+        self.deadline = deadline
+
+
+class PredictBatcher:
+    """
+    Agrupa instancias de análisis concurrentes en una sola llamada `predict`.
+
+    Cada llamador entrega su instancia y recibe un Future con *su* predicción.
+    Un lote se envía cuando alcanza `max_batch_size` instancias, cuando la
+    siguiente instancia superaría `max_payload_bytes` o cuando la primera lleva
+    `max_wait_ms` esperando. Cada RPC tiene un plazo de `predict_timeout`
+    segundos; su error (o el vencimiento) se reparte a todas sus instancias.
+    """
+
+    def __init__(
+            self,
+            max_batch_size: int = BATCH_MAX_SIZE,
+            max_wait_ms: float = BATCH_MAX_WAIT_MS,
+            max_payload_bytes: int = BATCH_MAX_PAYLOAD_BYTES,
+            dispatch_threads: int = BATCH_DISPATCH_THREADS,
+            predict_timeout: float = BATCH_PREDICT_TIMEOUT_S
+    ):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.max_payload_bytes = max_payload_bytes
+        self.dispatch_threads = dispatch_threads
+        self.predict_timeout = predict_timeout
+
+        self._groups: Dict[Tuple[int, str, str], _Group] = {}
+        self._stats: Dict[str, int] = {"instances": 0, "rpcs": 0, "errors": 0, "timeouts": 0}
+        self._init_runtime()
+
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._init_runtime)
+
+    def _init_runtime(self) -> None:
+        # Hilos y locks no sobreviven al fork: se recrean (perezosamente) en el hijo.
+        self._cond = threading.Condition()
+        self._groups = {}
+        self._dispatcher: Optional[threading.Thread] = None
+        self._pool: Optional[ThreadPoolExecutor] = None
+
+    def _ensure_started(self) -> None:
+        if self._dispatcher is None or not self._dispatcher.is_alive():
+            self._pool = ThreadPoolExecutor(
+                max_workers=self.dispatch_threads, thread_name_prefix="baysafe-predict"
+            )
+            self._dispatcher = threading.Thread(
+                target=self._dispatch_loop, name="baysafe-batcher", daemon=True
+            )
+            self._dispatcher.start()
+
+    def submit(
+            self,
+            client: Any,
+            endpoint: str,
+            instance: Value,
+            parameters: Dict[str, Any],
+            size: int
+    ) -> Future:
+        """
+        Encola una instancia para predicción.
+
+        Args:
+            client: PredictionServiceClient a usar.
+            endpoint: Ruta completa del endpoint.
+            instance: Instancia ya convertida a `Value`.
+            parameters: Parámetros de predicción (deben coincidir para agruparse).
+            size: Tamaño aproximado de la instancia en bytes (base64).
+
+        Returns:
+            Future: Se resuelve con la predicción de esta instancia (esperarla
+            con `result()`, que aplica el plazo).
+        """
+        self._stats["instances"] += 1
+        item = _Pending(instance, size)
+        params_json = json.dumps(parameters, sort_keys=True)
+
+        if self.max_batch_size <= 1:
+            self._send(client, endpoint, _parse_parameters(parameters), [item])
+            return item.future
+
+        key = (id(client), endpoint, params_json)
+        ready: List[_Group] = []
+        with self._cond:
+            self._ensure_started()
+            group = self._groups.get(key)
+            if group is not None and group.size + size > self.max_payload_bytes:
+                # No cabe en el lote actual: se envía ya y empezamos uno nuevo.
+                ready.append(self._groups.pop(key))
+                group = None
+            if group is None:
+                group = self._groups[key] = _Group(
+                    client, endpoint, _parse_parameters(parameters), time.monotonic() + self.max_wait
+                )
+                self._cond.notify()
+            group.items.append(item)
+            group.size += size
+            if len(group.items) >= self.max_batch_size:
+                ready.append(self._groups.pop(key))
+
+        for full_group in ready:
+            self._pool.submit(self._send, full_group.client, full_group.endpoint, full_group.parameters, full_group.items)
+        return item.future
+
+    def predict_all(
+            self,
+            client: Any,
+            endpoint: str,
+            instances: List[Value],
+            parameters: Dict[str, Any]
+    ) -> List[Any]:
+        """
+        Envía ya, en una sola RPC y sin mezclarlas con otros análisis, varias
+        instancias de una misma imagen (p.ej. sus teselas). Bloqueante.
+
+        Returns:
+            list: Una predicción por instancia, en el mismo orden.
+        """
+        self._stats["instances"] += len(instances)
+        items = [_Pending(instance, 0) for instance in instances]
+        self._send(client, endpoint, _parse_parameters(parameters), items)
+        return [self.result(item.future) for item in items]
+
+    def result(self, future: Future) -> Any:
+        """
+        Espera la predicción de un Future de `submit`: como mucho el plazo de la
+        RPC más la espera del lote y un margen.
+
+        Raises:
+            TimeoutError: Si no llegó a tiempo (el Future queda cancelado).
+            Exception: El error de la RPC de su lote.
+        """
+        try:
+            return future.result(timeout=self.predict_timeout + self.max_wait + BATCH_RESULT_GRACE_S)
+        except FutureTimeoutError:
+            if not future.cancel():
+                # Se resolvió justo ahora.
+                return future.result()
+            self._stats["timeouts"] += 1
+            raise TimeoutError(f"La predicción no respondió en {self.predict_timeout:.0f} s") from None
+
+    def _dispatch_loop(self) -> None:
+        while True:
+            with self._cond:
+                while not self._groups:
+                    self._cond.wait()
+                now = time.monotonic()
+                expired = [key for key, group in self._groups.items() if group.deadline <= now]
+                if not expired:
+                    next_deadline = min(group.deadline for group in self._groups.values())
+                    self._cond.wait(timeout=next_deadline - now)
+                    continue
+                groups = [self._groups.pop(key) for key in expired]
+
+            for group in groups:
+                self._pool.submit(self._send, group.client, group.endpoint, group.parameters, group.items)
+
+    def _send(self, client: Any, endpoint: str, parameters: Value, items: List[_Pending]) -> None:
+        """Una sola RPC para todo el lote; reparte cada predicción a su llamador."""
+        self._stats["rpcs"] += 1
+        try:
+            response = client.predict(
+                endpoint=endpoint,
+                instances=[item.instance for item in items],
+                parameters=parameters,
+                timeout=self.predict_timeout,
+            )
+            predictions = list(response.predictions)
+            if len(predictions) != len(items):
+                raise RuntimeError(
+                    f"Vertex devolvió {len(predictions)} predicciones para {len(items)} instancias"
+                )
+        except Exception as e:
+            self._stats["errors"] += 1
+            for item in items:
+                _resolve(item.future.set_exception, e)
+            return
+
+        for item, prediction in zip(items, predictions):
+            _resolve(item.future.set_result, prediction)
+
+    def stats(self) -> Dict[str, float]:
+        """Instancias, RPCs emitidas (y fallidas o vencidas) y tamaño medio de lote del worker."""
+        stats: Dict[str, float] = dict(self._stats)
+        stats["mean_batch_size"] = stats["instances"] / stats["rpcs"] if stats["rpcs"] else 0.0
+        return stats
+
+
+def _resolve(setter, value: Any) -> None:
+    # El llamador pudo rendirse por plazo (Future cancelado): la respuesta tardía se descarta.
+    try:
+        setter(value)
+    except InvalidStateError:
+        pass
+
+
+def _parse_parameters(parameters: Dict[str, Any]) -> Value:
+    parameters_value = Value()
+    json_format.ParseDict(parameters, parameters_value)
+    return parameters_value
+
+
+predict_batcher = PredictBatcher()
+
+
+def _batcher_metrics():
+    """Contadores del agrupador de `predict` del worker, leídos al exportar."""
+    stats = predict_batcher.stats()
+    yield "baysafe_predict_instances_total", {}, stats["instances"]
+    yield "baysafe_predict_rpcs_total", {}, stats["rpcs"]
+    yield "baysafe_predict_failures_total", {"reason": "error"}, stats["errors"]
+    yield "baysafe_predict_failures_total", {"reason": "timeout"}, stats["timeouts"]
+
+
+register_collector(_batcher_metrics)
@@ -0,0 +1,110 @@
+import os
+import threading
+from typing import Dict, Optional
+
+
+# --- CACHÉ LOCAL DE BYTES (HANDOFF ORQUESTADOR -> HERRAMIENTA) ---
+# El orquestador ya tiene los bytes de la imagen en memoria cuando genera la
+# URI `gs://`. Los dejamos aquí para que la herramienta de detección no tenga
+# que descargarlos de nuevo desde GCS.
+
+BLOB_CACHE_MAX_BYTES = int(os.environ.get("BLOB_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+BLOB_CACHE_MAX_ITEMS = int(os.environ.get("BLOB_CACHE_MAX_ITEMS", "64"))
+# Espera máxima (segundos) de una lectura a que termine la subida en curso de su URI.
+BLOB_UPLOAD_WAIT_SECONDS = float(os.environ.get("BLOB_UPLOAD_WAIT_SECONDS", "60"))
+
+
+class BlobCache:
+    """
+    Registro de bytes acotado por tamaño total y número de entradas.
+
+    Las entradas son de corta vida: el orquestador las registra al iniciar el
+    análisis y las libera al terminar. Mientras tanto quedan fijadas (nunca se
+    expulsan): la subida a GCS corre en paralelo y el objeto aún puede no
+    existir. Si la caché está llena, la nueva entrada se rechaza y ese análisis
+    espera a su subida antes de detectar.
+
+    También registra las subidas en curso: una lectura que no encuentra los
+    bytes espera a que termine la subida de su URI antes de ir a GCS.
+    """
+
+    def __init__(self, max_bytes: int = BLOB_CACHE_MAX_BYTES, max_items: int = BLOB_CACHE_MAX_ITEMS):
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self._entries: Dict[str, bytes] = {}
+        self._uploads: Dict[str, threading.Event] = {}
+        self._size = 0
+        self._lock = threading.Lock()
+        self._stats: Dict[str, int] = {"hits": 0, "misses": 0, "rejected": 0}
+
+    def put(self, uri: str, data: bytes) -> bool:
+        """
+        Registra (y fija hasta `discard`) los bytes asociados a `uri`.
+
+        Returns:
+            bool: False si no caben junto a las entradas de los análisis en curso.
+        """
+        size = len(data)
+        with self._lock:
+            previous = self._entries.pop(uri, None)
+            if previous is not None:
+                self._size -= len(previous)
+            if self._size + size > self.max_bytes or len(self._entries) >= self.max_items:
+                self._stats["rejected"] += 1
+                return False
+            self._entries[uri] = data
+            self._size += size
+        return True
+
+    def get(self, uri: str) -> Optional[bytes]:
+        """Retorna los bytes de `uri` o None si no están en la caché."""
+        with self._lock:
+            data = self._entries.get(uri)
+            if data is None:
+                self._stats["misses"] += 1
+                return None
+            self._stats["hits"] += 1
+            return data
+
+    def discard(self, uri: str) -> None:
+        """Libera la entrada de `uri` (fin del análisis)."""
+        with self._lock:
+            data = self._entries.pop(uri, None)
+            if data is not None:
+                self._size -= len(data)
+
+    # --- Subidas en curso ---
+
+    def upload_started(self, uri: str) -> None:
+        """Marca que la subida de `uri` a GCS está en curso."""
+        with self._lock:
+            self._uploads[uri] = threading.Event()
+
+    def upload_finished(self, uri: str) -> None:
+        """La subida de `uri` terminó (con éxito o no): despierta a quien la espere."""
+        with self._lock:
+            event = self._uploads.pop(uri, None)
+        if event is not None:
+            event.set()
+
+    def wait_upload(self, uri: str, timeout: float = BLOB_UPLOAD_WAIT_SECONDS) -> bool:
+        """
+        Espera a que termine la subida en curso de `uri` (si la hay).
+
+        Returns:
+            bool: False si se agotó `timeout` sin que terminara.
+        """
+        with self._lock:
+            event = self._uploads.get(uri)
+        return event is None or event.wait(timeout)
+
+    def stats(self) -> Dict[str, int]:
+        """Contadores de aciertos/fallos y ocupación actual."""
+        stats = dict(self._stats)
+        stats["items"] = len(self._entries)
+        stats["bytes"] = self._size
+        stats["uploads"] = len(self._uploads)
+        return stats
+
+
+blob_cache = BlobCache()
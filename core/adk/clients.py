@@ -0,0 +1,145 @@
+import os
+import threading
+from typing import TYPE_CHECKING, Any, Callable, Dict, Optional, Tuple
+
+from .metrics import register_collector
+
+if TYPE_CHECKING:
+    from google.cloud import storage
+    from google.cloud.aiplatform_v1.services.prediction_service import PredictionServiceClient
+
+
+# --- REGISTRO DE CLIENTES (UNO POR PROCESO) ---
+# Crear un `storage.Client` o un `PredictionServiceClient` implica resolver
+# credenciales, abrir el canal gRPC/HTTP y negociar TLS. Reutilizamos una única
+# instancia por (tipo, proyecto, api_endpoint) en cada worker.
+#
+# Los SDK se importan al crear el primer cliente (no al importar el módulo):
+# solo el de Vertex AI tarda más de un segundo y `manage.py` no los necesita.
+
+_ClientKey = Tuple[str, Optional[str], Optional[str]]
+
+_lock = threading.Lock()
+_clients: Dict[_ClientKey, Any] = {}
+_owner_pid = os.getpid()
+_stats: Dict[str, int] = {
+    "created": 0,
+    "reused": 0,
+    "resets": 0,
+}
+
+
+def _reset_after_fork() -> None:
+    """
+    Descarta los clientes heredados del proceso padre.
+
+    Los canales gRPC y las sesiones HTTP no sobreviven a un fork (gunicorn
+    precarga la app y luego bifurca los workers), así que cada hijo debe
+    crear los suyos propios.
+    """
+    global _lock, _owner_pid
+    _lock = threading.Lock()
+    _clients.clear()
+    _owner_pid = os.getpid()
+    _stats["created"] = 0
+    _stats["reused"] = 0
+    _stats["resets"] += 1
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _get_or_create(key: _ClientKey, factory: Callable[[], Any]) -> Any:
+    """Retorna el cliente registrado para `key`, creándolo la primera vez."""
+    # Salvaguarda adicional por si el fork ocurrió sin pasar por os.fork
+    # (p.ej. multiprocessing con otro mecanismo de arranque).
+    if os.getpid() != _owner_pid:
+        _reset_after_fork()
+
+    client = _clients.get(key)
+    if client is not None:
+        _stats["reused"] += 1
+        return client
+
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            client = factory()
+            _clients[key] = client
+            _stats["created"] += 1
+        else:
+            _stats["reused"] += 1
+        return client
+
+
+def _new_storage_client(project: Optional[str]) -> "storage.Client":
+    from google.cloud import storage
+    return storage.Client(project=project)
+
+
+def _new_prediction_client(api_endpoint: str) -> "PredictionServiceClient":
+    # Solo el cliente GAPIC de predicción: `google.cloud.aiplatform` completo
+    # (el SDK de alto nivel) tarda el doble en importarse y no se usa.
+    from google.cloud.aiplatform_v1.services.prediction_service import PredictionServiceClient
+    return PredictionServiceClient(client_options={"api_endpoint": api_endpoint})
+
+
+def get_storage_client(project: Optional[str] = None) -> "storage.Client":
+    """
+    Cliente de Cloud Storage compartido por el worker.
+
+    Args:
+        project: ID del proyecto (opcional).
+
+    Returns:
+        storage.Client: Instancia reutilizable (thread-safe para lecturas/escrituras de blobs).
+    """
+    return _get_or_create(
+        ("storage", project, None),
+        lambda: _new_storage_client(project),
+    )
+
+
+def get_prediction_client(
+        api_endpoint: str,
+        project: Optional[str] = None,
+) -> "PredictionServiceClient":
+    """
+    Cliente de predicción de Vertex AI compartido por el worker.
+
+    Args:
+        api_endpoint: Endpoint regional (ej: "us-central1-aiplatform.googleapis.com").
+        project: ID del proyecto; forma parte de la clave del registro.
+
+    Returns:
+        PredictionServiceClient: Instancia con el canal gRPC ya establecido.
+    """
+    return _get_or_create(
+        ("prediction", project, api_endpoint),
+        lambda: _new_prediction_client(api_endpoint),
+    )
+
+
+def get_client_stats() -> Dict[str, int]:
+    """
+    Contadores de reutilización del worker actual.
+
+    Returns:
+        dict: `created` (canales nuevos), `reused` (canales reutilizados),
+        `resets` (reinicios tras fork) y `active` (clientes vivos).
+    """
+    stats = dict(_stats)
+    stats["active"] = len(_clients)
+    return stats
+
+
+def _client_metrics():
+    """Reutilización de clientes del worker, leída de `get_client_stats()` al exportar."""
+    stats = get_client_stats()
+    yield "baysafe_clients_total", {"result": "created"}, stats["created"]
+    yield "baysafe_clients_total", {"result": "reused"}, stats["reused"]
+    yield "baysafe_clients_active", {}, stats["active"]
+
+
+register_collector(_client_metrics)
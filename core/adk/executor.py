@@ -0,0 +1,147 @@
+import asyncio
+import contextvars
+import functools
+import os
+import sys
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, Optional, TypeVar
+
+from .metrics import observe
+
+T = TypeVar("T")
+
+
+# --- CONFIGURACIÓN ---
+# Hilos para las llamadas bloqueantes de red (GCS, Vertex) y CPU corto (hash, base64).
+IO_THREADS = int(os.environ.get("BAYSAFE_IO_THREADS", "16"))
+LOOP_LAG_INTERVAL_MS = float(os.environ.get("BAYSAFE_LOOP_LAG_INTERVAL_MS", "100"))
+LOOP_LAG_WARN_MS = float(os.environ.get("BAYSAFE_LOOP_LAG_WARN_MS", "50"))
+# Ajuste opcional: cada cuánto un hilo con el GIL lo cede (0 = el de Python, 5 ms).
+# Con hilos del pool haciendo CPU (hash, base64, Pillow), ese es el retraso mínimo
+# del loop en cada despertar; 1 ms lo acota a costa de algo más de cambios de
+# contexto en todos los hilos del proceso.
+GIL_SWITCH_INTERVAL_MS = float(os.environ.get("BAYSAFE_GIL_SWITCH_INTERVAL_MS", "0"))
+
+
+# --- POOL DE HILOS ACOTADO ---
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def _reset_after_fork() -> None:
+    # Los hilos del padre no existen en el hijo: el pool se recrea bajo demanda.
+    global _executor, _executor_lock
+    _executor = None
+    _executor_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_io_executor() -> ThreadPoolExecutor:
+    """Pool compartido del worker para I/O bloqueante (tamaño BAYSAFE_IO_THREADS)."""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=IO_THREADS,
+                    thread_name_prefix="baysafe-io",
+                )
+    return _executor
+
+
+def apply_gil_switch_interval() -> None:
+    """
+    Aplica BAYSAFE_GIL_SWITCH_INTERVAL_MS al proceso, si está definido. Es un
+    ajuste global (afecta a todos los hilos): se llama una vez al arrancar el
+    worker, en `mi_proyecto.asgi`.
+    """
+    if GIL_SWITCH_INTERVAL_MS > 0:
+        sys.setswitchinterval(GIL_SWITCH_INTERVAL_MS / 1000.0)
+        print(f"Intervalo de cesión del GIL: {GIL_SWITCH_INTERVAL_MS:g} ms")
+
+
+async def run_blocking(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """
+    Ejecuta `func` en el pool de I/O sin bloquear el event loop.
+
+    A diferencia de `loop.run_in_executor`, propaga las contextvars del llamador
+    (igual que `asyncio.to_thread`), pero usando nuestro pool acotado.
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    call = functools.partial(context.run, func, *args, **kwargs)
+    return await loop.run_in_executor(get_io_executor(), call)
+
+
+# --- MEDICIÓN DEL RETRASO DEL EVENT LOOP ---
+
+class LoopLagMonitor:
+    """
+    Mide cuánto se retrasa el event loop respecto a un temporizador periódico.
+
+    Si alguna corrutina hace trabajo bloqueante, el `sleep` del monitor despierta
+    tarde; ese retraso es el tiempo que el loop estuvo bloqueado.
+    """
+
+    def __init__(self, interval_ms: float = LOOP_LAG_INTERVAL_MS, window: int = 1000):
+        self.interval = interval_ms / 1000.0
+        self.samples: Deque[float] = deque(maxlen=window)
+        self.max_lag_ms = 0.0
+        self.task: Optional[asyncio.Task] = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag_ms = max(0.0, (loop.time() - start - self.interval) * 1000.0)
+            self.samples.append(lag_ms)
+            observe("baysafe_event_loop_lag_seconds", lag_ms / 1000.0)
+            if lag_ms > self.max_lag_ms:
+                self.max_lag_ms = lag_ms
+            if lag_ms > LOOP_LAG_WARN_MS:
+                print(f"Advertencia: event loop bloqueado {lag_ms:.1f} ms")
+
+    def start(self) -> None:
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def stats(self) -> Dict[str, float]:
+        """Percentiles del retraso (ms) sobre la ventana reciente y máximo histórico."""
+        ordered = sorted(self.samples)
+        if not ordered:
+            return {"samples": 0, "p50_ms": 0.0, "p99_ms": 0.0, "max_ms": 0.0}
+        return {
+            "samples": len(ordered),
+            "p50_ms": ordered[len(ordered) // 2],
+            "p99_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))],
+            "max_ms": self.max_lag_ms,
+        }
+
+
+_monitors: Dict[int, LoopLagMonitor] = {}
+
+
+def ensure_loop_lag_monitor() -> LoopLagMonitor:
+    """Arranca (una sola vez por event loop) el monitor de retraso y lo retorna."""
+    loop = asyncio.get_running_loop()
+    monitor = _monitors.get(id(loop))
+    if monitor is None or monitor.task is None or monitor.task.get_loop() is not loop:
+        # Limpiamos monitores de loops ya cerrados (p.ej. WSGI + async_to_sync).
+        for key, old in list(_monitors.items()):
+            if old.task is None or old.task.get_loop().is_closed():
+                del _monitors[key]
+        monitor = _monitors[id(loop)] = LoopLagMonitor()
+    monitor.start()
+    return monitor
@@ -0,0 +1,159 @@
+from typing import Dict, Iterable, List, NamedTuple, Tuple
+
+
+# --- TABLA DE RIESGOS (VERSIONADA) ---
+# Cambiar etiquetas, niveles o textos implica subir la versión: forma parte de
+# la clave de cualquier informe guardado en caché.
+HAZARD_TABLE_VERSION = "2025.1"
+
+RISK_HIGH = "alto"
+RISK_MEDIUM = "medio"
+RISK_NONE = "ninguno"
+
+_RISK_ORDER = {RISK_NONE: 0, RISK_MEDIUM: 1, RISK_HIGH: 2}
+
+
+class Hazard(NamedTuple):
+    """Riesgo asociado a una etiqueta del detector."""
+
+    label: str
+    name: str
+    risk: str
+    explanation: str
+
+
+HAZARDS: Dict[str, Hazard] = {
+    hazard.label: hazard for hazard in (
+        Hazard(
+            "mesa_bordes", "Mesa con bordes", RISK_HIGH,
+            "sus esquinas rígidas quedan a la altura de la cabeza de un bebé que gatea o "
+            "empieza a caminar y pueden causar golpes y cortes.",
+        ),
+        Hazard(
+            "bateria", "Batería", RISK_HIGH,
+            "si se traga (sobre todo una pila de botón) puede provocar quemaduras internas graves "
+            "en pocas horas.",
+        ),
+        Hazard(
+            "jarron", "Jarrón", RISK_MEDIUM,
+            "el bebé puede tirarlo al agarrarse del mueble; al romperse deja fragmentos cortantes "
+            "y puede contener agua.",
+        ),
+        Hazard(
+            "cadenilla", "Cadenilla", RISK_HIGH,
+            "puede enredarse en el cuello (riesgo de estrangulamiento) o llevarse a la boca y "
+            "causar atragantamiento.",
+        ),
+        Hazard(
+            "juguete_madera", "Juguete de madera", RISK_MEDIUM,
+            "las piezas pequeñas o astillas sueltas pueden provocar atragantamiento o cortes; "
+            "revisa que esté entero y sin piezas desprendibles.",
+        ),
+        Hazard(
+            "Cojin_Suave", "Cojín suave", RISK_HIGH,
+            "cerca de un bebé dormido puede tapar su nariz y boca y causar asfixia; no debe "
+            "estar en su zona de descanso.",
+        ),
+        Hazard(
+            "tela_colgante", "Tela colgante", RISK_HIGH,
+            "al tirar de ella puede hacer caer objetos pesados encima del bebé, y los cordones "
+            "o pliegues pueden enredarse en su cuello.",
+        ),
+    )
+}
+
+_HAZARDS_BY_KEY = {label.lower(): hazard for label, hazard in HAZARDS.items()}
+
+_SAFE_EXPLANATION = "no figura entre los objetos de riesgo conocidos para un bebé."
+
+_VERDICTS = {
+    RISK_HIGH: (
+        "PELIGROSA",
+        "🔴 Conclusión: la zona NO es segura para un bebé. Retira o asegura los objetos marcados "
+        "como peligrosos antes de dejarlo en este espacio.",
+    ),
+    RISK_MEDIUM: (
+        "PRECAUCIÓN",
+        "🟠 Conclusión: la zona requiere precaución. No hay riesgos graves, pero conviene apartar "
+        "los objetos señalados y supervisar al bebé.",
+    ),
+    RISK_NONE: (
+        "SEGURA",
+        "🟢 Conclusión: no se detectaron objetos peligrosos; la zona parece segura para un bebé. "
+        "Mantén siempre la supervisión de un adulto.",
+    ),
+}
+
+
+def dangerous_labels() -> List[str]:
+    """Etiquetas del detector consideradas peligrosas (para las instrucciones del agente)."""
+    return [label for label, hazard in HAZARDS.items() if hazard.risk != RISK_NONE]
+
+
+def classify(labels: Iterable[str]) -> List[Hazard]:
+    """
+    Clasifica las etiquetas detectadas según la tabla de riesgos.
+
+    Las etiquetas desconocidas se consideran seguras. El resultado va ordenado
+    de mayor a menor riesgo y luego por nombre, para que el informe sea estable.
+    """
+    hazards = []
+    for label in sorted(set(labels)):
+        hazard = _HAZARDS_BY_KEY.get(label.lower())
+        if hazard is None:
+            hazard = Hazard(label, label.replace("_", " ").capitalize(), RISK_NONE, _SAFE_EXPLANATION)
+        hazards.append(hazard)
+    hazards.sort(key=lambda hazard: (-_RISK_ORDER[hazard.risk], hazard.name))
+    return hazards
+
+
+def aggregate_verdict(hazards: List[Hazard]) -> Tuple[str, str]:
+    """
+    Veredicto de la zona: lo determina el objeto de mayor riesgo.
+
+    Returns:
+        tuple: (veredicto corto — PELIGROSA, PRECAUCIÓN o SEGURA —, conclusión para los padres)
+    """
+    worst = max((hazard.risk for hazard in hazards), key=_RISK_ORDER.__getitem__, default=RISK_NONE)
+    return _VERDICTS[worst]
+
+
+def build_report(labels: Iterable[str]) -> str:
+    """
+    Informe de seguridad para padres, sin LLM, con la misma estructura que pide
+    BAYSAFE_INSTRUCTION: resumen, una frase por objeto y conclusión final.
+    """
+    hazards = classify(labels)
+    _, conclusion = aggregate_verdict(hazards)
+
+    if not hazards:
+        return "No se detectaron objetos en la imagen.\n\n" + conclusion
+
+    dangerous = [hazard for hazard in hazards if hazard.risk != RISK_NONE]
+    summary = f"Se detectaron {len(hazards)} tipo(s) de objeto: " + ", ".join(h.name for h in hazards) + "."
+    if len(dangerous) == 1:
+        summary += " 1 de ellos representa un riesgo."
+    elif dangerous:
+        summary += f" {len(dangerous)} de ellos representan un riesgo."
+
+    lines = [summary, ""]
+    for hazard in hazards:
+        if hazard.risk == RISK_NONE:
+            lines.append(f"🟢 {hazard.name} (SEGURO): {hazard.explanation}")
+        else:
+            icon = "🔴" if hazard.risk == RISK_HIGH else "🟠"
+            lines.append(f"{icon} {hazard.name} (PELIGROSO, riesgo {hazard.risk}): {hazard.explanation}")
+    lines += ["", conclusion]
+    return "\n".join(lines)
+
+
+def build_error_report(reason: str = "la detección de objetos falló") -> str:
+    """
+    Informe cuando la imagen no se pudo analizar. Nunca lleva veredicto: una
+    detección fallida no equivale a "no hay objetos".
+    """
+    return (
+        f"⚠️ No se pudo analizar la imagen: {reason}.\n\n"
+        "No es posible confirmar si la zona es segura para un bebé. Vuelve a enviar la foto en "
+        "unos minutos y, mientras tanto, revisa la zona en persona."
+    )
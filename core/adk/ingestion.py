@@ -0,0 +1,186 @@
+import hashlib
+import io
+import os
+from typing import BinaryIO, NamedTuple, Optional
+
+from .backends import get_blob_store
+from .tracing import traced
+
+
+# --- CONFIGURACIÓN ---
+# Tamaño de cada bloque leído del upload. Las subidas reanudables de GCS exigen
+# múltiplos de 256 KiB, así que se redondea hacia arriba.
+_GCS_CHUNK_MULTIPLE = 256 * 1024
+INGEST_CHUNK_BYTES = max(
+    _GCS_CHUNK_MULTIPLE,
+    -(-int(os.environ.get("BAYSAFE_INGEST_CHUNK_BYTES", str(_GCS_CHUNK_MULTIPLE))) // _GCS_CHUNK_MULTIPLE)
+    * _GCS_CHUNK_MULTIPLE,
+)
+INGEST_MAX_BYTES = int(os.environ.get("BAYSAFE_INGEST_MAX_BYTES", str(25 * 1024 * 1024)))
+
+# Firmas (magic bytes) de los formatos de imagen aceptados.
+_SIGNATURES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"BM", "image/bmp"),
+)
+_EXTENSIONS = {
+    "image/jpeg": ".jpg",
+    "image/png": ".png",
+    "image/gif": ".gif",
+    "image/bmp": ".bmp",
+    "image/webp": ".webp",
+    "image/heic": ".heic",
+}
+
+
+class IngestionError(ValueError):
+    """El archivo subido no es una imagen aceptada o supera el tamaño máximo."""
+
+
+def _too_large(max_bytes: int) -> str:
+    return f"La imagen supera el máximo de {max_bytes / (1024 * 1024):.1f} MB"
+
+
+class IngestedFile(NamedTuple):
+    """Resultado de la ingesta de un archivo subido."""
+
+    sha256: str
+    content_type: str
+    size: int
+    gcs_uri: Optional[str]
+
+
+def sniff_image_type(header: bytes) -> Optional[str]:
+    """
+    Identifica el formato de imagen por sus primeros bytes (no por la extensión
+    ni por el Content-Type que declara el navegador).
+
+    Returns:
+        str: MIME type, o None si no es un formato aceptado.
+    """
+    for signature, content_type in _SIGNATURES:
+        if header.startswith(signature):
+            return content_type
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "image/webp"
+    if header[4:8] == b"ftyp" and header[8:12] in (b"heic", b"heix", b"mif1", b"msf1"):
+        return "image/heic"
+    return None
+
+
+def extension_for(content_type: str) -> str:
+    """Extensión de archivo para un MIME type de imagen aceptado."""
+    return _EXTENSIONS.get(content_type, ".jpg")
+
+
+def validate_upload(file_obj, max_bytes: int = INGEST_MAX_BYTES) -> str:
+    """
+    Validación previa y barata de un archivo de Django: tamaño declarado y firma.
+
+    Solo lee la cabecera; deja el puntero al inicio.
+
+    Returns:
+        str: MIME type detectado.
+
+    Raises:
+        IngestionError: Si supera `max_bytes` o no es una imagen aceptada.
+    """
+    if file_obj.size is not None and file_obj.size > max_bytes:
+        raise IngestionError(_too_large(max_bytes))
+    file_obj.seek(0)
+    header = file_obj.read(32)
+    file_obj.seek(0)
+    content_type = sniff_image_type(header)
+    if content_type is None:
+        raise IngestionError("El archivo no es una imagen válida (JPEG, PNG, WebP, GIF, BMP o HEIC)")
+    return content_type
+
+
+def open_upload(file_obj) -> BinaryIO:
+    """
+    Abre un lector independiente del archivo subido (no comparte la posición
+    con `file_obj`), para poder leerlo en paralelo con la ingesta.
+
+    Un TemporaryUploadedFile se reabre desde disco; uno en memoria (por debajo
+    de FILE_UPLOAD_MAX_MEMORY_SIZE) se copia.
+    """
+    if hasattr(file_obj, "temporary_file_path"):
+        return open(file_obj.temporary_file_path(), "rb")
+    file_obj.seek(0)
+    return io.BytesIO(file_obj.read())
+
+
+@traced("ingest")
+def ingest_upload(
+        file_obj,
+        bucket_name: Optional[str] = None,
+        blob_path: Optional[str] = None,
+        project_id: Optional[str] = None,
+        chunk_size: int = INGEST_CHUNK_BYTES,
+        max_bytes: int = INGEST_MAX_BYTES
+) -> IngestedFile:
+    """
+    Ingesta en una sola pasada: lee el upload por bloques de `chunk_size`,
+    detecta el formato con el primer bloque, calcula el SHA-256, corta en cuanto
+    se supera `max_bytes` y, si se indica destino, envía cada bloque a una
+    subida reanudable de GCS.
+
+    La memoria usada es del orden de `chunk_size`, sea cual sea el tamaño del
+    archivo (Django entrega un TemporaryUploadedFile en disco para los grandes).
+
+    Args:
+        file_obj: Archivo de Django (InMemoryUploadedFile o TemporaryUploadedFile).
+        bucket_name: Bucket de destino; None para solo validar y calcular el hash.
+        blob_path: Ruta destino dentro del bucket.
+        project_id: ID del proyecto (opcional).
+        chunk_size: Bytes por bloque (múltiplo de 256 KiB).
+        max_bytes: Tamaño máximo aceptado.
+
+    Returns:
+        IngestedFile: Hash, MIME type detectado, tamaño y URI (si se subió).
+
+    Raises:
+        IngestionError: Si no es una imagen aceptada o supera `max_bytes`
+            (la subida parcial a GCS se cancela).
+    """
+    digest = hashlib.sha256()
+    size = 0
+    content_type = None
+    writer = None
+
+    file_obj.seek(0)
+    try:
+        for chunk in file_obj.chunks(chunk_size):
+            if content_type is None:
+                content_type = sniff_image_type(chunk[:32])
+                if content_type is None:
+                    raise IngestionError("El archivo no es una imagen válida")
+                if bucket_name and blob_path:
+                    writer = get_blob_store(project_id).open_writer(
+                        bucket_name, blob_path, content_type, chunk_size
+                    )
+
+            size += len(chunk)
+            if size > max_bytes:
+                raise IngestionError(_too_large(max_bytes))
+
+            digest.update(chunk)
+            if writer is not None:
+                writer.write(chunk)
+    except BaseException:
+        if writer is not None:
+            # Cancela la subida (sesión reanudable de GCS o archivo temporal local):
+            # no queda un objeto a medias en el bucket.
+            writer.terminate()
+        raise
+
+    if content_type is None:
+        raise IngestionError("El archivo está vacío")
+    if writer is not None:
+        writer.close()
+
+    gcs_uri = f"gs://{bucket_name}/{blob_path}" if writer is not None else None
+    return IngestedFile(sha256=digest.hexdigest(), content_type=content_type, size=size, gcs_uri=gcs_uri)
@@ -0,0 +1,317 @@
+import atexit
+import bisect
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+
+# --- CONFIGURACIÓN ---
+METRICS_ENABLED = os.environ.get("BAYSAFE_METRICS_ENABLED", "True") == "True"
+# Directorio compartido por los workers de gunicorn del mismo host: cada uno
+# vuelca ahí su instantánea (`<pid>.json`), la borra al salir y `/metrics`
+# suma las de los workers vivos.
+METRICS_DIR = os.environ.get("BAYSAFE_METRICS_DIR", os.path.join(tempfile.gettempdir(), "baysafe_metrics"))
+# Cada cuánto (segundos) un worker vuelca su instantánea.
+METRICS_FLUSH_SECONDS = float(os.environ.get("BAYSAFE_METRICS_FLUSH_SECONDS", "5"))
+
+# Límites superiores (segundos) de los buckets de latencia.
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Retraso del event loop: el objetivo son pocos milisegundos.
+LOOP_LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+LabelSet = Tuple[Tuple[str, str], ...]
+_Sample = Tuple[str, LabelSet]
+
+
+class Metric(NamedTuple):
+    """Definición de una métrica en el formato de exposición de Prometheus."""
+
+    name: str
+    kind: str  # "counter", "gauge" o "histogram"
+    help: str
+    buckets: Tuple[float, ...] = ()
+
+
+METRICS: Dict[str, Metric] = {
+    metric.name: metric for metric in (
+        Metric("baysafe_stage_duration_seconds", "histogram",
+               "Duración de cada etapa del análisis (un turno del LLM por observación).", DURATION_BUCKETS),
+        Metric("baysafe_event_loop_lag_seconds", "histogram",
+               "Retraso del event loop respecto a su temporizador (una muestra por intervalo).", LOOP_LAG_BUCKETS),
+        Metric("baysafe_stage_errors_total", "counter", "Errores por etapa del análisis."),
+        Metric("baysafe_analyses_total", "counter", "Análisis iniciados por modo de informe."),
+        Metric("baysafe_analyses_in_flight", "gauge", "Análisis en curso."),
+        Metric("baysafe_cache_requests_total", "counter", "Consultas a las cachés por resultado (hit/miss)."),
+        Metric("baysafe_detected_labels_total", "counter", "Objetos detectados por etiqueta."),
+        Metric("baysafe_clients_total", "counter", "Clientes de GCS/Vertex AI pedidos: creados o reutilizados."),
+        Metric("baysafe_clients_active", "gauge", "Clientes de GCS/Vertex AI vivos en el worker."),
+        Metric("baysafe_predict_instances_total", "counter", "Instancias enviadas a Vertex AI (predict agrupado)."),
+        Metric("baysafe_predict_rpcs_total", "counter", "Llamadas predict emitidas (instancias / RPCs = lote medio)."),
+        Metric("baysafe_predict_failures_total", "counter",
+               "Llamadas predict fallidas (error) y esperas vencidas (timeout)."),
+    )
+}
+
+
+# --- REGISTRO POR HILO (SIN LOCKS EN EL CAMINO CALIENTE) ---
+# Cada hilo (el del event loop y los del pool de I/O) escribe solo en su propio
+# fragmento; la exportación copia y suma los fragmentos. Así registrar una
+# observación cuesta unas pocas operaciones de diccionario y nunca compite.
+
+class _Shard:
+    __slots__ = ("values", "histograms")
+
+    def __init__(self):
+        self.values: Dict[_Sample, float] = {}
+        # Por muestra: un contador por bucket, uno para +Inf y la suma al final.
+        self.histograms: Dict[_Sample, List[float]] = {}
+
+
+_registry_lock = threading.Lock()
+_shards: List[_Shard] = []
+_local = threading.local()
+_owner_pid = os.getpid()
+_collectors: List[Callable[[], Iterable[Tuple[str, Dict[str, str], float]]]] = []
+_flusher: Optional[threading.Thread] = None
+# Tras borrar la instantánea al salir, el hilo de volcado no debe recrearla.
+_exiting = False
+
+
+def _reset_after_fork() -> None:
+    """Un worker recién bifurcado empieza de cero (no hereda lo del proceso padre)."""
+    global _registry_lock, _shards, _local, _owner_pid, _flusher
+    _registry_lock = threading.Lock()
+    _shards = []
+    _local = threading.local()
+    _owner_pid = os.getpid()
+    _flusher = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _shard() -> _Shard:
+    shard = getattr(_local, "shard", None)
+    if shard is None:
+        if os.getpid() != _owner_pid:
+            _reset_after_fork()
+        shard = _local.shard = _Shard()
+        with _registry_lock:
+            _shards.append(shard)
+        _ensure_flusher()
+    return shard
+
+
+def _labels(labels: Dict[str, object]) -> LabelSet:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def inc(name: str, value: float = 1.0, **labels: object) -> None:
+    """Suma `value` a un contador (o a un gauge, con valores negativos)."""
+    if METRICS_ENABLED:
+        values = _shard().values
+        key = (name, _labels(labels))
+        values[key] = values.get(key, 0.0) + value
+
+
+def dec(name: str, value: float = 1.0, **labels: object) -> None:
+    """Resta `value` a un gauge."""
+    inc(name, -value, **labels)
+
+
+def observe(name: str, value: float, **labels: object) -> None:
+    """Registra una observación en un histograma."""
+    if not METRICS_ENABLED:
+        return
+    buckets = METRICS[name].buckets
+    histograms = _shard().histograms
+    key = (name, _labels(labels))
+    counts = histograms.get(key)
+    if counts is None:
+        counts = histograms[key] = [0.0] * (len(buckets) + 2)
+    counts[bisect.bisect_left(buckets, value)] += 1
+    counts[-1] += value
+
+
+def register_collector(collector: Callable[[], Iterable[Tuple[str, Dict[str, str], float]]]) -> None:
+    """
+    Registra una función que, al exportar, retorna (métrica, etiquetas, valor)
+    leídos de contadores que ya existen (p.ej. las estadísticas de las cachés).
+    """
+    _collectors.append(collector)
+
+
+# --- INSTANTÁNEAS Y EXPORTACIÓN ENTRE WORKERS ---
+
+def snapshot() -> Dict[str, object]:
+    """Suma de los fragmentos de este worker (más los colectores registrados)."""
+    values: Dict[_Sample, float] = {}
+    histograms: Dict[_Sample, List[float]] = {}
+    with _registry_lock:
+        shards = list(_shards)
+    for shard in shards:
+        # dict(...) y list(...) copian de una vez (bajo el GIL) aunque el hilo
+        # dueño siga escribiendo.
+        for key, value in dict(shard.values).items():
+            values[key] = values.get(key, 0.0) + value
+        for key, counts in dict(shard.histograms).items():
+            merged = histograms.setdefault(key, [0.0] * len(counts))
+            for i, count in enumerate(list(counts)):
+                merged[i] += count
+    for collector in _collectors:
+        try:
+            for name, labels, value in collector():
+                key = (name, _labels(labels))
+                values[key] = values.get(key, 0.0) + value
+        except Exception as e:
+            print(f"Error en colector de métricas: {e}")
+    return {
+        "pid": os.getpid(),
+        "values": [[name, list(labels), value] for (name, labels), value in values.items()],
+        "histograms": [[name, list(labels), counts] for (name, labels), counts in histograms.items()],
+    }
+
+
+def flush() -> None:
+    """Vuelca la instantánea de este worker a METRICS_DIR (escritura atómica)."""
+    if _exiting:
+        return
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        path = os.path.join(METRICS_DIR, f"{os.getpid()}.json")
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as snapshot_file:
+            json.dump(snapshot(), snapshot_file)
+        os.replace(temp_path, path)
+    except OSError as e:
+        print(f"Error volcando métricas: {e}")
+
+
+def _remove_file(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _remove_snapshot() -> None:
+    """Al salir el worker, su instantánea deja de contar (y no se acumula en disco)."""
+    global _exiting
+    _exiting = True
+    _remove_file(os.path.join(METRICS_DIR, f"{os.getpid()}.json"))
+
+
+# os.getpid() se evalúa al salir: cada worker bifurcado borra su propio fichero.
+atexit.register(_remove_snapshot)
+
+
+def _flush_loop() -> None:
+    while True:
+        time.sleep(METRICS_FLUSH_SECONDS)
+        flush()
+
+
+def _ensure_flusher() -> None:
+    global _flusher
+    if _flusher is None or not _flusher.is_alive():
+        _flusher = threading.Thread(target=_flush_loop, name="baysafe-metrics", daemon=True)
+        _flusher.start()
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _load_snapshots() -> List[Dict[str, object]]:
+    """
+    Instantáneas de los workers vivos. Las de procesos muertos sin `atexit`
+    (SIGKILL, OOM) se borran aquí.
+    """
+    flush()
+    snapshots = []
+    try:
+        names = [name for name in os.listdir(METRICS_DIR) if name.endswith(".json")]
+    except OSError:
+        return [snapshot()]
+    for name in names:
+        path = os.path.join(METRICS_DIR, name)
+        pid = name[:-len(".json")]
+        if pid.isdigit() and int(pid) != os.getpid() and not _pid_alive(int(pid)):
+            _remove_file(path)
+            continue
+        try:
+            with open(path, encoding="utf-8") as snapshot_file:
+                snapshots.append(json.load(snapshot_file))
+        except (OSError, ValueError):
+            continue
+    return snapshots or [snapshot()]
+
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Iterable[Tuple[str, str]]) -> str:
+    labels = list(labels)
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def render_metrics() -> str:
+    """
+    Métricas de todos los workers del host en el formato de texto de Prometheus.
+
+    Solo cuentan los workers vivos: cuando uno se recicla, sus contadores
+    desaparecen de la suma y Prometheus lo trata como un reinicio del
+    contador (`rate()` y `increase()` lo absorben).
+    """
+    values: Dict[_Sample, float] = {}
+    histograms: Dict[_Sample, List[float]] = {}
+    for worker in _load_snapshots():
+        for name, labels, value in worker.get("values", []):
+            if name not in METRICS:
+                continue
+            key = (name, tuple(tuple(label) for label in labels))
+            values[key] = values.get(key, 0.0) + value
+        for name, labels, counts in worker.get("histograms", []):
+            key = (name, tuple(tuple(label) for label in labels))
+            merged = histograms.setdefault(key, [0.0] * len(counts))
+            for i, count in enumerate(counts):
+                merged[i] += count
+
+    lines = []
+    for metric in METRICS.values():
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        if metric.kind != "histogram":
+            for (name, labels), value in sorted(values.items()):
+                if name == metric.name:
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+            continue
+        for (name, labels), counts in sorted(histograms.items()):
+            if name != metric.name:
+                continue
+            cumulative = 0.0
+            for bound, count in zip(list(metric.buckets) + ["+Inf"], counts[:-1]):
+                cumulative += count
+                le = bound if isinstance(bound, str) else repr(float(bound))
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', le),))} {_format_value(cumulative)}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {repr(float(counts[-1]))}")
+            lines.append(f"{name}_count{_format_labels(labels)} {_format_value(cumulative)}")
+    return "\n".join(lines) + "\n"
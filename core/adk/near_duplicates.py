@@ -0,0 +1,290 @@
+import io
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+# Third-party imports
+from PIL import Image
+
+from .result_cache import CACHE_DB_PATH
+
+
+# --- CONFIGURACIÓN ---
+NEAR_DUPLICATE_ENABLED = os.environ.get("NEAR_DUPLICATE_ENABLED", "True") == "True"
+# Distancia de Hamming máxima (sobre 64 bits) para considerar dos fotos "la misma escena".
+NEAR_DUPLICATE_MAX_DISTANCE = int(os.environ.get("NEAR_DUPLICATE_MAX_DISTANCE", "4"))
+NEAR_DUPLICATE_MAX_ITEMS = int(os.environ.get("NEAR_DUPLICATE_MAX_ITEMS", "1000000"))
+# Cada cuánto (segundos) un worker incorpora los hashes que guardaron otros workers.
+NEAR_DUPLICATE_SYNC_SECONDS = float(os.environ.get("NEAR_DUPLICATE_SYNC_SECONDS", "2"))
+# Fotos oscuras, borrosas o lisas: casi todos sus bits salen de diferencias de
+# uno o dos niveles de gris (ruido) y escenas distintas caen a pocos bits. Solo se
+# reutilizan fotos con al menos MIN_CONTRAST_BITS bits de una diferencia de
+# MIN_STEP niveles o más (ver benchmarks/bench_near_duplicates.py).
+NEAR_DUPLICATE_MIN_CONTRAST_BITS = int(os.environ.get("NEAR_DUPLICATE_MIN_CONTRAST_BITS", "24"))
+NEAR_DUPLICATE_MIN_STEP = int(os.environ.get("NEAR_DUPLICATE_MIN_STEP", "4"))
+
+HASH_BITS = 64
+
+
+# --- HASH PERCEPTUAL (dHash) ---
+
+def dhash_with_contrast(image_bytes: bytes, hash_size: int = 8,
+                        min_step: int = NEAR_DUPLICATE_MIN_STEP) -> Tuple[int, int]:
+    """
+    Calcula el dHash (difference hash) de una imagen y cuántos de sus bits son fiables.
+
+    Reduce la imagen a una miniatura en escala de grises de (hash_size+1) x hash_size
+    y codifica si cada píxel es más brillante que su vecino derecho. Es robusto a
+    recompresión, cambios de tamaño y pequeñas variaciones de exposición.
+
+    Args:
+        image_bytes: Bytes de la imagen (JPEG, PNG, WebP...).
+        hash_size: Lado del hash; 8 produce un entero de 64 bits.
+        min_step: Diferencia mínima (niveles de gris) para contar un bit como fiable.
+
+    Returns:
+        tuple: (hash sin signo de hash_size * hash_size bits, bits cuya
+        diferencia es de al menos `min_step` niveles).
+    """
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        # Para JPEG, `draft` decodifica directamente a una escala reducida (DCT),
+        # evitando descomprimir los 12 MP completos solo para obtener 9x8 píxeles.
+        image.draft("L", ((hash_size + 1) * 8, hash_size * 8))
+        thumbnail = image.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR)
+        pixels = list(thumbnail.getdata())
+
+    value = 0
+    contrast_bits = 0
+    width = hash_size + 1
+    for row in range(hash_size):
+        offset = row * width
+        for col in range(hash_size):
+            step = pixels[offset + col] - pixels[offset + col + 1]
+            value = (value << 1) | (step > 0)
+            contrast_bits += abs(step) >= min_step
+    return value, contrast_bits
+
+
+def dhash(image_bytes: bytes, hash_size: int = 8) -> int:
+    """dHash de una imagen (ver `dhash_with_contrast`)."""
+    return dhash_with_contrast(image_bytes, hash_size)[0]
+
+
+def distinctive_hash(image_bytes: bytes) -> Optional[int]:
+    """
+    dHash de la imagen, o None si tiene menos de NEAR_DUPLICATE_MIN_CONTRAST_BITS
+    bits fiables: en fotos oscuras, borrosas o lisas el hash se acerca a 0 y dos
+    habitaciones distintas quedan a menos de NEAR_DUPLICATE_MAX_DISTANCE bits.
+    Esas fotos no se buscan ni se guardan en el índice.
+    """
+    value, contrast_bits = dhash_with_contrast(image_bytes)
+    return value if contrast_bits >= NEAR_DUPLICATE_MIN_CONTRAST_BITS else None
+
+
+# --- ÍNDICE MULTI-ÍNDICE PARA BÚSQUEDA POR DISTANCIA DE HAMMING ---
+
+class MultiIndexHashIndex:
+    """
+    Índice de hashes de 64 bits con consultas por distancia de Hamming.
+
+    Implementa multi-index hashing: el hash se divide en `max_distance + 1`
+    segmentos disjuntos y cada segmento indexa una tabla hash. Por el principio
+    del palomar, cualquier hash a distancia <= max_distance coincide exactamente
+    en al menos un segmento, así que solo se verifican los candidatos de esos
+    buckets (con popcount) en lugar de recorrer todo el índice.
+    """
+
+    def __init__(self, max_distance: int = NEAR_DUPLICATE_MAX_DISTANCE, bits: int = HASH_BITS):
+        self.max_distance = max_distance
+        self.bits = bits
+
+        chunks = max_distance + 1
+        base, extra = divmod(bits, chunks)
+        self._segments: List[Tuple[int, int]] = []  # (desplazamiento, máscara)
+        shift = 0
+        for i in range(chunks):
+            width = base + (1 if i < extra else 0)
+            self._segments.append((shift, (1 << width) - 1))
+            shift += width
+
+        self._tables: List[Dict[int, List[int]]] = [dict() for _ in self._segments]
+        self._hashes: List[int] = []
+        self._payloads: List[Any] = []
+
+    def __len__(self) -> int:
+        return len(self._hashes)
+
+    def add(self, value: int, payload: Any) -> None:
+        """Inserta un hash con su dato asociado (p.ej. la lista de objetos detectados)."""
+        item_id = len(self._hashes)
+        self._hashes.append(value)
+        self._payloads.append(payload)
+        for table, (shift, mask) in zip(self._tables, self._segments):
+            table.setdefault((value >> shift) & mask, []).append(item_id)
+
+    def query(self, value: int, max_distance: Optional[int] = None) -> Optional[Tuple[int, Any]]:
+        """
+        Busca el hash almacenado más cercano dentro de `max_distance`.
+
+        Returns:
+            tuple: (distancia, payload) del vecino más cercano, o None.
+        """
+        if max_distance is None or max_distance > self.max_distance:
+            max_distance = self.max_distance
+
+        best: Optional[Tuple[int, Any]] = None
+        hashes = self._hashes
+        for table, (shift, mask) in zip(self._tables, self._segments):
+            for item_id in table.get((value >> shift) & mask, ()):
+                distance = (hashes[item_id] ^ value).bit_count()
+                if distance <= max_distance and (best is None or distance < best[0]):
+                    best = (distance, self._payloads[item_id])
+                    if distance == 0:
+                        return best
+        return best
+
+
+# --- ALMACÉN PERSISTENTE COMPARTIDO ENTRE WORKERS ---
+
+def _to_signed(value: int) -> int:
+    # SQLite guarda enteros de 64 bits con signo.
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def _to_unsigned(value: int) -> int:
+    return value + (1 << 64) if value < 0 else value
+
+
+class NearDuplicateStore:
+    """
+    Índice de casi-duplicados por worker, sincronizado con una tabla SQLite.
+
+    Cada worker mantiene su `MultiIndexHashIndex` en memoria y, como mucho cada
+    NEAR_DUPLICATE_SYNC_SECONDS, incorpora las filas nuevas que hayan escrito los
+    demás workers (consulta incremental por id).
+    """
+
+    def __init__(
+            self,
+            db_path: str = CACHE_DB_PATH,
+            max_distance: int = NEAR_DUPLICATE_MAX_DISTANCE,
+            max_items: int = NEAR_DUPLICATE_MAX_ITEMS
+    ):
+        self.db_path = db_path
+        self.max_distance = max_distance
+        self.max_items = max_items
+
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._indexes: Dict[str, MultiIndexHashIndex] = {}
+        self._last_row_id = 0
+        self._last_sync = 0.0
+        self._stats: Dict[str, int] = {"hits": 0, "misses": 0, "errors": 0}
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+
+        conn = sqlite3.connect(self.db_path, timeout=5.0, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS near_duplicates (
+                id         INTEGER PRIMARY KEY AUTOINCREMENT,
+                namespace  TEXT NOT NULL,
+                hash       INTEGER NOT NULL,
+                labels     TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+            """
+        )
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def _index_for(self, namespace: str) -> MultiIndexHashIndex:
+        index = self._indexes.get(namespace)
+        if index is None:
+            index = self._indexes[namespace] = MultiIndexHashIndex(self.max_distance)
+        return index
+
+    def _sync(self) -> None:
+        # Comprobación, lectura y avance de `_last_row_id` bajo el mismo lock: dos
+        # hilos del pool que sincronizaran a la vez leerían las mismas filas y
+        # las insertarían dos veces en el índice.
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_sync < NEAR_DUPLICATE_SYNC_SECONDS:
+                return
+            self._last_sync = now
+
+            rows = self._connection().execute(
+                "SELECT id, namespace, hash, labels FROM near_duplicates WHERE id > ? ORDER BY id",
+                (self._last_row_id,),
+            ).fetchall()
+            if not rows:
+                return
+
+            for row_id, namespace, value, labels in rows:
+                self._index_for(namespace).add(_to_unsigned(value), labels.split("\n") if labels else [])
+                self._last_row_id = row_id
+
+            # Al superar el límite se reconstruye con la mitad más reciente.
+            if sum(len(index) for index in self._indexes.values()) > self.max_items:
+                self._indexes.clear()
+                self._last_row_id = max(0, self._last_row_id - self.max_items // 2)
+                self._last_sync = 0.0
+
+    def lookup(self, image_hash: int, namespace: str) -> Optional[List[str]]:
+        """
+        Retorna los objetos detectados de una imagen casi idéntica, o None.
+
+        Args:
+            image_hash: dHash de la imagen consultada.
+            namespace: Identifica endpoint y parámetros de detección.
+        """
+        try:
+            self._sync()
+        except sqlite3.Error as e:
+            self._stats["errors"] += 1
+            print(f"Error sincronizando índice de casi-duplicados: {e}")
+
+        index = self._indexes.get(namespace)
+        match = index.query(image_hash) if index is not None else None
+        if match is None:
+            self._stats["misses"] += 1
+            return None
+
+        self._stats["hits"] += 1
+        distance, labels = match
+        print(f"DEBUG: Casi-duplicado encontrado (distancia Hamming {distance})")
+        return list(labels)
+
+    def add(self, image_hash: int, namespace: str, labels: List[str]) -> None:
+        """Registra el resultado de una detección para futuras consultas."""
+        try:
+            conn = self._connection()
+            row_id = conn.execute(
+                "INSERT INTO near_duplicates (namespace, hash, labels, created_at) VALUES (?, ?, ?, ?)",
+                (namespace, _to_signed(image_hash), "\n".join(labels), time.time()),
+            ).lastrowid
+            if row_id % 1000 == 0:
+                conn.execute("DELETE FROM near_duplicates WHERE id <= ?", (row_id - self.max_items,))
+            # Se incorpora en la próxima sincronización (también en este worker).
+            self._last_sync = 0.0
+        except sqlite3.Error as e:
+            self._stats["errors"] += 1
+            print(f"Error guardando hash de casi-duplicado: {e}")
+
+    def stats(self) -> Dict[str, int]:
+        """Aciertos/fallos del worker actual y tamaño del índice en memoria."""
+        stats = dict(self._stats)
+        stats["items"] = sum(len(index) for index in self._indexes.values())
+        return stats
+
+
+near_duplicate_store = NearDuplicateStore()
@@ -0,0 +1,225 @@
+import os
+from typing import Any, Dict, Iterable, List, Mapping, NamedTuple, Optional, Sequence, Tuple
+
+# Third-party imports
+import numpy as np
+
+
+# --- CONFIGURACIÓN ---
+# Confianza mínima de una caja tras la predicción (por defecto, la misma que se
+# pide a Vertex AI en VERTEX_CONFIDENCE_THRESHOLD).
+DETECTION_MIN_CONFIDENCE = float(os.environ.get(
+    "BAYSAFE_DETECTION_MIN_CONFIDENCE", os.environ.get("VERTEX_CONFIDENCE_THRESHOLD", "0.5")
+))
+# IoU a partir del cual dos cajas de la misma clase se consideran el mismo objeto.
+DETECTION_NMS_IOU = float(os.environ.get("BAYSAFE_DETECTION_NMS_IOU", "0.5"))
+# Filas de la matriz de solapes que se calculan a la vez en la NMS.
+NMS_BLOCK_ROWS = 256
+
+
+# --- DETECCIONES ESTRUCTURADAS ---
+# Vertex AI (AutoML Object Detection) devuelve columnas paralelas:
+# `displayNames`, `confidences` y `bboxes` con cada caja como
+# [xMin, xMax, yMin, yMax] normalizadas. Aquí se decodifican a arrays de NumPy
+# y se filtran y suprimen en bloque, sin recorrer las cajas en Python: el coste
+# sigue siendo bajo con miles de cajas por imagen.
+
+class Detection(NamedTuple):
+    """Un objeto detectado; la caja es (x_min, y_min, x_max, y_max) normalizada, o None."""
+
+    label: str
+    score: float
+    box: Optional[Tuple[float, float, float, float]]
+
+    def as_dict(self) -> Dict[str, Any]:
+        """Formato de las detecciones del orquestador y de la caché (JSON)."""
+        return {
+            "label": self.label,
+            "confidence": self.score,
+            "box": list(self.box) if self.box is not None else None,
+        }
+
+
+class DecodedPrediction(NamedTuple):
+    """Columnas de una predicción: etiquetas (N,), confianzas (N,) y cajas (N, 4) xyxy."""
+
+    labels: np.ndarray
+    scores: np.ndarray
+    boxes: np.ndarray
+
+
+def decode_prediction(prediction: Mapping[str, Any]) -> DecodedPrediction:
+    """
+    Convierte una predicción de Vertex AI (dict o struct de protobuf) en arrays.
+    Si faltan las cajas o no cuadran con las etiquetas, quedan en NaN.
+    """
+    names = list(prediction.get("displayNames") or [])
+    confidences = list(prediction.get("confidences") or [])
+    count = min(len(names), len(confidences))
+
+    labels = np.asarray([str(name) for name in names[:count]], dtype=object)
+    scores = np.asarray(confidences[:count], dtype=np.float32).reshape(count)
+    boxes = np.full((count, 4), np.nan, dtype=np.float32)
+
+    raw_boxes = list(prediction.get("bboxes") or [])
+    if count and len(raw_boxes) >= count:
+        try:
+            raw = np.asarray(raw_boxes[:count], dtype=np.float32)
+        except (TypeError, ValueError):
+            # Structs de protobuf: cada caja es un ListValue.
+            try:
+                raw = np.asarray([list(box) for box in raw_boxes[:count]], dtype=np.float32)
+            except (TypeError, ValueError):
+                raw = None
+        if raw is not None and raw.shape == (count, 4):
+            # [xMin, xMax, yMin, yMax] -> [xMin, yMin, xMax, yMax]
+            boxes = raw[:, [0, 2, 1, 3]]
+    return DecodedPrediction(labels, scores, boxes)
+
+
+def _best_per_class(scores: np.ndarray, class_ids: np.ndarray) -> np.ndarray:
+    """Índice de la caja de mayor confianza de cada clase."""
+    order = np.argsort(-scores, kind="stable")
+    _, first = np.unique(class_ids[order], return_index=True)
+    return order[first]
+
+
+def _greedy_nms(boxes: np.ndarray, iou_threshold: float) -> np.ndarray:
+    """
+    NMS voraz de cajas de una misma clase ya ordenadas de mayor a menor
+    confianza; retorna las posiciones conservadas.
+
+    Los solapes se calculan por bloques de filas (memoria acotada a
+    NMS_BLOCK_ROWS x N), solo para las cajas que siguen vivas al empezar el
+    bloque y contra las de menor confianza. Los bloques empiezan pequeños y se
+    duplican: las primeras cajas (las de más confianza) suelen suprimir a casi
+    todas las demás. El recorrido voraz que queda es un OR de máscaras por caja
+    conservada.
+    """
+    x1, y1, x2, y2 = boxes.T
+    areas = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    removed = np.zeros(len(boxes), dtype=bool)
+    kept: List[int] = []
+    block_start, block_rows = 0, 8
+    while block_start < len(boxes):
+        rows = np.arange(block_start, min(block_start + block_rows, len(boxes)))
+        block_start += block_rows
+        block_rows = min(block_rows * 2, NMS_BLOCK_ROWS)
+        rows = rows[~removed[rows]]
+        if not rows.size:
+            continue
+        columns = slice(rows[0], len(boxes))
+        width = np.minimum(x2[rows, None], x2[None, columns])
+        width -= np.maximum(x1[rows, None], x1[None, columns])
+        height = np.minimum(y2[rows, None], y2[None, columns])
+        height -= np.maximum(y1[rows, None], y1[None, columns])
+        intersection = np.clip(width, 0, None, out=width)
+        intersection *= np.clip(height, 0, None, out=height)
+        # IoU > umbral  <=>  intersección > umbral * (área_a + área_b - intersección)
+        union = areas[rows, None] + areas[None, columns]
+        union -= intersection
+        overlaps = intersection > iou_threshold * union
+        for row, row_overlaps in zip(rows.tolist(), overlaps):
+            if removed[row]:
+                continue
+            kept.append(row)
+            removed[columns] |= row_overlaps
+    return np.asarray(kept, dtype=np.intp)
+
+
+def class_aware_nms(
+        boxes: np.ndarray,
+        scores: np.ndarray,
+        class_ids: np.ndarray,
+        iou_threshold: float = DETECTION_NMS_IOU
+) -> np.ndarray:
+    """
+    Non-max suppression por clase: una caja se descarta si otra de su misma
+    clase y mayor confianza la solapa con IoU > `iou_threshold`. Las filas sin
+    caja (NaN) se reducen a la de mayor confianza de su clase.
+
+    Returns:
+        np.ndarray: Índices conservados, de mayor a menor confianza.
+    """
+    if scores.size == 0:
+        return np.empty(0, dtype=np.intp)
+
+    has_box = ~np.isnan(boxes).any(axis=1)
+    keep = [np.flatnonzero(~has_box)]
+    if keep[0].size:
+        keep[0] = keep[0][_best_per_class(scores[~has_box], class_ids[~has_box])]
+
+    # Cajas agrupadas por clase y, dentro de cada clase, de mayor a menor
+    # confianza: cada clase es un tramo contiguo que se suprime por separado.
+    indices = np.flatnonzero(has_box)
+    indices = indices[np.lexsort((-scores[indices], class_ids[indices]))]
+    sorted_boxes = boxes[indices]
+    _, starts = np.unique(class_ids[indices], return_index=True)
+    for start, end in zip(starts.tolist(), starts[1:].tolist() + [indices.size]):
+        keep.append(indices[start:end][_greedy_nms(sorted_boxes[start:end], iou_threshold)])
+
+    keep = np.concatenate(keep)
+    return keep[np.argsort(-scores[keep], kind="stable")]
+
+
+def to_image_coordinates(boxes: np.ndarray, region: Sequence[float]) -> np.ndarray:
+    """
+    Traslada cajas xyxy normalizadas a una tesela (`region`, también xyxy
+    normalizada en la imagen) a coordenadas normalizadas de la imagen.
+    """
+    x_min, y_min, x_max, y_max = region
+    scale = np.asarray([x_max - x_min, y_max - y_min] * 2, dtype=np.float32)
+    offset = np.asarray([x_min, y_min] * 2, dtype=np.float32)
+    return boxes * scale + offset
+
+
+def postprocess_predictions(
+        predictions: Iterable[Mapping[str, Any]],
+        min_confidence: float = DETECTION_MIN_CONFIDENCE,
+        iou_threshold: float = DETECTION_NMS_IOU,
+        regions: Optional[Sequence[Sequence[float]]] = None
+) -> Tuple[List[Detection], List[str]]:
+    """
+    Decodifica las predicciones, descarta las cajas bajo `min_confidence` y
+    aplica NMS por clase sobre todas a la vez.
+
+    Args:
+        regions: Con teselas, la región de la imagen de cada predicción (en el
+            mismo orden); sus cajas se trasladan a la imagen antes de la NMS.
+
+    Returns:
+        tuple: (detecciones de mayor a menor confianza, etiquetas únicas en ese orden)
+    """
+    decoded = [decode_prediction(prediction) for prediction in predictions]
+    if not decoded:
+        return [], []
+    if regions is not None:
+        decoded = [
+            d._replace(boxes=to_image_coordinates(d.boxes, region)) for d, region in zip(decoded, regions)
+        ]
+    labels = np.concatenate([d.labels for d in decoded])
+    scores = np.concatenate([d.scores for d in decoded])
+    boxes = np.concatenate([d.boxes for d in decoded])
+
+    mask = scores >= min_confidence
+    labels, scores, boxes = labels[mask], scores[mask], boxes[mask]
+    if not scores.size:
+        return [], []
+
+    classes, class_ids = np.unique(labels, return_inverse=True)
+    keep = class_aware_nms(boxes, scores, class_ids, iou_threshold)
+
+    detections = []
+    for index in keep.tolist():
+        box = boxes[index]
+        detections.append(Detection(
+            label=str(classes[class_ids[index]]),
+            score=round(float(scores[index]), 4),
+            box=None if np.isnan(box).any() else tuple(round(float(v), 4) for v in box),
+        ))
+    return detections, list(dict.fromkeys(detection.label for detection in detections))
+
+
+def detection_labels(detections: Iterable[Dict[str, Any]]) -> List[str]:
+    """Etiquetas únicas, en el orden de las detecciones (la mejor primero)."""
+    return list(dict.fromkeys(detection["label"] for detection in detections))
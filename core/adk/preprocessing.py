@@ -0,0 +1,143 @@
+import io
+import os
+from typing import BinaryIO, NamedTuple, Optional, Union
+
+# Third-party imports
+from PIL import Image, ImageOps
+
+
+# --- CONFIGURACIÓN ---
+PREPROCESS_ENABLED = os.environ.get("BAYSAFE_PREPROCESS_ENABLED", "True") == "True"
+# Lado mayor máximo (px). El detector de AutoML trabaja a una resolución muy
+# inferior a la de una foto de móvil (12 MP), así que no perdemos información útil.
+PREPROCESS_MAX_SIDE = int(os.environ.get("BAYSAFE_PREPROCESS_MAX_SIDE", "1280"))
+# Formato de salida: JPEG o WEBP.
+PREPROCESS_FORMAT = os.environ.get("BAYSAFE_PREPROCESS_FORMAT", "JPEG").upper()
+PREPROCESS_QUALITY = int(os.environ.get("BAYSAFE_PREPROCESS_QUALITY", "85"))
+PREPROCESS_MIN_QUALITY = int(os.environ.get("BAYSAFE_PREPROCESS_MIN_QUALITY", "55"))
+# JPEG optimizado y progresivo: un ~10% menos de bytes, pero Pillow lo codifica
+# de una sola vez sin soltar el GIL (~25 ms por foto de 1280 px en los que el
+# event loop no avanza). Sin él, codifica por bloques y el loop sigue atendiendo.
+PREPROCESS_OPTIMIZE = os.environ.get("BAYSAFE_PREPROCESS_OPTIMIZE", "False") == "True"
+# Presupuesto de bytes por imagen. En base64 ocupa un 33% más y debe quedar
+# holgadamente bajo el límite de 1.5 MB de la predicción online de Vertex AI.
+PREPROCESS_MAX_BYTES = int(os.environ.get("BAYSAFE_PREPROCESS_MAX_BYTES", str(600_000)))
+# Conservar también el original en GCS (en segundo plano, fuera del camino crítico).
+ARCHIVE_ORIGINALS = os.environ.get("BAYSAFE_ARCHIVE_ORIGINALS", "True") == "True"
+
+_FORMATS = {
+    "JPEG": ("image/jpeg", ".jpg"),
+    "WEBP": ("image/webp", ".webp"),
+}
+
+
+class PreparedImage(NamedTuple):
+    """Imagen lista para subir e inferir."""
+
+    data: bytes
+    content_type: str
+    extension: str
+    width: int
+    height: int
+    original_bytes: int
+
+
+def _to_rgb(image: Image.Image) -> Image.Image:
+    if image.mode == "RGB":
+        return image
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        # Las transparencias se aplanan sobre blanco (JPEG no tiene canal alfa).
+        rgba = image.convert("RGBA")
+        background = Image.new("RGB", rgba.size, (255, 255, 255))
+        background.paste(rgba, mask=rgba.getchannel("A"))
+        return background
+    return image.convert("RGB")
+
+
+def _encode(image: Image.Image, image_format: str, quality: int) -> bytes:
+    buffer = io.BytesIO()
+    options = {"quality": quality}
+    if image_format == "JPEG":
+        if PREPROCESS_OPTIMIZE:
+            options.update(optimize=True, progressive=True)
+    else:
+        options.update(method=4)
+    # Sin `exif`/`icc_profile`: se descartan los metadatos (GPS, cámara...).
+    image.save(buffer, format=image_format, **options)
+    return buffer.getvalue()
+
+
+def preprocess_image(
+        image: Union[bytes, BinaryIO],
+        max_side: int = PREPROCESS_MAX_SIDE,
+        max_bytes: int = PREPROCESS_MAX_BYTES,
+        image_format: str = PREPROCESS_FORMAT,
+        quality: int = PREPROCESS_QUALITY,
+        min_quality: int = PREPROCESS_MIN_QUALITY
+) -> Optional[PreparedImage]:
+    """
+    Normaliza una foto para el detector: orientación EXIF aplicada, lado mayor
+    acotado, sin metadatos y recomprimida dentro de un presupuesto de bytes.
+
+    Primero baja la calidad en pasos de 10 hasta `min_quality`; si aún no cabe,
+    reduce el tamaño un 25% y vuelve a intentarlo.
+
+    Args:
+        image: Bytes originales (JPEG, PNG, WebP, HEIF si Pillow lo soporta...) o un
+            archivo binario abierto; así Pillow lee del disco sin cargar el original
+            completo en memoria.
+        max_side: Lado mayor máximo en píxeles.
+        max_bytes: Tamaño máximo del resultado.
+        image_format: "JPEG" o "WEBP".
+        quality: Calidad inicial de compresión.
+        min_quality: Calidad mínima antes de reducir la resolución.
+
+    Returns:
+        PreparedImage, o None si los bytes no son una imagen que Pillow pueda abrir.
+    """
+    if image_format not in _FORMATS:
+        image_format = "JPEG"
+    content_type, extension = _FORMATS[image_format]
+
+    if isinstance(image, (bytes, bytearray)):
+        original_bytes = len(image)
+        image = io.BytesIO(image)
+    else:
+        image.seek(0, io.SEEK_END)
+        original_bytes = image.tell()
+        image.seek(0)
+
+    try:
+        with Image.open(image) as source:
+            # En JPEG, `draft` decodifica directamente a 1/2, 1/4 o 1/8 de escala
+            # (sin bajar de max_side), evitando descomprimir los 12 MP completos.
+            source.draft("RGB", (max_side, max_side))
+            picture = _to_rgb(ImageOps.exif_transpose(source))
+            picture.load()
+    except Exception as e:
+        print(f"Error preprocesando imagen: {e}")
+        return None
+
+    picture.thumbnail((max_side, max_side), Image.LANCZOS)
+
+    while True:
+        current_quality = quality
+        data = _encode(picture, image_format, current_quality)
+        while len(data) > max_bytes and current_quality - 10 >= min_quality:
+            current_quality -= 10
+            data = _encode(picture, image_format, current_quality)
+
+        if len(data) <= max_bytes or max(picture.size) <= 256:
+            break
+        picture = picture.resize(
+            (max(1, int(picture.width * 0.75)), max(1, int(picture.height * 0.75))), Image.LANCZOS
+        )
+
+    return PreparedImage(
+        data=data,
+        content_type=content_type,
+        extension=extension,
+        width=picture.width,
+        height=picture.height,
+        original_bytes=original_bytes,
+    )
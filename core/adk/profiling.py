@@ -0,0 +1,294 @@
+import hmac
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import Counter
+from pathlib import Path
+from typing import Dict, List, Optional
+
+
+# --- CONFIGURACIÓN ---
+BASE_DIR = Path(__file__).resolve().parent.parent.parent
+
+# Secreto de la cabecera X-BaySafe-Profile (sin definir, solo se perfila desde el admin).
+PROFILE_TOKEN = os.environ.get("BAYSAFE_PROFILE_TOKEN", "")
+# Directorio compartido por los workers: perfiles generados y peticiones pendientes.
+PROFILE_DIR = os.environ.get("BAYSAFE_PROFILE_DIR", os.path.join(tempfile.gettempdir(), "baysafe_profiles"))
+# Periodo de muestreo de las pilas (milisegundos).
+PROFILE_INTERVAL_MS = float(os.environ.get("BAYSAFE_PROFILE_INTERVAL_MS", "5"))
+# Profundidad de las trazas de tracemalloc y perfiles conservados.
+PROFILE_TRACEMALLOC_FRAMES = int(os.environ.get("BAYSAFE_PROFILE_TRACEMALLOC_FRAMES", "16"))
+PROFILE_MAX_ITEMS = int(os.environ.get("BAYSAFE_PROFILE_MAX_ITEMS", "50"))
+
+PROFILE_HEADER = "X-BaySafe-Profile"
+COLLAPSED_SUFFIX = ".collapsed.txt"
+ALLOCATIONS_SUFFIX = ".alloc.txt"
+_PROFILE_FILE_RE = re.compile(r"^[\w.-]+\.(collapsed|alloc)\.txt$")
+
+# Marca en disco que indica que hay peticiones pendientes de perfilar: mientras no
+# exista, comprobarlo cuesta un `stat` por petición (sin abrir SQLite).
+_ARMED_FLAG = os.path.join(PROFILE_DIR, "armed")
+_ARM_DB = os.path.join(PROFILE_DIR, "armed.sqlite3")
+
+
+# --- ACTIVACIÓN (CABECERA O PRÓXIMAS N PETICIONES) ---
+
+def _arm_connection() -> sqlite3.Connection:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    conn = sqlite3.connect(_ARM_DB, timeout=5.0, isolation_level=None)
+    conn.execute("CREATE TABLE IF NOT EXISTS armed (id INTEGER PRIMARY KEY CHECK (id = 1), remaining INTEGER NOT NULL)")
+    return conn
+
+
+def arm_profiling(count: int) -> None:
+    """Perfila las próximas `count` peticiones, en cualquier worker del host (0 cancela)."""
+    conn = _arm_connection()
+    try:
+        conn.execute("INSERT OR REPLACE INTO armed (id, remaining) VALUES (1, ?)", (max(0, count),))
+    finally:
+        conn.close()
+    if count > 0:
+        Path(_ARMED_FLAG).touch()
+    elif os.path.exists(_ARMED_FLAG):
+        os.remove(_ARMED_FLAG)
+
+
+def armed_remaining() -> int:
+    """Peticiones que aún quedan por perfilar."""
+    if not os.path.exists(_ARMED_FLAG):
+        return 0
+    conn = _arm_connection()
+    try:
+        row = conn.execute("SELECT remaining FROM armed WHERE id = 1").fetchone()
+    finally:
+        conn.close()
+    return row[0] if row else 0
+
+
+def _take_armed() -> bool:
+    """Consume una de las peticiones pendientes (atómico entre workers)."""
+    if not os.path.exists(_ARMED_FLAG):
+        return False
+    try:
+        conn = _arm_connection()
+        try:
+            taken = conn.execute(
+                "UPDATE armed SET remaining = remaining - 1 WHERE id = 1 AND remaining > 0"
+            ).rowcount > 0
+            left = conn.execute("SELECT remaining FROM armed WHERE id = 1").fetchone()
+        finally:
+            conn.close()
+        if not left or left[0] <= 0:
+            try:
+                os.remove(_ARMED_FLAG)
+            except FileNotFoundError:
+                # Otro worker consumió la última a la vez.
+                pass
+        return taken
+    except (sqlite3.Error, OSError) as e:
+        print(f"Error leyendo perfiles pendientes: {e}")
+        return False
+
+
+def profiling_requested(header_value: Optional[str]) -> bool:
+    """True si la petición trae el secreto en la cabecera o quedan peticiones pendientes."""
+    if header_value and PROFILE_TOKEN and hmac.compare_digest(header_value.strip(), PROFILE_TOKEN):
+        return True
+    return _take_armed()
+
+
+# --- PERFIL DE UNA PETICIÓN ---
+# Un hilo muestrea cada PROFILE_INTERVAL_MS las pilas de todos los hilos del
+# worker (`sys._current_frames`), como haría py-spy desde fuera del proceso.
+# Se conservan el hilo del event loop y los hilos que ejecutan código de la app
+# (el pool de I/O en GCS, Vertex o el preprocesado); los hilos ociosos se
+# descartan. En paralelo, tracemalloc registra las asignaciones de memoria.
+# Ambos cubren todo el worker durante la petición, incluidos otros análisis
+# concurrentes.
+
+_active_lock = threading.Lock()
+
+
+def _is_app_file(filename: str) -> bool:
+    return filename.startswith(str(BASE_DIR)) and "site-packages" not in filename
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    filename = code.co_filename
+    if _is_app_file(filename):
+        filename = os.path.relpath(filename, BASE_DIR)
+    else:
+        filename = os.path.basename(filename)
+    # El formato colapsado usa `;` como separador de marcos.
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})".replace(";", ":")
+
+
+class Profile:
+    """Muestreo de pilas y tracemalloc durante una petición; `stop()` escribe los archivos."""
+
+    def __init__(self, profile_id: str, interval: float = PROFILE_INTERVAL_MS / 1000):
+        self.profile_id = profile_id
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._started_tracemalloc = False
+        # Hilo que abre el perfil (el del event loop): se muestrea aunque esté ocioso.
+        self._owner = threading.get_ident()
+        self._thread = threading.Thread(target=self._run, name="baysafe-profiler", daemon=True)
+
+    def start(self) -> None:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(PROFILE_TRACEMALLOC_FRAMES)
+            self._started_tracemalloc = True
+        tracemalloc.reset_peak()
+        self.started = time.perf_counter()
+        self._thread.start()
+
+    def _run(self) -> None:
+        sampler = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for ident, frame in sys._current_frames().items():
+                if ident == sampler:
+                    continue
+                stack = []
+                in_app = ident == self._owner
+                own = names.get(ident) == "baysafe-metrics"
+                while frame is not None:
+                    in_app = in_app or _is_app_file(frame.f_code.co_filename)
+                    # Pilas del propio perfilador (p.ej. `finish_profile`) y del volcado de métricas.
+                    own = own or frame.f_code.co_filename == __file__
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                if in_app and not own:
+                    stack.append(names.get(ident, str(ident)))
+                    self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self) -> Dict[str, str]:
+        """Detiene el muestreo y guarda el perfil; retorna las rutas generadas."""
+        self._stop.set()
+        self._thread.join()
+        duration = time.perf_counter() - self.started
+        try:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            if self._started_tracemalloc:
+                tracemalloc.stop()
+
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        collapsed_path = os.path.join(PROFILE_DIR, f"{self.profile_id}{COLLAPSED_SUFFIX}")
+        with open(collapsed_path, "w", encoding="utf-8") as collapsed_file:
+            for stack, count in self.stacks.most_common():
+                collapsed_file.write(f"{stack} {count}\n")
+
+        allocations_path = os.path.join(PROFILE_DIR, f"{self.profile_id}{ALLOCATIONS_SUFFIX}")
+        with open(allocations_path, "w", encoding="utf-8") as allocations_file:
+            allocations_file.write(self._allocations_report(snapshot, current, peak, duration))
+
+        _prune()
+        print(f"Perfil {self.profile_id} guardado ({self.samples} muestras en {duration * 1000:.0f} ms)")
+        return {"collapsed": collapsed_path, "allocations": allocations_path}
+
+    def _allocations_report(self, snapshot, current: int, peak: int, duration: float) -> str:
+        snapshot = snapshot.filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<unknown>"),
+        ))
+        lines = [
+            f"Perfil {self.profile_id}: {duration * 1000:.0f} ms, {self.samples} muestras de pila",
+            f"Memoria trazada al terminar: {current / 1024:.1f} KiB (pico {peak / 1024:.1f} KiB)",
+            "",
+            "Top 25 asignaciones vivas por línea:",
+        ]
+        for index, stat in enumerate(snapshot.statistics("lineno")[:25], 1):
+            frame = stat.traceback[0]
+            lines.append(f"{index:3}. {frame.filename}:{frame.lineno}: {stat.size / 1024:.1f} KiB en {stat.count} bloques")
+        lines += ["", "Top 5 por traza completa:"]
+        for stat in snapshot.statistics("traceback")[:5]:
+            lines.append(f"{stat.size / 1024:.1f} KiB en {stat.count} bloques")
+            lines += [f"    {line}" for line in stat.traceback.format()]
+        return "\n".join(lines) + "\n"
+
+
+def start_profile(profile_id: Optional[str] = None) -> Optional[Profile]:
+    """
+    Empieza a perfilar el worker (None si ya hay un perfil en curso en este
+    proceso: el muestreo y tracemalloc son globales).
+    """
+    if not _active_lock.acquire(blocking=False):
+        print("Perfil omitido: ya hay uno en curso en este worker")
+        return None
+    try:
+        profile = Profile(re.sub(r"[^\w.-]", "_", profile_id or "") or uuid.uuid4().hex[:16])
+        profile.start()
+    except Exception:
+        _active_lock.release()
+        raise
+    return profile
+
+
+def finish_profile(profile: Profile) -> Dict[str, str]:
+    """Detiene el perfil y escribe los archivos. Bloqueante: llamar con `run_blocking`."""
+    try:
+        return profile.stop()
+    finally:
+        _active_lock.release()
+
+
+# --- PERFILES GUARDADOS ---
+
+def list_profiles() -> List[Dict[str, object]]:
+    """Perfiles guardados, del más reciente al más antiguo."""
+    try:
+        names = os.listdir(PROFILE_DIR)
+    except OSError:
+        return []
+    profiles = []
+    for name in names:
+        if not name.endswith(COLLAPSED_SUFFIX):
+            continue
+        profile_id = name[:-len(COLLAPSED_SUFFIX)]
+        path = os.path.join(PROFILE_DIR, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        profiles.append({
+            "id": profile_id,
+            "created_at": stat.st_mtime,
+            "collapsed": name,
+            "allocations": f"{profile_id}{ALLOCATIONS_SUFFIX}",
+            "size": stat.st_size,
+        })
+    return sorted(profiles, key=lambda p: -p["created_at"])
+
+
+def profile_file_path(name: str) -> Optional[str]:
+    """Ruta de un archivo de perfil por su nombre (None si no es válido o no existe)."""
+    if not _PROFILE_FILE_RE.match(name):
+        return None
+    path = os.path.join(PROFILE_DIR, name)
+    return path if os.path.isfile(path) else None
+
+
+def _prune() -> None:
+    for profile in list_profiles()[PROFILE_MAX_ITEMS:]:
+        for name in (profile["collapsed"], profile["allocations"]):
+            try:
+                os.remove(os.path.join(PROFILE_DIR, name))
+            except OSError:
+                pass
@@ -0,0 +1,249 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+
+# --- CONFIGURACIÓN ---
+# El archivo SQLite vive en disco local y lo comparten todos los workers de
+# gunicorn del mismo host (modo WAL: lectores concurrentes + un escritor).
+BASE_DIR = Path(__file__).resolve().parent.parent.parent
+
+CACHE_DB_PATH = os.environ.get("BAYSAFE_CACHE_DB", str(BASE_DIR / "baysafe_cache.sqlite3"))
+DETECTION_CACHE_TTL = int(os.environ.get("DETECTION_CACHE_TTL", str(7 * 24 * 3600)))
+DETECTION_CACHE_MEMORY_ITEMS = int(os.environ.get("DETECTION_CACHE_MEMORY_ITEMS", "512"))
+DETECTION_CACHE_DISK_ITEMS = int(os.environ.get("DETECTION_CACHE_DISK_ITEMS", "50000"))
+# Informes del agente por conjunto de objetos detectados (hay pocas docenas de
+# combinaciones frecuentes, así que bastan pocas entradas).
+REPORT_CACHE_TTL = int(os.environ.get("REPORT_CACHE_TTL", str(30 * 24 * 3600)))
+REPORT_CACHE_MEMORY_ITEMS = int(os.environ.get("REPORT_CACHE_MEMORY_ITEMS", "256"))
+REPORT_CACHE_DISK_ITEMS = int(os.environ.get("REPORT_CACHE_DISK_ITEMS", "5000"))
+
+# Cada cuántas escrituras se ejecuta la limpieza por TTL/tamaño en disco.
+_PRUNE_EVERY = 100
+
+
+def make_cache_key(content: bytes, **params: Any) -> str:
+    """
+    Clave direccionada por contenido: SHA-256 de los bytes + parámetros.
+
+    Args:
+        content: Bytes de la imagen.
+        **params: Parámetros que alteran el resultado (umbral, endpoint, ...).
+
+    Returns:
+        str: Hex digest estable para los mismos bytes y parámetros.
+    """
+    digest = hashlib.sha256(content).hexdigest()
+    params_json = json.dumps(params, sort_keys=True, default=str)
+    return f"{digest}:{hashlib.sha256(params_json.encode('utf-8')).hexdigest()[:16]}"
+
+
+def make_label_set_key(labels: Iterable[str], **params: Any) -> str:
+    """
+    Clave canónica para un conjunto de etiquetas: el orden y los repetidos no
+    importan ("silla, mesa" y "mesa, silla, mesa" comparten clave).
+
+    Args:
+        labels: Etiquetas detectadas.
+        **params: Lo que altera el resultado cacheado (p.ej. la versión del prompt).
+    """
+    canonical = json.dumps(
+        {"labels": sorted(set(labels)), "params": params}, sort_keys=True, default=str
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class TieredCache:
+    """
+    Caché de dos niveles: LRU en memoria por worker + SQLite (WAL) compartido.
+
+    Los valores deben ser serializables a JSON. Los errores de SQLite nunca se
+    propagan: en ese caso la caché se comporta como un fallo (miss).
+    """
+
+    def __init__(
+            self,
+            namespace: str,
+            ttl: int,
+            memory_items: int,
+            disk_items: int,
+            db_path: str = CACHE_DB_PATH
+    ):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.memory_items = memory_items
+        self.disk_items = disk_items
+        self.db_path = db_path
+
+        self._memory: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._writes = 0
+        self._stats: Dict[str, int] = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "sets": 0,
+            "errors": 0,
+        }
+
+    # --- Conexión SQLite (una por hilo y proceso) ---
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+
+        conn = sqlite3.connect(self.db_path, timeout=5.0, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS cache_entries (
+                namespace   TEXT NOT NULL,
+                key         TEXT NOT NULL,
+                value       TEXT NOT NULL,
+                expires_at  REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                PRIMARY KEY (namespace, key)
+            )
+            """
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS cache_entries_lru ON cache_entries (namespace, accessed_at)"
+        )
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    # --- Nivel en memoria ---
+
+    def _memory_get(self, key: str, now: float) -> Optional[Any]:
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= now:
+                del self._memory[key]
+                return None
+            self._memory.move_to_end(key)
+            return value
+
+    def _memory_set(self, key: str, value: Any, expires_at: float) -> None:
+        with self._lock:
+            self._memory[key] = (expires_at, value)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_items:
+                self._memory.popitem(last=False)
+
+    # --- API pública ---
+
+    def get(self, key: str) -> Optional[Any]:
+        """Busca `key` en memoria y luego en disco. Retorna None si no existe o expiró."""
+        now = time.time()
+        value = self._memory_get(key, now)
+        if value is not None:
+            self._stats["memory_hits"] += 1
+            return value
+
+        try:
+            conn = self._connection()
+            row = conn.execute(
+                "SELECT value, expires_at FROM cache_entries WHERE namespace = ? AND key = ?",
+                (self.namespace, key),
+            ).fetchone()
+            if row is not None and row[1] > now:
+                conn.execute(
+                    "UPDATE cache_entries SET accessed_at = ? WHERE namespace = ? AND key = ?",
+                    (now, self.namespace, key),
+                )
+                value = json.loads(row[0])
+                self._memory_set(key, value, row[1])
+                self._stats["disk_hits"] += 1
+                return value
+        except (sqlite3.Error, ValueError) as e:
+            self._stats["errors"] += 1
+            print(f"Error leyendo caché '{self.namespace}': {e}")
+
+        self._stats["misses"] += 1
+        return None
+
+    def set(self, key: str, value: Any) -> None:
+        """Guarda `value` en ambos niveles con el TTL configurado."""
+        now = time.time()
+        expires_at = now + self.ttl
+        self._memory_set(key, value, expires_at)
+        self._stats["sets"] += 1
+
+        try:
+            conn = self._connection()
+            conn.execute(
+                "INSERT OR REPLACE INTO cache_entries (namespace, key, value, expires_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (self.namespace, key, json.dumps(value), expires_at, now),
+            )
+            self._writes += 1
+            if self._writes % _PRUNE_EVERY == 0:
+                self.prune()
+        except (sqlite3.Error, TypeError) as e:
+            self._stats["errors"] += 1
+            print(f"Error escribiendo caché '{self.namespace}': {e}")
+
+    def prune(self) -> None:
+        """Elimina entradas expiradas y, si se supera el tamaño, las menos usadas."""
+        conn = self._connection()
+        conn.execute(
+            "DELETE FROM cache_entries WHERE namespace = ? AND expires_at <= ?",
+            (self.namespace, time.time()),
+        )
+        conn.execute(
+            """
+            DELETE FROM cache_entries
+            WHERE namespace = ? AND key IN (
+                SELECT key FROM cache_entries WHERE namespace = ?
+                ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+            )
+            """,
+            (self.namespace, self.namespace, self.disk_items),
+        )
+
+    def clear(self) -> None:
+        """Vacía ambos niveles para este namespace."""
+        with self._lock:
+            self._memory.clear()
+        try:
+            self._connection().execute(
+                "DELETE FROM cache_entries WHERE namespace = ?", (self.namespace,)
+            )
+        except sqlite3.Error as e:
+            print(f"Error vaciando caché '{self.namespace}': {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        """Contadores del worker actual y tasa de aciertos."""
+        stats: Dict[str, Any] = dict(self._stats)
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        stats["memory_items"] = len(self._memory)
+        return stats
+
+
+detection_cache = TieredCache(
+    namespace="detections",
+    ttl=DETECTION_CACHE_TTL,
+    memory_items=DETECTION_CACHE_MEMORY_ITEMS,
+    disk_items=DETECTION_CACHE_DISK_ITEMS,
+)
+
+report_cache = TieredCache(
+    namespace="reports",
+    ttl=REPORT_CACHE_TTL,
+    memory_items=REPORT_CACHE_MEMORY_ITEMS,
+    disk_items=REPORT_CACHE_DISK_ITEMS,
+)
@@ -0,0 +1,373 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Set, Tuple
+
+# Third-party imports
+from google.genai import types
+
+# Google ADK imports
+from google.adk.events import Event
+from google.adk.sessions import InMemorySessionService, Session
+
+
+# --- CONFIGURACIÓN ---
+APP_NAME = "agents"
+SESSION_MAX_ACTIVE = int(os.environ.get("BAYSAFE_SESSION_MAX_ACTIVE", "1000"))
+SESSION_IDLE_SECONDS = int(os.environ.get("BAYSAFE_SESSION_IDLE_SECONDS", "1800"))
+# Turnos completos que se conservan literalmente; los anteriores se resumen.
+SESSION_KEEP_TURNS = int(os.environ.get("BAYSAFE_SESSION_KEEP_TURNS", "2"))
+SESSION_MAX_EVENTS = int(os.environ.get("BAYSAFE_SESSION_MAX_EVENTS", "12"))
+# Líneas (una por análisis) que caben en el resumen acumulado.
+SESSION_SUMMARY_MAX_TURNS = int(os.environ.get("BAYSAFE_SESSION_SUMMARY_MAX_TURNS", "10"))
+# Presupuesto global de memoria de las sesiones del worker (bytes aproximados).
+SESSION_MEMORY_BUDGET = int(os.environ.get("BAYSAFE_SESSION_MEMORY_BUDGET", str(64 * 1024 * 1024)))
+
+DETECTION_TOOL_NAME = "predict_image_object_detection_sample"
+# Línea con la que el orquestador inyecta las detecciones en el mensaje del
+# usuario cuando el agente responde en un solo turno (sin llamar a la herramienta).
+DETECTIONS_PREFIX = "Objetos detectados por el modelo de visión:"
+COMPACTION_INVOCATION_ID = "baysafe-compaction"
+# Sustituye en el historial a la imagen en línea que recibió el LLM para verificar detecciones.
+INLINE_IMAGE_PLACEHOLDER = "[Imagen adjunta para verificar las detecciones (omitida del historial)]"
+_SUMMARY_HEADER = "Contexto (resumen de análisis anteriores de esta conversación):"
+_VERDICT_MAX_CHARS = 240
+
+_SessionKey = Tuple[str, str]
+
+
+def session_ids_for(django_session_key: str) -> Tuple[str, str]:
+    """
+    Deriva (user_id, session_id) del ADK a partir de la sesión de Django.
+
+    Se usa un hash para no exponer la cookie de sesión en los logs ni en el
+    historial del agente.
+
+    Returns:
+        tuple: ("django-<hash>", "chat-<hash>")
+    """
+    digest = hashlib.sha256(django_session_key.encode("utf-8")).hexdigest()[:24]
+    return f"django-{digest}", f"chat-{digest}"
+
+
+# --- HISTORIAL ACOTADO CON COMPACTACIÓN ---
+
+def _event_size(event: Event) -> int:
+    """Tamaño aproximado (bytes) del contenido de un evento."""
+    size = 0
+    if event.content and event.content.parts:
+        for part in event.content.parts:
+            if part.text:
+                size += len(part.text)
+            if part.inline_data is not None and part.inline_data.data:
+                size += len(part.inline_data.data)
+            if part.function_call is not None:
+                size += len(str(part.function_call.args))
+            if part.function_response is not None:
+                size += len(str(part.function_response.response))
+    return size
+
+
+def _final_text(event: Event) -> str:
+    if not event.content or not event.content.parts:
+        return ""
+    return " ".join(part.text for part in event.content.parts if part.text).strip()
+
+
+def summarize_turn(events: List[Event]) -> str:
+    """
+    Resume un turno (petición del usuario + respuesta del agente) en una línea.
+
+    Conserva lo único que necesitan los turnos siguientes: la lista de objetos
+    detectados y el veredicto final del agente.
+    """
+    objects: List[str] = []
+    verdict = ""
+    for event in events:
+        if event.author == "user":
+            for line in _final_text(event).splitlines():
+                if line.startswith(DETECTIONS_PREFIX):
+                    try:
+                        objects.extend(str(item) for item in json.loads(line[len(DETECTIONS_PREFIX):]))
+                    except ValueError:
+                        pass
+        for response in event.get_function_responses():
+            if response.name == DETECTION_TOOL_NAME and response.response:
+                result = response.response.get("result", response.response)
+                if isinstance(result, list):
+                    objects.extend(str(item) for item in result)
+        if event.author != "user":
+            text = _final_text(event)
+            if text:
+                verdict = text
+
+    # Del informe nos quedamos con el cierre (la conclusión para el bebé).
+    if len(verdict) > _VERDICT_MAX_CHARS:
+        verdict = "…" + verdict[-_VERDICT_MAX_CHARS:].split(" ", 1)[-1]
+    detected = ", ".join(sorted(set(objects))) if objects else "ninguno"
+    return f"- Objetos detectados: {detected}. Veredicto: {verdict or 'sin respuesta'}"
+
+
+def _without_inline_data(event: Event) -> Event:
+    """Copia del evento con cada parte binaria (imagen en línea) sustituida por un texto."""
+    parts = [
+        types.Part(text=INLINE_IMAGE_PLACEHOLDER) if part.inline_data is not None else part
+        for part in event.content.parts
+    ]
+    return event.model_copy(update={"content": types.Content(role=event.content.role, parts=parts)})
+
+
+class CompactingSessionService(InMemorySessionService):
+    """
+    Servicio de sesiones en memoria con historial acotado.
+
+    Cuando termina un turno y la sesión supera SESSION_MAX_EVENTS, los turnos
+    más antiguos se sustituyen por un único evento de resumen (objetos
+    detectados + veredicto). Así la memoria del worker y el prompt que se
+    reenvía al LLM dejan de crecer con cada mensaje del chat.
+
+    Al terminar cada turno también se quitan del historial las imágenes en
+    línea: solo las necesita el turno que las recibe y, si no, se reenviarían
+    como tokens de entrada en todos los siguientes.
+    """
+
+    def __init__(
+            self,
+            max_events: int = SESSION_MAX_EVENTS,
+            keep_turns: int = SESSION_KEEP_TURNS,
+            summary_max_turns: int = SESSION_SUMMARY_MAX_TURNS
+    ):
+        super().__init__()
+        self.max_events = max_events
+        self.keep_turns = keep_turns
+        self.summary_max_turns = summary_max_turns
+        self._sizes: Dict[Tuple[str, str, str], int] = {}
+        self.compactions = 0
+
+    async def append_event(self, session: Session, event: Event) -> Event:
+        event = await super().append_event(session=session, event=event)
+        if event.partial:
+            return event
+
+        key = (session.app_name, session.user_id, session.id)
+        self._sizes[key] = self._sizes.get(key, 0) + _event_size(event)
+
+        # Solo compactamos al cerrar un turno del agente: a mitad de invocación
+        # romperíamos los pares llamada/respuesta de la herramienta.
+        if event.author != "user" and event.is_final_response():
+            storage = self.sessions.get(session.app_name, {}).get(session.user_id, {}).get(session.id)
+            if storage is None:
+                return event
+            changed = self._drop_inline_data(storage)
+            if len(storage.events) > self.max_events:
+                self._compact(storage)
+                changed = True
+            if changed:
+                session.events = list(storage.events)
+                self._sizes[key] = sum(_event_size(e) for e in storage.events)
+        return event
+
+    @staticmethod
+    def _drop_inline_data(storage: Session) -> bool:
+        """Sustituye las imágenes en línea del historial; True si había alguna."""
+        changed = False
+        for index, stored in enumerate(storage.events):
+            if stored.content and stored.content.parts and any(
+                    part.inline_data is not None for part in stored.content.parts
+            ):
+                # Copia, no mutación: el evento original lo comparte la invocación.
+                storage.events[index] = _without_inline_data(stored)
+                changed = True
+        return changed
+
+    def _compact(self, storage: Session) -> None:
+        events = storage.events
+
+        # Índices donde empieza cada turno (mensaje del usuario real).
+        turn_starts = [
+            i for i, e in enumerate(events)
+            if e.author == "user" and e.invocation_id != COMPACTION_INVOCATION_ID
+        ]
+        if len(turn_starts) <= self.keep_turns:
+            return
+        cut = turn_starts[-self.keep_turns] if self.keep_turns else len(events)
+
+        lines: List[str] = []
+        turn: List[Event] = []
+        for event in events[:cut]:
+            if event.invocation_id == COMPACTION_INVOCATION_ID:
+                # Resumen previo: sus líneas se arrastran tal cual.
+                lines.extend(
+                    line for line in _final_text(event).splitlines() if line.startswith("- ")
+                )
+                continue
+            if event.author == "user" and turn:
+                lines.append(summarize_turn(turn))
+                turn = []
+            turn.append(event)
+        if turn:
+            lines.append(summarize_turn(turn))
+        lines = lines[-self.summary_max_turns:]
+
+        summary = Event(
+            author="user",
+            invocation_id=COMPACTION_INVOCATION_ID,
+            timestamp=events[cut - 1].timestamp,
+            content=types.Content(
+                role="user",
+                parts=[types.Part(text="\n".join([_SUMMARY_HEADER] + lines))],
+            ),
+        )
+        storage.events = [summary] + events[cut:]
+        self.compactions += 1
+
+    async def delete_session(self, *, app_name: str, user_id: str, session_id: str) -> None:
+        self._sizes.pop((app_name, user_id, session_id), None)
+        await super().delete_session(app_name=app_name, user_id=user_id, session_id=session_id)
+
+    def memory_usage(self, app_name: str, user_id: str, session_id: str) -> int:
+        """Bytes aproximados que ocupa el historial de una sesión."""
+        return self._sizes.get((app_name, user_id, session_id), 0)
+
+    def total_memory_usage(self) -> int:
+        """Bytes aproximados que ocupan todas las sesiones del worker."""
+        return sum(self._sizes.values())
+
+
+class SessionRegistry:
+    """
+    Sesiones del ADK de larga vida, acotadas en número y con expiración por inactividad.
+
+    Cada chat de Django tiene su propia sesión del agente. Si llega una segunda
+    petición del mismo chat mientras la primera sigue en curso, se atiende en
+    una sesión efímera (que se borra al terminar) para que nunca dos
+    invocaciones escriban en el mismo historial a la vez.
+    """
+
+    def __init__(
+            self,
+            session_service: CompactingSessionService,
+            app_name: str = APP_NAME,
+            max_active: int = SESSION_MAX_ACTIVE,
+            idle_seconds: int = SESSION_IDLE_SECONDS,
+            memory_budget: int = SESSION_MEMORY_BUDGET
+    ):
+        self.session_service = session_service
+        self.app_name = app_name
+        self.max_active = max_active
+        self.idle_seconds = idle_seconds
+        self.memory_budget = memory_budget
+
+        self._last_used: "OrderedDict[_SessionKey, float]" = OrderedDict()
+        self._in_use: Set[_SessionKey] = set()
+        self._lock = threading.Lock()
+        self._stats: Dict[str, int] = {"created": 0, "reused": 0, "expired": 0, "evicted": 0, "ephemeral": 0}
+
+    async def _delete(self, key: _SessionKey) -> None:
+        user_id, session_id = key
+        await self.session_service.delete_session(
+            app_name=self.app_name, user_id=user_id, session_id=session_id
+        )
+
+    async def _expire(self) -> None:
+        """
+        Borra las sesiones inactivas y, si sobran (en número o en memoria),
+        las menos usadas recientemente.
+        """
+        now = time.monotonic()
+        to_delete = []
+        with self._lock:
+            memory = self.session_service.total_memory_usage()
+            for key, last_used in list(self._last_used.items()):
+                if key in self._in_use:
+                    continue
+                if now - last_used > self.idle_seconds:
+                    to_delete.append(key)
+                    self._stats["expired"] += 1
+                elif (
+                        len(self._last_used) - len(to_delete) > self.max_active
+                        or memory > self.memory_budget
+                ):
+                    to_delete.append(key)
+                    self._stats["evicted"] += 1
+                else:
+                    break
+                memory -= self.session_service.memory_usage(self.app_name, *key)
+            for key in to_delete:
+                del self._last_used[key]
+
+        for key in to_delete:
+            await self._delete(key)
+
+    async def _ensure(self, key: _SessionKey) -> None:
+        user_id, session_id = key
+        with self._lock:
+            known = key in self._last_used
+            self._last_used[key] = time.monotonic()
+            self._last_used.move_to_end(key)
+
+        if known:
+            self._stats["reused"] += 1
+            return
+
+        existing = await self.session_service.get_session(
+            app_name=self.app_name, user_id=user_id, session_id=session_id
+        )
+        if existing is None:
+            await self.session_service.create_session(
+                app_name=self.app_name, user_id=user_id, session_id=session_id
+            )
+            self._stats["created"] += 1
+        else:
+            self._stats["reused"] += 1
+
+    @asynccontextmanager
+    async def session(self, user_id: str, session_id: str, ephemeral: bool = False) -> AsyncIterator[str]:
+        """
+        Reserva la sesión (user_id, session_id) mientras dura el bloque `async with`.
+
+        Args:
+            user_id: Usuario del ADK.
+            session_id: Sesión del chat.
+            ephemeral: Si es True, la sesión se borra al salir del bloque
+                (p.ej. cada imagen de un análisis por lote).
+
+        Yields:
+            str: El session_id a usar con el Runner (el original o uno efímero).
+        """
+        key = (user_id, session_id)
+        with self._lock:
+            if key in self._in_use:
+                ephemeral = True
+                key = (user_id, f"{session_id}-{uuid.uuid4().hex[:8]}")
+                self._stats["ephemeral"] += 1
+            self._in_use.add(key)
+
+        try:
+            await self._ensure(key)
+            await self._expire()
+            yield key[1]
+        finally:
+            with self._lock:
+                self._in_use.discard(key)
+                if ephemeral:
+                    self._last_used.pop(key, None)
+            if ephemeral:
+                await self._delete(key)
+
+    def stats(self) -> Dict[str, int]:
+        """Contadores del worker y número de sesiones vivas."""
+        stats = dict(self._stats)
+        stats["active"] = len(self._last_used)
+        stats["in_use"] = len(self._in_use)
+        stats["memory_bytes"] = self.session_service.total_memory_usage()
+        stats["compactions"] = self.session_service.compactions
+        return stats
+
+
+session_registry = SessionRegistry(CompactingSessionService())
@@ -0,0 +1,164 @@
+import io
+import math
+import os
+from typing import BinaryIO, List, NamedTuple, Optional, Tuple, Union
+
+# Third-party imports
+from PIL import Image, ImageOps
+
+from .batching import BATCH_MAX_PAYLOAD_BYTES
+from .preprocessing import PREPROCESS_OPTIMIZE, _to_rgb
+
+
+# --- CONFIGURACIÓN ---
+# Inferencia por teselas: desactivada, el detector recibe la imagen completa.
+TILING_ENABLED = os.environ.get("BAYSAFE_TILING_ENABLED", "False") == "True"
+# Lado de cada tesela en píxeles de la imagen y solape entre teselas vecinas
+# (fracción del lado): un objeto más pequeño que el solape cae entero en alguna.
+TILE_SIZE = int(os.environ.get("BAYSAFE_TILE_SIZE", "640"))
+TILE_OVERLAP = float(os.environ.get("BAYSAFE_TILE_OVERLAP", "0.2"))
+# Teselas máximas por imagen; si la rejilla no cabe, las teselas crecen.
+TILE_MAX_TILES = int(os.environ.get("BAYSAFE_TILE_MAX_TILES", "8"))
+# Enviar además la imagen completa (reducida a TILE_SIZE) para los objetos
+# grandes que ninguna tesela contiene enteros.
+TILE_INCLUDE_FULL = os.environ.get("BAYSAFE_TILE_INCLUDE_FULL", "True") == "True"
+TILE_QUALITY = int(os.environ.get("BAYSAFE_TILE_QUALITY", "85"))
+TILE_MIN_QUALITY = 50
+# Parte de las claves de caché: cambiar la configuración cambia las detecciones.
+TILING_SIGNATURE = (
+    f"{TILE_SIZE}:{TILE_OVERLAP}:{TILE_MAX_TILES}:{TILE_INCLUDE_FULL}" if TILING_ENABLED else "off"
+)
+
+# Región de la imagen que cubre una tesela: (x_min, y_min, x_max, y_max) normalizada.
+Region = Tuple[float, float, float, float]
+FULL_REGION: Region = (0.0, 0.0, 1.0, 1.0)
+
+
+# --- TESELAS ---
+# El detector de AutoML reduce cada instancia a su resolución de entrada, así
+# que en una foto de la sala entera un objeto pequeño (`bateria`, `cadenilla`)
+# queda en unos pocos píxeles. Recortar la imagen en teselas solapadas y
+# predecirlas todas en una sola llamada multiplica la resolución efectiva; las
+# cajas de cada tesela se trasladan a coordenadas de la imagen y se fusionan
+# con la NMS por clase de `postprocessing.py`.
+#
+# Las teselas se recortan del original, no de la copia preprocesada: esa ya
+# está reducida a PREPROCESS_MAX_SIDE y sus objetos pequeños han perdido los
+# píxeles que las teselas deben recuperar. Las regiones son normalizadas, así
+# que las cajas valen igual sobre la copia preprocesada (misma orientación).
+
+class Tile(NamedTuple):
+    """Instancia para el detector: JPEG de una región de la imagen."""
+
+    data: bytes
+    region: Region
+
+
+def tile_grid(
+        width: int,
+        height: int,
+        tile_size: int = TILE_SIZE,
+        overlap: float = TILE_OVERLAP,
+        max_tiles: int = TILE_MAX_TILES
+) -> List[Tuple[int, int, int, int]]:
+    """
+    Rejilla de teselas solapadas (left, top, right, bottom) en píxeles que cubre
+    la imagen. Si hacen falta más de `max_tiles`, el lado de la tesela crece
+    hasta que la rejilla cabe; una sola tesela significa que no hay que teselar.
+    """
+    size = max(1, tile_size)
+    while True:
+        side_x, side_y = min(size, width), min(size, height)
+        stride_x = max(1, int(side_x * (1 - overlap)))
+        stride_y = max(1, int(side_y * (1 - overlap)))
+        columns = 1 + math.ceil(max(0, width - side_x) / stride_x)
+        rows = 1 + math.ceil(max(0, height - side_y) / stride_y)
+        if columns * rows <= max(1, max_tiles):
+            break
+        size = int(size * 1.1) + 1
+
+    # Teselas repartidas uniformemente: la primera y la última tocan los bordes.
+    lefts = [round(i * (width - side_x) / (columns - 1)) if columns > 1 else 0 for i in range(columns)]
+    tops = [round(j * (height - side_y) / (rows - 1)) if rows > 1 else 0 for j in range(rows)]
+    return [(left, top, left + side_x, top + side_y) for top in tops for left in lefts]
+
+
+def _encode(picture: Image.Image, max_bytes: int, quality: int = TILE_QUALITY) -> bytes:
+    while True:
+        buffer = io.BytesIO()
+        # Sin `optimize` por defecto: ver PREPROCESS_OPTIMIZE (GIL retenido).
+        picture.save(buffer, format="JPEG", quality=quality, optimize=PREPROCESS_OPTIMIZE)
+        data = buffer.getvalue()
+        if len(data) <= max_bytes or quality - 10 < TILE_MIN_QUALITY:
+            return data
+        quality -= 10
+
+
+def _decode_side(tile_size: int, max_tiles: int) -> int:
+    # Lado mayor con el que la rejilla de `max_tiles` aún usa teselas de
+    # `tile_size` píxeles reales: decodificar más sería memoria desperdiciada.
+    return tile_size * (math.isqrt(max(1, max_tiles)) + 1)
+
+
+def make_tiles(
+        image: Union[bytes, BinaryIO],
+        tile_size: int = TILE_SIZE,
+        overlap: float = TILE_OVERLAP,
+        max_tiles: int = TILE_MAX_TILES,
+        include_full: bool = TILE_INCLUDE_FULL,
+        max_payload_bytes: int = BATCH_MAX_PAYLOAD_BYTES
+) -> Optional[List[Tile]]:
+    """
+    Recorta la imagen en teselas solapadas (cada una reducida a `tile_size` si
+    la rejilla tuvo que crecer) y, opcionalmente, añade la imagen completa.
+
+    `image` es el original (bytes o archivo binario abierto): se aplica la
+    orientación EXIF, como en el preprocesado, y en JPEG se decodifica
+    directamente a la escala mínima que aún llena la rejilla.
+
+    Todas viajan en una sola llamada `predict`: cada JPEG se recomprime hasta
+    caber en su parte del límite de payload (en base64 ocupa un 33% más).
+
+    Returns:
+        Lista de teselas, o None si la imagen cabe en una sola tesela, no se
+        puede abrir o las teselas no caben en el payload (se predice entera).
+    """
+    if isinstance(image, (bytes, bytearray)):
+        image = io.BytesIO(image)
+    else:
+        image.seek(0)
+
+    try:
+        with Image.open(image) as source:
+            scale = min(1.0, _decode_side(tile_size, max_tiles) / max(source.size))
+            source.draft("RGB", (max(1, int(source.width * scale)), max(1, int(source.height * scale))))
+            picture = _to_rgb(ImageOps.exif_transpose(source))
+            picture.load()
+    except Exception as e:
+        print(f"Error abriendo la imagen para teselar: {e}")
+        return None
+
+    width, height = picture.size
+    boxes = tile_grid(width, height, tile_size, overlap, max_tiles)
+    if len(boxes) <= 1:
+        return None
+
+    regions = [(left / width, top / height, right / width, bottom / height) for left, top, right, bottom in boxes]
+    crops = [picture.crop(box) for box in boxes]
+    if include_full:
+        regions.append(FULL_REGION)
+        crops.append(picture)
+
+    per_tile_bytes = int(max_payload_bytes * 3 / 4 / len(crops))
+    tiles = []
+    for crop, region in zip(crops, regions):
+        if max(crop.size) > tile_size:
+            crop = crop.copy()
+            # BILINEAR: el detector vuelve a reducir la tesela; LANCZOS cuesta el doble.
+            crop.thumbnail((tile_size, tile_size), Image.BILINEAR)
+        tiles.append(Tile(_encode(crop, per_tile_bytes), region))
+
+    if sum(len(tile.data) for tile in tiles) * 4 / 3 > max_payload_bytes:
+        print(f"Teselas omitidas: {len(tiles)} teselas superan el límite de payload")
+        return None
+    return tiles
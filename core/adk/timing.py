@@ -0,0 +1,63 @@
+import contextvars
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+from .metrics import inc, observe
+from .tracing import span
+
+
+# --- TIEMPOS POR ETAPA DE CADA ANÁLISIS ---
+# Cada petición abre su propio registro en una contextvar: lo heredan las tareas
+# que crea el orquestador y los hilos de `run_blocking` (que copian el contexto),
+# así que las etapas que corren en paralelo anotan en el mismo registro.
+SERVER_TIMING_ENABLED = os.environ.get("BAYSAFE_SERVER_TIMING", "True") == "True"
+
+# Etapas instrumentadas, en el orden en que se reportan.
+STAGES = ("preprocess", "upload", "download", "b64", "predict", "llm", "total")
+
+_timings: contextvars.ContextVar[Optional[Dict[str, float]]] = contextvars.ContextVar(
+    "baysafe_stage_timings", default=None
+)
+
+
+def start_stage_timings() -> Dict[str, float]:
+    """Abre el registro de la petición en curso y lo retorna (segundos por etapa)."""
+    timings: Dict[str, float] = {}
+    _timings.set(timings)
+    return timings
+
+
+def record_stage(name: str, seconds: float) -> None:
+    """
+    Suma `seconds` a la etapa `name` (una etapa puede repetirse, p.ej. dos turnos
+    del LLM) y la observa en el histograma de latencias de `/metrics`.
+    """
+    observe("baysafe_stage_duration_seconds", seconds, stage=name)
+    timings = _timings.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds
+
+
+@contextmanager
+def stage_timer(name: str) -> Iterator[None]:
+    """
+    Mide el bloque como la etapa `name` (y como un span de la traza, si la hay);
+    si termina con una excepción, la cuenta como error.
+    """
+    start = time.perf_counter()
+    try:
+        with span(name):
+            yield
+    except Exception:
+        inc("baysafe_stage_errors_total", stage=name)
+        raise
+    finally:
+        record_stage(name, time.perf_counter() - start)
+
+
+def format_server_timing(timings: Dict[str, float]) -> str:
+    """Cabecera `Server-Timing` (milisegundos), p.ej. `predict;dur=151.2, total;dur=180.4`."""
+    names = [name for name in STAGES if name in timings] + sorted(set(timings) - set(STAGES))
+    return ", ".join(f"{name};dur={timings[name] * 1000:.1f}" for name in names)
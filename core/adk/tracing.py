@@ -0,0 +1,373 @@
+import contextvars
+import functools
+import itertools
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+# --- CONFIGURACIÓN ---
+BASE_DIR = Path(__file__).resolve().parent.parent.parent
+
+# Fracción de peticiones que se guardan siempre (0 = ninguna, 1 = todas).
+TRACE_SAMPLE_RATE = float(os.environ.get("BAYSAFE_TRACE_SAMPLE_RATE", "0"))
+# Se guarda toda petición que tarde al menos esto (milisegundos; 0 = desactivado).
+TRACE_SLOW_MS = float(os.environ.get("BAYSAFE_TRACE_SLOW_MS", "0"))
+# Buffer circular en SQLite compartido por los workers: se conservan las últimas N trazas.
+TRACE_DB_PATH = os.environ.get("BAYSAFE_TRACE_DB", str(BASE_DIR / "baysafe_traces.sqlite3"))
+TRACE_MAX_ITEMS = int(os.environ.get("BAYSAFE_TRACE_MAX_ITEMS", "500"))
+
+# Con ambos criterios desactivados no se abre ninguna traza: cada `span` se
+# reduce a leer una contextvar vacía.
+TRACING_ENABLED = TRACE_SAMPLE_RATE > 0 or TRACE_SLOW_MS > 0
+
+
+# --- TRAZA DE LA PETICIÓN EN CURSO ---
+# Igual que los tiempos por etapa (ver `timing.py`), la traza vive en una
+# contextvar: la heredan las tareas del orquestador y los hilos de
+# `run_blocking`, así que los spans que corren en paralelo caen en la misma traza
+# y cuelgan del span que estaba abierto al lanzarlos.
+
+class Trace:
+    """Spans de una petición; los tiempos son relativos a su inicio (segundos)."""
+
+    __slots__ = ("request_id", "name", "started_at", "start", "duration", "sampled", "spans", "_ids")
+
+    def __init__(self, request_id: str, name: str, sampled: bool):
+        self.request_id = request_id
+        self.name = name
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.duration = 0.0
+        self.sampled = sampled
+        # list.append y next() sobre itertools.count son atómicos bajo el GIL:
+        # los hilos del pool anotan sin lock.
+        self.spans: List[Dict[str, Any]] = []
+        self._ids = itertools.count(1)
+
+    def new_id(self) -> int:
+        return next(self._ids)
+
+    def add(self, span_id: int, name: str, start: float, end: float,
+            parent: Optional[int], attrs: Dict[str, Any]) -> None:
+        self.spans.append({
+            "id": span_id,
+            "parent": parent,
+            "name": name,
+            "start": start - self.start,
+            "duration": end - start,
+            "thread": threading.current_thread().name,
+            "attrs": attrs,
+        })
+
+    @property
+    def status(self) -> str:
+        return "error" if any("error" in span["attrs"] for span in self.spans) else "ok"
+
+
+_trace: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar("baysafe_trace", default=None)
+_current: contextvars.ContextVar[Optional["OpenSpan"]] = contextvars.ContextVar(
+    "baysafe_trace_span", default=None
+)
+
+
+class OpenSpan:
+    """Span abierto con `open_span`; se cierra con `close_span`."""
+
+    __slots__ = ("trace", "id", "name", "parent", "attrs", "start", "token")
+
+    def __init__(self, trace: Trace, name: str, attrs: Dict[str, Any]):
+        self.trace = trace
+        self.id = trace.new_id()
+        self.name = name
+        parent = _current.get()
+        self.parent = parent.id if parent is not None else None
+        self.attrs = attrs
+        self.start = time.perf_counter()
+        self.token = _current.set(self)
+
+
+def start_trace(name: str, request_id: Optional[str] = None) -> Optional[Trace]:
+    """
+    Abre la traza de la petición en curso (None si el trazado está desactivado).
+
+    `request_id` permite continuar el id que trae el cliente o el proxy
+    (cabecera X-Request-ID); si no viene, se genera uno.
+    """
+    if not TRACING_ENABLED:
+        return None
+    request_id = (request_id or "").strip()[:64] or uuid.uuid4().hex[:16]
+    trace = Trace(request_id, name, sampled=random.random() < TRACE_SAMPLE_RATE)
+    _trace.set(trace)
+    _current.set(None)
+    return trace
+
+
+def open_span(name: str, **attrs: Any) -> Optional[OpenSpan]:
+    """
+    Abre un span en la traza en curso (None si no hay traza). Los spans que se
+    abran después en este contexto, o en las tareas e hilos que lance, cuelgan de él.
+    """
+    trace = _trace.get()
+    return OpenSpan(trace, name, attrs) if trace is not None else None
+
+
+def close_span(opened: Optional[OpenSpan]) -> None:
+    """Cierra un span de `open_span` y lo añade a su traza."""
+    if opened is None:
+        return
+    opened.trace.add(opened.id, opened.name, opened.start, time.perf_counter(), opened.parent, opened.attrs)
+    try:
+        _current.reset(opened.token)
+    except ValueError:
+        # Generador asíncrono cerrado desde otro contexto: nada que restaurar.
+        pass
+
+
+@contextmanager
+def span(name: str, **attrs: Any) -> Iterator[None]:
+    """
+    Mide el bloque como un span de la traza en curso (no hace nada si no hay
+    traza). Si el bloque lanza una excepción, el span la registra en `error`.
+    """
+    opened = open_span(name, **attrs)
+    if opened is None:
+        yield
+        return
+    try:
+        yield
+    except Exception as e:
+        attrs["error"] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        close_span(opened)
+
+
+def traced(name: str) -> Callable[[Callable[..., T]], Callable[..., T]]:
+    """Decorador: cada llamada a la función (síncrona) es un span `name`."""
+    def decorator(func: Callable[..., T]) -> Callable[..., T]:
+        @functools.wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> T:
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def add_span(name: str, start: float, end: float, **attrs: Any) -> None:
+    """Registra un span ya medido (`start`/`end` de `time.perf_counter()`), p.ej. un evento del ADK."""
+    trace = _trace.get()
+    if trace is not None:
+        parent = _current.get()
+        trace.add(trace.new_id(), name, start, end, parent.id if parent is not None else None, attrs)
+
+
+def annotate(**attrs: Any) -> None:
+    """Añade atributos al span abierto (p.ej. `error=...` cuando el error se captura)."""
+    opened = _current.get()
+    if opened is not None:
+        opened.attrs.update(attrs)
+
+
+def finish_trace(trace: Trace) -> bool:
+    """Cierra la traza y retorna True si debe guardarse (muestreada o lenta)."""
+    trace.duration = time.perf_counter() - trace.start
+    return trace.sampled or (TRACE_SLOW_MS > 0 and trace.duration * 1000 >= TRACE_SLOW_MS)
+
+
+# --- BUFFER CIRCULAR EN SQLITE ---
+
+class TraceStore:
+    """
+    Últimas `max_items` trazas guardadas, compartidas por los workers (SQLite en
+    modo WAL, una conexión por hilo y proceso). Los errores de SQLite nunca se
+    propagan: la traza simplemente no se guarda.
+    """
+
+    def __init__(self, db_path: str = TRACE_DB_PATH, max_items: int = TRACE_MAX_ITEMS):
+        self.db_path = db_path
+        self.max_items = max_items
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+
+        conn = sqlite3.connect(self.db_path, timeout=5.0, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS traces (
+                id          INTEGER PRIMARY KEY AUTOINCREMENT,
+                request_id  TEXT NOT NULL,
+                name        TEXT NOT NULL,
+                started_at  REAL NOT NULL,
+                duration_ms REAL NOT NULL,
+                status      TEXT NOT NULL,
+                spans       TEXT NOT NULL
+            )
+            """
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS traces_request_id ON traces (request_id)")
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def save(self, trace: Trace) -> None:
+        """Guarda la traza y descarta las que exceden el tamaño del buffer."""
+        try:
+            conn = self._connection()
+            cursor = conn.execute(
+                "INSERT INTO traces (request_id, name, started_at, duration_ms, status, spans) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    trace.request_id,
+                    trace.name,
+                    trace.started_at,
+                    trace.duration * 1000,
+                    trace.status,
+                    json.dumps(sorted(trace.spans, key=lambda s: s["start"]), default=str),
+                ),
+            )
+            conn.execute("DELETE FROM traces WHERE id <= ?", (cursor.lastrowid - self.max_items,))
+            print(f"Traza {trace.request_id} guardada ({trace.duration * 1000:.0f} ms, {len(trace.spans)} spans)")
+        except (sqlite3.Error, TypeError) as e:
+            print(f"Error guardando traza {trace.request_id}: {e}")
+
+    def recent(self, limit: int = 100) -> List[Dict[str, Any]]:
+        """Resumen de las últimas trazas, de la más reciente a la más antigua."""
+        try:
+            rows = self._connection().execute(
+                "SELECT request_id, name, started_at, duration_ms, status, spans FROM traces "
+                "ORDER BY id DESC LIMIT ?",
+                (limit,),
+            ).fetchall()
+        except sqlite3.Error as e:
+            print(f"Error leyendo trazas: {e}")
+            return []
+        return [
+            {
+                "request_id": row[0],
+                "name": row[1],
+                "started_at": row[2],
+                "duration_ms": row[3],
+                "status": row[4],
+                "span_count": len(json.loads(row[5])),
+            }
+            for row in rows
+        ]
+
+    def get(self, request_id: str) -> Optional[Dict[str, Any]]:
+        """Traza completa (la más reciente con ese id) o None."""
+        try:
+            row = self._connection().execute(
+                "SELECT request_id, name, started_at, duration_ms, status, spans FROM traces "
+                "WHERE request_id = ? ORDER BY id DESC LIMIT 1",
+                (request_id,),
+            ).fetchone()
+        except sqlite3.Error as e:
+            print(f"Error leyendo traza {request_id}: {e}")
+            return None
+        if row is None:
+            return None
+        return {
+            "request_id": row[0],
+            "name": row[1],
+            "started_at": row[2],
+            "duration_ms": row[3],
+            "status": row[4],
+            "spans": json.loads(row[5]),
+        }
+
+
+trace_store = TraceStore()
+
+
+# --- WATERFALL ---
+
+# Categoría de cada span según su nombre, para ver a simple vista si el tiempo se
+# fue en GCS, Vertex AI o el LLM.
+SPAN_CATEGORIES = {
+    "upload": "gcs",
+    "download": "gcs",
+    "ingest": "gcs",
+    "b64": "vertex",
+    "predict": "vertex",
+    "llm": "llm",
+}
+
+
+def span_category(name: str) -> str:
+    return SPAN_CATEGORIES.get(name.split(":", 1)[0], "app")
+
+
+def build_waterfall(trace: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Filas del waterfall (ordenadas como árbol, con profundidad y posición en %
+    de la duración total) y tiempo por categoría externa (gcs, vertex, llm; los
+    spans anidados dentro de otro de la misma categoría no se cuentan dos veces).
+    """
+    spans = trace["spans"]
+    total = max(trace["duration_ms"] / 1000, max((s["start"] + s["duration"] for s in spans), default=0), 1e-9)
+    by_id = {span_item["id"]: span_item for span_item in spans}
+    children: Dict[Optional[int], List[Dict[str, Any]]] = {}
+    for span_item in spans:
+        parent = span_item["parent"] if span_item["parent"] in by_id else None
+        children.setdefault(parent, []).append(span_item)
+
+    rows: List[Dict[str, Any]] = []
+    categories: Dict[str, float] = {}
+
+    def walk(parent: Optional[int], depth: int, parent_category: Optional[str]) -> None:
+        for span_item in sorted(children.get(parent, []), key=lambda s: s["start"]):
+            category = span_category(span_item["name"])
+            if category != "app" and category != parent_category:
+                categories[category] = categories.get(category, 0.0) + span_item["duration"]
+            rows.append({
+                "name": span_item["name"],
+                "depth": depth,
+                "indent": depth * 14,
+                "category": category,
+                "start_ms": span_item["start"] * 1000,
+                "duration_ms": span_item["duration"] * 1000,
+                "left": span_item["start"] / total * 100,
+                "width": min(max(span_item["duration"] / total * 100, 0.2), 100 - span_item["start"] / total * 100),
+                "thread": span_item["thread"],
+                "attrs": span_item["attrs"],
+                "error": span_item["attrs"].get("error"),
+            })
+            walk(span_item["id"], depth + 1, category)
+
+    # Primera fila: la petición completa.
+    rows.append({
+        "name": trace["name"],
+        "depth": 0,
+        "indent": 0,
+        "category": "app",
+        "start_ms": 0.0,
+        "duration_ms": trace["duration_ms"],
+        "left": 0.0,
+        "width": trace["duration_ms"] / 1000 / total * 100,
+        "thread": "",
+        "attrs": {"request_id": trace["request_id"]},
+        "error": None,
+    })
+    walk(None, 1, None)
+    return {
+        "rows": rows,
+        "categories": sorted(
+            ({"name": name, "ms": seconds * 1000} for name, seconds in categories.items()),
+            key=lambda c: -c["ms"],
+        ),
+    }
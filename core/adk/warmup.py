@@ -0,0 +1,140 @@
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+
+# --- CONFIGURACIÓN ---
+# Calentar el worker al arrancar (asgi.py / wsgi.py). Desactivado, todo se
+# inicializa con la primera petición de análisis.
+WARMUP_ENABLED = os.environ.get("BAYSAFE_WARMUP", "True") == "True"
+# Espera máxima por cada conexión que se abre por adelantado (segundos).
+WARMUP_CONNECT_TIMEOUT = float(os.environ.get("BAYSAFE_WARMUP_CONNECT_TIMEOUT", "10"))
+
+
+# --- ESTADO DEL CALENTAMIENTO (POR WORKER) ---
+# Importar el ADK, Vertex AI y GCS y construir los agentes cuesta segundos y
+# cientos de MB, así que nada de eso ocurre al importar settings ni las vistas:
+# lo hace `warm_up()` en un hilo en cuanto el worker arranca, mientras el
+# endpoint de readiness responde 503 para que el balanceador aún no le envíe
+# tráfico. Si algún paso falla el worker queda en `failed` (también 503) y la
+# siguiente sonda de readiness reintenta el calentamiento.
+
+STATUS_PENDING = "pending"
+STATUS_WARMING = "warming"
+STATUS_READY = "ready"
+STATUS_FAILED = "failed"
+STATUS_DISABLED = "disabled"
+
+_lock = threading.Lock()
+_state: Dict[str, Any] = {}
+_thread: Optional[threading.Thread] = None
+
+
+def _reset_state() -> None:
+    global _lock, _thread
+    _lock = threading.Lock()
+    _thread = None
+    _state.clear()
+    _state.update(status=STATUS_PENDING, steps={}, errors={}, duration_s=None)
+
+
+_reset_state()
+
+if hasattr(os, "register_at_fork"):
+    # Con `gunicorn --preload` la app se carga en el proceso maestro: cada worker
+    # hijo debe calentar sus propios clientes (no sobreviven al fork).
+    os.register_at_fork(after_in_child=_reset_state)
+
+
+def _step(name: str, action: Callable[[], None]) -> None:
+    start = time.perf_counter()
+    try:
+        action()
+    except Exception as e:
+        _state["errors"][name] = f"{type(e).__name__}: {e}"
+        print(f"❌ Calentamiento '{name}' falló: {e}")
+    _state["steps"][name] = round(time.perf_counter() - start, 3)
+
+
+def _warm_agent() -> None:
+    # Importa el ADK y construye los agentes, y crea el Runner de cada pipeline.
+    from . import adk_main
+    for pipeline in (adk_main.AGENT_PIPELINE_DIRECT, adk_main.AGENT_PIPELINE_TOOL):
+        adk_main.get_runner(pipeline)
+
+
+def _warm_storage() -> None:
+    from .adk_main import PROJECT_ID
+    from .backends import get_blob_store
+    get_blob_store(PROJECT_ID).warm_up(WARMUP_CONNECT_TIMEOUT)
+
+
+def _warm_detector() -> None:
+    from .adk_main import ENDPOINT_ID, LOCATION, PROJECT_ID, VERTEX_API_ENDPOINT
+    from .backends import get_detector
+    get_detector(PROJECT_ID, ENDPOINT_ID, LOCATION, VERTEX_API_ENDPOINT).warm_up(WARMUP_CONNECT_TIMEOUT)
+
+
+def _warm_llm() -> None:
+    # Con Gemini, el cliente de google-genai se crea con la primera llamada.
+    from .adk_main import baysafe_report_agent
+    model = baysafe_report_agent.canonical_model
+    if hasattr(model, "api_client"):
+        model.api_client
+
+
+def warm_up() -> Dict[str, Any]:
+    """
+    Calienta el worker (bloqueante): agentes y Runners, cliente de GCS, canal
+    gRPC de Vertex AI y cliente del LLM. Un paso que falla (p.ej. sin red) se
+    registra, no impide los demás y deja el worker en `failed`. Idempotente una
+    vez listo: las llamadas siguientes solo reintentan tras un fallo.
+
+    Returns:
+        dict: Estado final (ver `readiness()`).
+    """
+    with _lock:
+        if _state["status"] == STATUS_READY:
+            return readiness()
+        _state["status"] = STATUS_WARMING
+        _state["steps"], _state["errors"] = {}, {}
+        start = time.perf_counter()
+        _step("agent", _warm_agent)
+        _step("storage", _warm_storage)
+        _step("detector", _warm_detector)
+        _step("llm", _warm_llm)
+        _state["duration_s"] = round(time.perf_counter() - start, 3)
+        _state["status"] = STATUS_FAILED if _state["errors"] else STATUS_READY
+    if _state["errors"]:
+        print(f"❌ Worker {os.getpid()} no está listo: {len(_state['errors'])} paso(s) con error "
+              f"({', '.join(_state['errors'])}); se reintentará con la próxima sonda de /ready")
+    else:
+        print(f"✅ Worker {os.getpid()} listo en {_state['duration_s']:.2f} s")
+    return readiness()
+
+
+def start_warmup() -> None:
+    """
+    Lanza `warm_up()` en un hilo (una vez por worker, o de nuevo si el anterior
+    terminó en `failed`); no hace nada si está desactivado.
+    """
+    global _thread
+    if not WARMUP_ENABLED:
+        return
+    if _thread is not None and (_thread.is_alive() or _state["status"] != STATUS_FAILED):
+        return
+    _thread = threading.Thread(target=warm_up, name="baysafe-warmup", daemon=True)
+    _thread.start()
+
+
+def readiness() -> Dict[str, Any]:
+    """
+    Estado del calentamiento del worker: `pending`, `warming`, `ready`,
+    `failed` (algún paso con error) o `disabled` (sin calentamiento; listo
+    desde el arranque), con el tiempo de cada paso y sus errores.
+    """
+    state = dict(_state, pid=os.getpid())
+    if not WARMUP_ENABLED:
+        state["status"] = STATUS_DISABLED
+    return state
@@ -0,0 +1,1495 @@
+import asyncio
+import contextvars
+import hashlib
+import io
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from unittest import mock
+
+import numpy as np
+from django.contrib.sessions.backends.signed_cookies import SessionStore
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import RequestFactory, SimpleTestCase, override_settings
+from google.adk.events import Event
+from google.adk.models.llm_request import LlmRequest
+from google.genai import types
+from PIL import Image
+
+# adk_main crea los agentes al importarse: necesita un modelo configurado.
+os.environ.setdefault("AGENT_MODEL", "gemini-2.0-flash")
+os.environ.setdefault("BUCKET_NAME", "baysafe-tests")
+# Sin ellos, la herramienta tiene valores por defecto None y el ADK no puede declararla.
+os.environ.setdefault("GOOGLE_CLOUD_PROJECT", "baysafe-tests")
+os.environ.setdefault("GOOGLE_CLOUD_LOCATION", "us-central1")
+os.environ.setdefault("VERTEX_MODEL_ID", "tests")
+
+from core import views  # noqa: E402
+from core.adk import (  # noqa: E402
+    adk_main, backends, batching, ingestion, metrics, near_duplicates, preprocessing, profiling, result_cache, sessions,
+    tiling, tracing, warmup,
+)
+from core.adk.backends import fakes  # noqa: E402
+from core.adk.backends.base import Detector  # noqa: E402
+from core.adk.backends.fakes import FakeDetector, LocalBlobStore  # noqa: E402
+from core.adk.batching import PredictBatcher  # noqa: E402
+from core.adk.blob_cache import BlobCache  # noqa: E402
+from core.adk.hazards import build_report  # noqa: E402
+from core.adk.postprocessing import class_aware_nms, postprocess_predictions  # noqa: E402
+from core.adk.result_cache import TieredCache  # noqa: E402
+
+
+def _jpeg(seed: int, size=(64, 48)) -> bytes:
+    """Una imagen JPEG distinta por semilla."""
+    picture = Image.new("RGB", size, ((seed * 37) % 256, (seed * 91) % 256, (seed * 53) % 256))
+    buffer = io.BytesIO()
+    picture.save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+class _BatteryDetector(Detector):
+    """Detector que siempre ve una batería (un resultado vacío sería un error)."""
+
+    name = "tests"
+
+    def predict(self, image_bytes, parameters):
+        return {"displayNames": ["bateria"], "confidences": [0.9], "bboxes": [[0.1, 0.3, 0.1, 0.3]]}
+
+    def predict_batch(self, images, parameters):
+        return [self.predict(image_bytes, parameters) for image_bytes in images]
+
+
+class _FailingDetector(_BatteryDetector):
+    """Detector cuyo endpoint falla siempre."""
+
+    def predict(self, image_bytes, parameters):
+        raise RuntimeError("endpoint no disponible")
+
+
+@override_settings(BAYSAFE_STORAGE_BACKEND="fake", BAYSAFE_DETECTOR_BACKEND="fake", BAYSAFE_LLM_BACKEND="fake")
+class AnalysisPipelineTests(SimpleTestCase):
+    """Análisis completo con almacenamiento local lento y cachés aisladas."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="baysafe_tests_")
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        db_path = os.path.join(self.tmp, "cache.sqlite3")
+        self.blob_cache = BlobCache(max_items=2)
+        self.store = LocalBlobStore(root=os.path.join(self.tmp, "gcs"), latency_ms=300)
+        patches = {
+            "blob_cache": self.blob_cache,
+            "get_blob_store": lambda project=None: self.store,
+            "get_detector": lambda *args, **kwargs: _BatteryDetector(),
+            "detection_cache": TieredCache("tests-detections", 60, 16, 16, db_path=db_path),
+            "report_cache": TieredCache("tests-reports", 60, 16, 16, db_path=db_path),
+            "NEAR_DUPLICATE_ENABLED": False,
+            "ARCHIVE_ORIGINALS": False,
+            "TILING_ENABLED": False,
+        }
+        for name, value in patches.items():
+            patcher = mock.patch.object(adk_main, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _analyze_all(self, count: int):
+        async def analyze():
+            uploads = [SimpleUploadedFile(f"foto{i}.jpg", _jpeg(i), "image/jpeg") for i in range(count)]
+            return await asyncio.gather(*(
+                adk_main.run_safety_analysis(upload, user_id=f"u{i}", session_id=f"s{i}", mode="fast")
+                for i, upload in enumerate(uploads)
+            ))
+        return asyncio.run(analyze())
+
+    def test_more_concurrent_analyses_than_blob_cache_items(self):
+        reports = self._analyze_all(6)
+
+        self.assertEqual(len(reports), 6)
+        for report in reports:
+            self.assertIn("Batería", report)
+            self.assertIn("NO es segura", report)
+        stats = self.blob_cache.stats()
+        self.assertGreater(stats["rejected"], 0)
+        self.assertEqual(stats["items"], 0)
+        self.assertEqual(stats["uploads"], 0)
+
+    def test_blob_cache_pins_entries_until_discard(self):
+        self.assertTrue(self.blob_cache.put("gs://b/1", b"a"))
+        self.assertTrue(self.blob_cache.put("gs://b/2", b"b"))
+        self.assertFalse(self.blob_cache.put("gs://b/3", b"c"))
+        self.assertEqual(self.blob_cache.get("gs://b/1"), b"a")
+        self.blob_cache.discard("gs://b/1")
+        self.assertTrue(self.blob_cache.put("gs://b/3", b"c"))
+
+    def test_failed_detection_never_reports_safe_zone(self):
+        with mock.patch.object(adk_main, "get_detector", lambda *args, **kwargs: _FailingDetector()):
+            reports = self._analyze_all(2)
+            labels = adk_main._predict_image_object_detection_sync("gs://baysafe-tests/no-existe.jpg")
+
+        for report in reports:
+            self.assertIn("No se pudo analizar", report)
+            self.assertNotIn("parece segura", report)
+            self.assertNotIn("🟢", report)
+        self.assertEqual(labels, [adk_main.DETECTION_ERROR_RESULT])
+
+    def test_tiles_are_cut_from_the_original_not_the_preprocessed_copy(self):
+        produced = []
+
+        def spy(image, *args, **kwargs):
+            tiles = tiling.make_tiles(image, *args, **kwargs)
+            produced.append(tiles)
+            return tiles
+
+        with mock.patch.object(adk_main, "TILING_ENABLED", True), mock.patch.object(adk_main, "make_tiles", spy):
+            async def analyze():
+                upload = SimpleUploadedFile("sala.jpg", _jpeg(1, size=(2560, 1920)), "image/jpeg")
+                return await adk_main.run_safety_analysis(upload, user_id="u", session_id="s", mode="fast")
+            report = asyncio.run(analyze())
+
+        self.assertIn("Batería", report)
+        left, top, right, bottom = tiling.tile_grid(2560, 1920)[0]
+        self.assertEqual(produced[0][0].region, (left / 2560, top / 1920, right / 2560, bottom / 1920))
+        with Image.open(io.BytesIO(produced[0][0].data)) as first_tile:
+            self.assertEqual(max(first_tile.size), tiling.TILE_SIZE)
+
+    def test_undecodable_image_is_analyzed_as_uploaded(self):
+        # Firma JPEG válida pero cuerpo corrupto: el preprocesado no puede abrirla
+        # y se sube y analiza el original tal cual.
+        corrupted = b"\xff\xd8\xff\xe0" + bytes(range(256)) * 4
+        self.assertIsNone(preprocessing.preprocess_image(corrupted))
+
+        async def analyze():
+            upload = SimpleUploadedFile("rota.jpg", corrupted, "image/jpeg")
+            return await adk_main.run_safety_analysis(upload, user_id="u", session_id="s", mode="fast")
+        report = asyncio.run(analyze())
+
+        self.assertIn("Batería", report)
+        uploads = os.path.join(self.tmp, "gcs", "baysafe-tests", "uploads")
+        (name,) = os.listdir(uploads)
+        self.assertTrue(name.endswith(".jpg"))
+        with open(os.path.join(uploads, name), "rb") as uploaded:
+            self.assertEqual(uploaded.read(), corrupted)
+
+
+class WarmupTests(SimpleTestCase):
+    """El readiness del worker no miente si el calentamiento falló."""
+
+    def setUp(self):
+        warmup._reset_state()
+        self.addCleanup(warmup._reset_state)
+        for name in ("_warm_agent", "_warm_storage", "_warm_llm"):
+            patcher = mock.patch.object(warmup, name, lambda: None)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _ready_status(self):
+        with mock.patch.object(views, "start_warmup"):
+            return views.preparado(RequestFactory().get("/ready")).status_code
+
+    def test_failed_step_keeps_worker_not_ready(self):
+        with mock.patch.object(warmup, "_warm_detector", mock.Mock(side_effect=OSError("sin red"))):
+            state = warmup.warm_up()
+
+        self.assertEqual(state["status"], warmup.STATUS_FAILED)
+        self.assertIn("detector", state["errors"])
+        self.assertEqual(self._ready_status(), 503)
+
+    def test_retry_after_failure_becomes_ready(self):
+        with mock.patch.object(warmup, "_warm_detector", mock.Mock(side_effect=OSError("sin red"))):
+            warmup.warm_up()
+        with mock.patch.object(warmup, "_warm_detector", lambda: None):
+            state = warmup.warm_up()
+
+        self.assertEqual(state["status"], warmup.STATUS_READY)
+        self.assertEqual(state["errors"], {})
+        self.assertEqual(self._ready_status(), 200)
+
+
+class _HungPredictionClient:
+    """Cliente de Vertex AI cuyo `predict` no responde hasta que se libera."""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.calls = 0
+
+    def predict(self, endpoint, instances, parameters, timeout=None):
+        self.calls += 1
+        self.release.wait()
+        return type("Response", (), {"predictions": [{"displayNames": []}] * len(instances)})()
+
+
+class PredictBatcherTests(SimpleTestCase):
+    """
+    Plazos del agrupador de `predict`. Un lote lleno se envía al instante: en
+    los tests de errores la espera máxima es amplia para que una máquina
+    cargada no lo parta en dos.
+    """
+
+    def test_hung_predict_fails_every_item_of_its_batch(self):
+        client = _HungPredictionClient()
+        self.addCleanup(client.release.set)
+        batcher = PredictBatcher(max_batch_size=3, max_wait_ms=5, predict_timeout=0.1)
+
+        with mock.patch.object(batching, "BATCH_RESULT_GRACE_S", 0.05):
+            futures = [batcher.submit(client, "endpoint", None, {}, 10) for _ in range(3)]
+            for future in futures:
+                with self.assertRaises(TimeoutError):
+                    batcher.result(future)
+
+        self.assertEqual(client.calls, 1)
+        self.assertEqual(batcher.stats()["timeouts"], 3)
+        # La respuesta tardía se descarta sin errores.
+        client.release.set()
+        self.assertTrue(all(future.cancelled() for future in futures))
+
+    def test_failed_predict_fails_every_item_of_its_batch(self):
+        error = RuntimeError("endpoint no disponible")
+        client = mock.Mock()
+        client.predict.side_effect = error
+        batcher = PredictBatcher(max_batch_size=3, max_wait_ms=1000)
+
+        futures = [batcher.submit(client, "endpoint", None, {}, 10) for _ in range(3)]
+
+        for future in futures:
+            with self.assertRaises(RuntimeError) as raised:
+                batcher.result(future)
+            self.assertIs(raised.exception, error)
+        self.assertEqual(client.predict.call_count, 1)
+        self.assertEqual(batcher.stats()["errors"], 1)
+
+    def test_short_response_fails_the_whole_batch(self):
+        client = mock.Mock()
+        client.predict.return_value = type("Response", (), {"predictions": [{"displayNames": []}]})()
+        batcher = PredictBatcher(max_batch_size=2, max_wait_ms=1000)
+
+        futures = [batcher.submit(client, "endpoint", None, {}, 10) for _ in range(2)]
+
+        for future in futures:
+            with self.assertRaisesRegex(RuntimeError, "1 predicciones para 2 instancias"):
+                batcher.result(future)
+        self.assertEqual(batcher.stats()["errors"], 1)
+
+
+def _noisy_jpeg(size, exif=None) -> bytes:
+    """Una foto de ruido (no se comprime): fuerza el bucle del presupuesto de bytes."""
+    pixels = np.random.default_rng(0).integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format="JPEG", quality=95, **({"exif": exif} if exif else {}))
+    return buffer.getvalue()
+
+
+class PreprocessingTests(SimpleTestCase):
+    """Orientación EXIF, presupuesto de bytes y entradas que Pillow no abre."""
+
+    def _qualities(self, **kwargs):
+        qualities = []
+        original = preprocessing._encode
+
+        def spy(image, image_format, quality):
+            qualities.append((quality, image.size))
+            return original(image, image_format, quality)
+
+        with mock.patch.object(preprocessing, "_encode", spy):
+            prepared = preprocessing.preprocess_image(**kwargs)
+        return prepared, qualities
+
+    def test_exif_orientation_is_applied_and_metadata_dropped(self):
+        exif = Image.Exif()
+        exif[0x0112] = 6  # Rotar 90° en sentido horario al mostrar.
+        exif[0x010F] = "Camara"
+        prepared = preprocessing.preprocess_image(_noisy_jpeg((80, 40), exif=exif))
+
+        self.assertEqual((prepared.width, prepared.height), (40, 80))
+        with Image.open(io.BytesIO(prepared.data)) as result:
+            self.assertEqual(result.size, (40, 80))
+            self.assertEqual(dict(result.getexif()), {})
+
+    def test_image_within_budget_is_encoded_once(self):
+        original = _jpeg(1, size=(2000, 1000))
+        prepared, qualities = self._qualities(image=original, max_side=500)
+
+        self.assertEqual(qualities, [(85, (500, 250))])
+        self.assertEqual(prepared.original_bytes, len(original))
+        self.assertEqual(prepared.content_type, "image/jpeg")
+
+    def test_quality_drops_before_the_resolution(self):
+        prepared, qualities = self._qualities(image=_noisy_jpeg((400, 300)), max_bytes=20_000)
+
+        self.assertEqual(qualities[:4], [(85, (400, 300)), (75, (400, 300)), (65, (400, 300)), (55, (400, 300))])
+        # Sin caber a la calidad mínima: se reduce un 25% y se vuelve a empezar por la inicial.
+        self.assertEqual(qualities[4], (85, (300, 225)))
+        self.assertLessEqual(len(prepared.data), 20_000)
+        self.assertEqual((prepared.width, prepared.height), qualities[-1][1])
+
+    def test_resizing_stops_at_256_pixels(self):
+        prepared, qualities = self._qualities(image=_noisy_jpeg((400, 300)), max_bytes=100)
+
+        # 400 -> 300 -> 225 px: ya no se reduce más y se entrega aunque no quepa.
+        self.assertEqual(sorted({size for _, size in qualities}, reverse=True), [(400, 300), (300, 225), (225, 168)])
+        self.assertEqual((prepared.width, prepared.height), (225, 168))
+        self.assertGreater(len(prepared.data), 100)
+
+    def test_undecodable_input_returns_none(self):
+        self.assertIsNone(preprocessing.preprocess_image(b"no es una imagen"))
+        self.assertIsNone(preprocessing.preprocess_image(io.BytesIO(b"\xff\xd8\xff" + bytes(64))))
+
+
+class IngestionTests(SimpleTestCase):
+    """Ingesta por bloques: límite de tamaño y sin objetos a medias en el almacenamiento."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="baysafe_ingest_")
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        self.store = LocalBlobStore(root=self.tmp, latency_ms=0)
+        patcher = mock.patch.object(ingestion, "get_blob_store", lambda project=None: self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.bucket_dir = os.path.join(self.tmp, "baysafe-tests", "originales")
+
+    def _upload(self, size):
+        # Firma JPEG seguida de relleno: basta para la ingesta, que no decodifica.
+        return SimpleUploadedFile("foto.jpg", b"\xff\xd8\xff\xe0" + b"x" * (size - 4), "image/jpeg")
+
+    def _ingest(self, upload, **kwargs):
+        return ingestion.ingest_upload(
+            upload, "baysafe-tests", "originales/foto.jpg", chunk_size=256 * 1024, **kwargs
+        )
+
+    def test_upload_in_chunks_is_stored_with_its_hash(self):
+        upload = self._upload(600 * 1024)
+        result = self._ingest(upload)
+
+        data = upload.open().read()
+        self.assertEqual(result.sha256, hashlib.sha256(data).hexdigest())
+        self.assertEqual((result.size, result.content_type), (len(data), "image/jpeg"))
+        self.assertEqual(result.gcs_uri, "gs://baysafe-tests/originales/foto.jpg")
+        self.assertEqual(os.listdir(self.bucket_dir), ["foto.jpg"])
+
+    def test_size_limit_raises_and_leaves_no_partial_blob(self):
+        with mock.patch.object(fakes._LocalBlobWriter, "terminate", autospec=True,
+                               side_effect=fakes._LocalBlobWriter.terminate) as terminate:
+            with self.assertRaises(ingestion.IngestionError):
+                self._ingest(self._upload(600 * 1024), max_bytes=300 * 1024)
+
+        terminate.assert_called_once()
+        self.assertEqual(os.listdir(self.bucket_dir), [])
+
+    def test_read_error_mid_upload_terminates_the_writer(self):
+        upload = self._upload(600 * 1024)
+        original_chunks = upload.chunks
+
+        def failing_chunks(chunk_size=None):
+            chunks = original_chunks(chunk_size)
+            yield next(chunks)
+            raise OSError("conexión cortada")
+
+        with mock.patch.object(upload, "chunks", failing_chunks), self.assertRaises(OSError):
+            self._ingest(upload)
+
+        self.assertEqual(os.listdir(self.bucket_dir), [])
+
+    def test_declared_size_and_signature_are_validated_before_reading(self):
+        with self.assertRaises(ingestion.IngestionError):
+            ingestion.validate_upload(self._upload(2048), max_bytes=1024)
+        with self.assertRaises(ingestion.IngestionError):
+            ingestion.validate_upload(SimpleUploadedFile("foto.jpg", b"no es una imagen", "image/jpeg"))
+        with self.assertRaises(ingestion.IngestionError):
+            self._ingest(SimpleUploadedFile("foto.jpg", b"no es una imagen", "image/jpeg"))
+        self.assertFalse(os.path.exists(self.bucket_dir))
+
+
+def _prediction(*boxes):
+    """Predicción de Vertex AI a partir de (etiqueta, confianza, x_min, y_min, x_max, y_max)."""
+    return {
+        "displayNames": [box[0] for box in boxes],
+        "confidences": [box[1] for box in boxes],
+        "bboxes": [[x_min, x_max, y_min, y_max] for _, _, x_min, y_min, x_max, y_max in boxes],
+    }
+
+
+class PostprocessingTests(SimpleTestCase):
+    """Umbral y NMS por clase de las detecciones."""
+
+    def test_empty_input(self):
+        keep = class_aware_nms(np.empty((0, 4), np.float32), np.empty(0, np.float32), np.empty(0, np.intp))
+
+        self.assertEqual(keep.size, 0)
+        self.assertEqual(postprocess_predictions([]), ([], []))
+        self.assertEqual(postprocess_predictions([_prediction()]), ([], []))
+        self.assertEqual(postprocess_predictions([_prediction(("silla", 0.2, 0, 0, 1, 1))]), ([], []))
+
+    def test_single_class_keeps_best_of_each_object(self):
+        detections, labels = postprocess_predictions([_prediction(
+            ("silla", 0.7, 0.10, 0.10, 0.40, 0.40),
+            ("silla", 0.9, 0.11, 0.11, 0.41, 0.41),
+            ("silla", 0.6, 0.60, 0.60, 0.90, 0.90),
+        )])
+
+        self.assertEqual([detection.score for detection in detections], [0.9, 0.6])
+        self.assertEqual(labels, ["silla"])
+
+    def test_identical_boxes_collapse_only_within_a_class(self):
+        box = (0.2, 0.2, 0.5, 0.5)
+        detections, labels = postprocess_predictions([_prediction(
+            ("bateria", 0.8, *box), ("bateria", 0.8, *box), ("bateria", 0.95, *box), ("jarron", 0.7, *box),
+        )])
+
+        self.assertEqual([(d.label, d.score) for d in detections], [("bateria", 0.95), ("jarron", 0.7)])
+        self.assertEqual(labels, ["bateria", "jarron"])
+
+    def test_iou_equal_to_threshold_is_not_suppressed(self):
+        # Intersección 0.125, unión 0.25: IoU exactamente 0.5.
+        prediction = _prediction(("silla", 0.9, 0.0, 0.0, 0.5, 0.5), ("silla", 0.8, 0.0, 0.0, 0.5, 0.25))
+
+        at_threshold, _ = postprocess_predictions([prediction], iou_threshold=0.5)
+        below_threshold, _ = postprocess_predictions([prediction], iou_threshold=0.49)
+
+        self.assertEqual(len(at_threshold), 2)
+        self.assertEqual([detection.score for detection in below_threshold], [0.9])
+
+    def test_detections_without_boxes_keep_best_per_class(self):
+        detections, _ = postprocess_predictions([{
+            "displayNames": ["silla", "silla", "jarron"], "confidences": [0.6, 0.8, 0.7],
+        }])
+
+        self.assertEqual([(d.label, d.score, d.box) for d in detections],
+                         [("silla", 0.8, None), ("jarron", 0.7, None)])
+
+    def test_tile_boxes_are_mapped_to_image_coordinates(self):
+        detections, _ = postprocess_predictions(
+            [_prediction(("bateria", 0.9, 0.0, 0.0, 0.5, 0.5))], regions=[(0.5, 0.5, 1.0, 1.0)]
+        )
+
+        self.assertEqual(detections[0].box, (0.5, 0.5, 0.75, 0.75))
+
+
+class ReportTests(SimpleTestCase):
+    """Informe determinista del modo "fast"."""
+
+    def test_unknown_labels_are_reported_as_safe(self):
+        report = build_report(["peluche_gigante"])
+
+        self.assertIn("🟢 Peluche gigante (SEGURO)", report)
+        self.assertIn("la zona parece segura", report)
+
+    def test_known_hazard_decides_the_verdict_over_unknown_labels(self):
+        report = build_report(["peluche_gigante", "BATERIA"])
+
+        self.assertIn("🔴 Batería (PELIGROSO, riesgo alto)", report)
+        self.assertIn("🟢 Peluche gigante (SEGURO)", report)
+        self.assertIn("NO es segura", report)
+
+    def test_no_labels(self):
+        report = build_report([])
+
+        self.assertTrue(report.startswith("No se detectaron objetos"))
+
+
+class MetricsSnapshotTests(SimpleTestCase):
+    """Las instantáneas de workers terminados no se suman ni se acumulan."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="baysafe_metrics_")
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        patcher = mock.patch.object(metrics, "METRICS_DIR", self.tmp)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _write_snapshot(self, pid: int, value: float) -> str:
+        path = os.path.join(self.tmp, f"{pid}.json")
+        with open(path, "w", encoding="utf-8") as snapshot_file:
+            json.dump({"pid": pid, "values": [["baysafe_analyses_total", [["mode", "dead"]], value]],
+                       "histograms": []}, snapshot_file)
+        return path
+
+    def test_dead_worker_snapshot_is_skipped_and_removed(self):
+        finished = subprocess.Popen([sys.executable, "-c", "pass"])
+        finished.wait()
+        path = self._write_snapshot(finished.pid, 7)
+
+        exported = metrics.render_metrics()
+
+        self.assertNotIn('mode="dead"', exported)
+        self.assertFalse(os.path.exists(path))
+
+    def test_exiting_worker_removes_its_snapshot(self):
+        own = os.path.join(self.tmp, f"{os.getpid()}.json")
+        self.addCleanup(setattr, metrics, "_exiting", False)
+        metrics.flush()
+        self.assertTrue(os.path.exists(own))
+
+        metrics._remove_snapshot()
+        metrics.flush()
+
+        self.assertFalse(os.path.exists(own))
+
+
+class StreamingLifecycleTests(SimpleTestCase):
+    """La traza y el perfil de una respuesta en streaming se cierran aunque el generador no arranque."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="baysafe_stream_")
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        self.store = tracing.TraceStore(db_path=os.path.join(self.tmp, "traces.sqlite3"))
+        patches = [
+            mock.patch.object(tracing, "TRACING_ENABLED", True),
+            mock.patch.object(tracing, "TRACE_SAMPLE_RATE", 1.0),
+            mock.patch.object(views, "trace_store", self.store),
+        ]
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _stream(self, **headers):
+        request = RequestFactory().post("/api/chat/stream/", {"mensaje": "hola"}, headers=headers)
+        return asyncio.run(views.procesar_chat_stream(request))
+
+    def test_disconnect_before_streaming_still_stores_the_trace(self):
+        response = self._stream(**{"X-Request-ID": "desconectado"})
+
+        # El servidor cierra la respuesta sin haber iterado el generador.
+        response.close()
+
+        self.assertEqual(response["X-Request-ID"], "desconectado")
+        self.assertEqual(self.store.get("desconectado")["name"], "procesar_chat_stream")
+
+    def test_trace_is_stored_once_after_streaming(self):
+        response = self._stream(**{"X-Request-ID": "completo"})
+
+        async def consume():
+            return [chunk async for chunk in response]
+        body = b"".join(asyncio.run(consume())).decode()
+        response.close()
+
+        self.assertIn("event: final", body)
+        self.assertEqual(len([t for t in self.store.recent() if t["request_id"] == "completo"]), 1)
+
+    def test_disconnect_before_streaming_releases_the_profile(self):
+        with mock.patch.object(profiling, "PROFILE_TOKEN", "secreto"), \
+                mock.patch.object(profiling, "PROFILE_DIR", self.tmp):
+            response = self._stream(**{"X-Request-ID": "perfilado", profiling.PROFILE_HEADER: "secreto"})
+            self.assertTrue(profiling._active_lock.locked())
+
+            response.close()
+
+        self.assertEqual(response["X-BaySafe-Profile-Id"], "perfilado")
+        self.assertFalse(profiling._active_lock.locked())
+        self.assertTrue(os.path.exists(os.path.join(self.tmp, "perfilado" + profiling.COLLAPSED_SUFFIX)))
+
+
+@override_settings(
+    BAYSAFE_STORAGE_BACKEND="fake", BAYSAFE_DETECTOR_BACKEND="fake", BAYSAFE_LLM_BACKEND="fake",
+    SESSION_ENGINE="django.contrib.sessions.backends.signed_cookies",
+)
+class _FakeBackendsTestCase(SimpleTestCase):
+    """Análisis y vistas del chat con los backends simulados sin latencia y cachés aisladas."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="baysafe_views_")
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        db_path = os.path.join(self.tmp, "cache.sqlite3")
+        patches = {
+            "get_blob_store": lambda project=None: LocalBlobStore(root=os.path.join(self.tmp, "gcs"), latency_ms=0),
+            "get_detector": lambda *args, **kwargs: FakeDetector(latency_ms=0),
+            "detection_cache": TieredCache("tests-detections", 60, 16, 16, db_path=db_path),
+            "report_cache": TieredCache("tests-reports", 60, 16, 16, db_path=db_path),
+            "NEAR_DUPLICATE_ENABLED": False,
+            "ARCHIVE_ORIGINALS": False,
+            "TILING_ENABLED": False,
+        }
+        for name, value in patches.items():
+            patcher = mock.patch.object(adk_main, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _call(self, view, path, data):
+        request = RequestFactory().post(path, data)
+        request.session = SessionStore()
+        return asyncio.run(view(request))
+
+    def _consume(self, response):
+        async def consume():
+            return [chunk async for chunk in response]
+        body = b"".join(asyncio.run(consume())).decode()
+        response.close()
+        return body
+
+
+class StreamingEventsTests(_FakeBackendsTestCase):
+    """El endpoint SSE emite las etapas en orden y su `final` es el JSON de `procesar_chat`."""
+
+    def _post(self, view, path):
+        return self._call(view, path, {
+            "mensaje": "",
+            "tiene_imagen": "True",
+            "modo": "fast",
+            "imagen": SimpleUploadedFile("sala.jpg", _jpeg(3), "image/jpeg"),
+        })
+
+    def _events(self, response):
+        events = []
+        for block in self._consume(response).strip().split("\n\n"):
+            name_line, data_line = block.split("\n")
+            events.append((name_line[len("event: "):], json.loads(data_line[len("data: "):])))
+        return events
+
+    def test_events_arrive_in_pipeline_order(self):
+        response = self._post(views.procesar_chat_stream, "/api/chat/stream/")
+        events = self._events(response)
+
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        self.assertEqual([name for name, _ in events], ["inicio", "subida", "herramienta", "detecciones", "final"])
+        self.assertTrue(events[1][1]["uri"].startswith("gs://baysafe-tests/"))
+        # Modo "fast": el informe final sale de la tabla de riesgos con los objetos emitidos.
+        self.assertEqual(events[-1][1]["respuesta"], build_report(events[3][1]["objetos"]))
+
+    def test_final_event_is_the_json_of_procesar_chat(self):
+        streamed = self._events(self._post(views.procesar_chat_stream, "/api/chat/stream/"))[-1][1]
+        response = self._post(views.procesar_chat, "/api/chat/")
+
+        self.assertEqual(streamed, json.loads(response.content))
+        self.assertEqual(streamed["status"], "ok")
+
+
+def _zip(files) -> io.BytesIO:
+    """Un .zip en memoria con los (nombre, contenido) indicados."""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        for name, data in files:
+            archive.writestr(name, data)
+    buffer.seek(0)
+    buffer.name = "fotos.zip"
+    return buffer
+
+
+class BulkEndpointTests(_FakeBackendsTestCase):
+    """Lote de imágenes en NDJSON y límites del .zip."""
+
+    def _bulk(self, **data):
+        data.setdefault("modo", "fast")
+        return self._call(views.procesar_chat_lote, "/api/chat/lote/", data)
+
+    def _error(self, response):
+        payload = json.loads(response.content)
+        self.assertEqual(payload["status"], "error")
+        return payload["mensaje"]
+
+    def test_ndjson_has_one_line_per_image_and_a_summary(self):
+        archive = _zip([
+            ("fotos/cocina.jpg", _jpeg(2)),
+            ("fotos/.oculta.jpg", _jpeg(3)),
+            ("__MACOSX/fotos/._cocina.jpg", b"x"),
+            ("notas.txt", b"no es una imagen"),
+        ])
+        response = self._bulk(imagenes=[SimpleUploadedFile("sala.jpg", _jpeg(1), "image/jpeg")], zip=archive)
+        lines = [json.loads(line) for line in self._consume(response).splitlines()]
+
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        results, summary = lines[:-1], lines[-1]
+        self.assertEqual(sorted((line["indice"], line["nombre"]) for line in results), [(0, "sala.jpg"), (1, "cocina.jpg")])
+        for line in results:
+            self.assertEqual(line["status"], "ok")
+            self.assertIn("Conclusión", line["respuesta"])
+        self.assertEqual(summary["status"], "fin")
+        self.assertEqual(summary["total"], 2)
+
+    def test_zip_bomb_is_rejected_before_decompressing(self):
+        # 8 MB de ceros se comprimen a unos KB: el límite se aplica al tamaño declarado.
+        archive = _zip([("a.jpg", _jpeg(1)), ("bomba.jpg", bytes(8 * 1024 * 1024))])
+        self.assertLess(len(archive.getvalue()), 64 * 1024)
+        decompressed = []
+        original_read = zipfile.ZipFile.read
+
+        def spy(zip_file, name, *args, **kwargs):
+            decompressed.append(getattr(name, "filename", name))
+            return original_read(zip_file, name, *args, **kwargs)
+
+        with mock.patch.object(views, "BULK_MAX_ZIP_BYTES", 1024 * 1024), \
+                mock.patch.object(zipfile.ZipFile, "read", spy):
+            response = self._bulk(zip=archive)
+
+        self.assertIn("Zip inválido", self._error(response))
+        self.assertEqual(decompressed, ["a.jpg"])
+
+    def test_too_many_images_in_zip_are_rejected(self):
+        archive = _zip([(f"{i}.jpg", _jpeg(i)) for i in range(4)])
+        with mock.patch.object(views, "BULK_MAX_IMAGES", 3):
+            response = self._bulk(zip=archive)
+
+        self.assertIn("Zip inválido", self._error(response))
+
+    def test_too_many_uploaded_images_are_rejected(self):
+        uploads = [SimpleUploadedFile(f"{i}.jpg", _jpeg(i), "image/jpeg") for i in range(4)]
+        with mock.patch.object(views, "BULK_MAX_IMAGES", 3):
+            response = self._bulk(imagenes=uploads)
+
+        self.assertEqual(self._error(response), "Máximo 3 imágenes por lote")
+
+
+class BackendSelectionTests(SimpleTestCase):
+    """Selección de backends desde settings y comportamiento de los dobles."""
+
+    def setUp(self):
+        patcher = mock.patch.object(backends, "_instances", {})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @override_settings(BAYSAFE_STORAGE_BACKEND="fake", BAYSAFE_DETECTOR_BACKEND="FAKE", BAYSAFE_LLM_BACKEND=" fake ")
+    def test_fake_backends_from_settings_are_shared(self):
+        store = backends.get_blob_store("proyecto")
+        detector = backends.get_detector("proyecto", "endpoint", "us-central1", "api")
+        model = backends.get_report_model("gemini-2.0-flash")
+
+        self.assertIsInstance(store, fakes.LocalBlobStore)
+        self.assertIsInstance(detector, fakes.FakeDetector)
+        self.assertIsInstance(model, fakes.CannedLlm)
+        self.assertIs(backends.get_blob_store(), store)
+        self.assertIs(backends.get_detector("otro", "endpoint", "eu", "api"), detector)
+        self.assertEqual(backends.report_model_name(model), "baysafe-canned-llm")
+
+    @override_settings(BAYSAFE_STORAGE_BACKEND="gcp", BAYSAFE_DETECTOR_BACKEND="desconocido", BAYSAFE_LLM_BACKEND="gcp")
+    def test_gcp_is_the_default_for_unknown_values(self):
+        self.assertEqual(backends.storage_backend(), backends.BACKEND_GCP)
+        self.assertEqual(backends.detector_backend(), backends.BACKEND_GCP)
+        self.assertEqual(backends.get_report_model("gemini-2.0-flash"), "gemini-2.0-flash")
+        self.assertEqual(backends.report_model_name("gemini-2.0-flash"), "gemini-2.0-flash")
+
+    def test_fake_detector_is_deterministic(self):
+        parameters = {"confidence_threshold": 0.0, "max_predictions": 5}
+        first = fakes.FakeDetector(latency_ms=0).predict(_jpeg(1), parameters)
+
+        self.assertEqual(fakes.FakeDetector(latency_ms=0, seed=42).predict(_jpeg(1), parameters), first)
+        self.assertEqual(fakes.FakeDetector(latency_ms=0).predict_batch([_jpeg(1), _jpeg(2)], parameters)[0], first)
+        self.assertTrue(set(first["displayNames"]) <= set(fakes.FAKE_DETECTOR_LABELS))
+        self.assertEqual(first["confidences"], sorted(first["confidences"], reverse=True))
+        self.assertEqual(len(first["bboxes"]), len(first["displayNames"]))
+
+    def test_fake_detector_applies_threshold_and_max_predictions(self):
+        detector = fakes.FakeDetector(latency_ms=0)
+        images = [_jpeg(seed) for seed in range(20)]
+        everything = [detector.predict(image, {"confidence_threshold": 0.0}) for image in images]
+        filtered = [detector.predict(image, {"confidence_threshold": 0.7, "max_predictions": 1}) for image in images]
+
+        for full, result in zip(everything, filtered):
+            self.assertLessEqual(len(result["displayNames"]), 1)
+            self.assertTrue(all(confidence >= 0.7 for confidence in result["confidences"]))
+            if result["confidences"]:
+                self.assertEqual(result["confidences"][0], full["confidences"][0])
+
+    def test_error_injection_is_reproducible(self):
+        def outcomes(seed):
+            detector = fakes.FakeDetector(latency_ms=0, error_rate=0.5, seed=seed)
+            results = []
+            for _ in range(40):
+                try:
+                    detector.predict(_jpeg(1), {})
+                    results.append(True)
+                except fakes.FakeBackendError:
+                    results.append(False)
+            return results
+
+        self.assertEqual(outcomes(7), outcomes(7))
+        self.assertIn(True, outcomes(7))
+        self.assertIn(False, outcomes(7))
+        self.assertNotEqual(outcomes(7), outcomes(8))
+        with self.assertRaises(fakes.FakeBackendError):
+            fakes.FakeDetector(latency_ms=0, error_rate=1.0).predict_batch([_jpeg(1), _jpeg(2)], {})
+
+
+class _LabelsDetector(_BatteryDetector):
+    """Detector que devuelve las etiquetas y la confianza indicadas, cada una en su caja."""
+
+    def __init__(self, labels, confidence=0.9):
+        self.labels = labels
+        self.confidence = confidence
+
+    def predict(self, image_bytes, parameters):
+        return {
+            "displayNames": list(self.labels),
+            "confidences": [self.confidence] * len(self.labels),
+            "bboxes": [[0.1 * i, 0.1 * i + 0.05, 0.1 * i, 0.1 * i + 0.05] for i in range(len(self.labels))],
+        }
+
+
+class ReportCacheTests(_FakeBackendsTestCase):
+    """Caché de informes del modo "rich": clave por conjunto de etiquetas y qué no se cachea."""
+
+    def setUp(self):
+        super().setUp()
+        self.agent_calls = []
+        self.complete = True
+
+        async def fake_agent(query, runner, user_id, session_id, streaming=False, attachments=None):
+            self.agent_calls.append(attachments)
+            yield {"evento": "final", "respuesta": f"informe {len(self.agent_calls)}", "completa": self.complete}
+
+        patcher = mock.patch.object(adk_main, "stream_agent_events", fake_agent)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _rich(self, seed, labels, confidence=0.9):
+        async def analyze():
+            upload = SimpleUploadedFile(f"foto{seed}.jpg", _jpeg(seed), "image/jpeg")
+            return await adk_main.run_safety_analysis(upload, user_id="u", session_id="s", mode="rich")
+        with mock.patch.object(adk_main, "get_detector", lambda *args, **kwargs: _LabelsDetector(labels, confidence)):
+            return asyncio.run(analyze())
+
+    def test_key_ignores_label_order_and_duplicates(self):
+        key = result_cache.make_label_set_key(["silla", "mesa_bordes"], version="v1")
+
+        self.assertEqual(key, result_cache.make_label_set_key(["mesa_bordes", "silla", "mesa_bordes"], version="v1"))
+        self.assertNotEqual(key, result_cache.make_label_set_key(["silla", "mesa_bordes"], version="v2"))
+        self.assertNotEqual(key, result_cache.make_label_set_key(["silla"], version="v1"))
+
+    def test_same_label_set_in_another_order_is_served_from_cache(self):
+        first = self._rich(1, ["bateria", "jarron"])
+        second = self._rich(2, ["jarron", "bateria", "jarron"])
+
+        self.assertEqual(first, "informe 1")
+        self.assertEqual(second, "informe 1")
+        self.assertEqual(len(self.agent_calls), 1)
+
+    def test_visual_check_bypasses_the_cache(self):
+        # Confianza entre el mínimo del detector y LLM_IMAGE_SKIP_CONFIDENCE: el LLM ve la imagen.
+        reports = [self._rich(seed, ["bateria"], confidence=0.6) for seed in (1, 2)]
+
+        self.assertEqual(reports, ["informe 1", "informe 2"])
+        self.assertTrue(all(attachments for attachments in self.agent_calls))
+        self.assertIsNone(adk_main.report_cache.get(
+            result_cache.make_label_set_key(["bateria"], version=adk_main.REPORT_VERSION)
+        ))
+
+    def test_incomplete_report_is_not_cached(self):
+        self.complete = False
+        self._rich(1, ["bateria"])
+        self.complete = True
+        second = self._rich(2, ["bateria"])
+        third = self._rich(3, ["bateria"])
+
+        self.assertEqual((second, third), ("informe 2", "informe 2"))
+        self.assertEqual(len(self.agent_calls), 2)
+
+
+class _CountingLlm(fakes.CannedLlm):
+    """CannedLlm sin latencia que guarda cada petición (un turno del LLM)."""
+
+    latency_ms: float = 0
+    requests: list = []
+
+    async def generate_content_async(self, llm_request, stream=False):
+        self.requests.append(llm_request)
+        async for response in super().generate_content_async(llm_request, stream):
+            yield response
+
+
+class AgentPipelineTests(_FakeBackendsTestCase):
+    """Orquestaciones del modo "rich" con el LLM simulado."""
+
+    def setUp(self):
+        super().setUp()
+        self.llm = _CountingLlm()
+        patches = [
+            mock.patch.object(adk_main, "_runners", {}),
+            mock.patch.object(adk_main, "get_detector", lambda *args, **kwargs: _LabelsDetector(["bateria", "silla"])),
+            mock.patch.object(adk_main.baysafe_agent, "model", self.llm),
+            mock.patch.object(adk_main.baysafe_report_agent, "model", self.llm),
+        ]
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _events(self, pipeline):
+        async def analyze():
+            upload = SimpleUploadedFile("sala.jpg", _jpeg(1), "image/jpeg")
+            return [event async for event in adk_main.run_safety_analysis_stream(
+                upload, "u", "s", streaming=False, mode="rich", pipeline=pipeline
+            )]
+        return asyncio.run(analyze())
+
+    def test_direct_pipeline_makes_a_single_llm_turn(self):
+        events = self._events("direct")
+
+        self.assertEqual(len(self.llm.requests), 1)
+        (message,) = [part.text for part in self.llm.requests[0].contents[-1].parts if part.text]
+        self.assertIn(f'{sessions.DETECTIONS_PREFIX} ["bateria", "silla"]', message)
+        self.assertEqual([event["evento"] for event in events], ["subida", "herramienta", "detecciones", "final"])
+        self.assertEqual(events[-1]["respuesta"], build_report(["bateria", "silla"]))
+
+    def test_tool_pipeline_makes_two_llm_turns(self):
+        events = self._events("tool")
+
+        self.assertEqual(len(self.llm.requests), 2)
+        self.assertEqual(events[-1]["respuesta"], build_report(["bateria", "silla"]))
+
+    def test_canned_llm_parses_the_detections_line(self):
+        def request(text):
+            return LlmRequest(contents=[types.Content(role="user", parts=[types.Part(text=text)])])
+
+        query = adk_main.build_detections_query("gs://b/sala.jpg", ["silla", "bateria"])
+        self.assertEqual(fakes._last_labels(request(query)), ["bateria", "silla"])
+        self.assertEqual(fakes._last_labels(request(f"{sessions.DETECTIONS_PREFIX} [no es json")), [])
+        self.assertEqual(fakes._last_labels(request("gs://b/sala.jpg")), [])
+
+
+class TracingTests(SimpleTestCase):
+    """Spans anidados, waterfall, buffer circular y criterio de traza lenta."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="baysafe_traces_")
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        patches = [
+            mock.patch.object(tracing, "TRACING_ENABLED", True),
+            mock.patch.object(tracing, "TRACE_SAMPLE_RATE", 1.0),
+            mock.patch.object(tracing, "TRACE_SLOW_MS", 0),
+        ]
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _trace(self, body, request_id="traza"):
+        # Contexto propio: la traza no se filtra a los demás tests.
+        def run():
+            trace = tracing.start_trace("procesar_chat", request_id)
+            body()
+            tracing.finish_trace(trace)
+            return trace
+        return contextvars.copy_context().run(run)
+
+    def test_waterfall_follows_span_nesting_across_threads(self):
+        def body():
+            with tracing.span("run_safety_analysis"):
+                with tracing.span("ingest"):
+                    # Un hilo lanzado con el contexto copiado (como run_blocking) cuelga del span abierto.
+                    worker = threading.Thread(target=contextvars.copy_context().run, args=(upload,))
+                    worker.start()
+                    worker.join()
+                with tracing.span("llm"):
+                    with tracing.span("llm:stream"):
+                        pass
+            start = time.perf_counter()
+            tracing.add_span("predict", start, start + 0.01)
+
+        def upload():
+            with tracing.span("upload"):
+                pass
+
+        store = tracing.TraceStore(db_path=os.path.join(self.tmp, "traces.sqlite3"))
+        store.save(self._trace(body))
+        waterfall = tracing.build_waterfall(store.get("traza"))
+
+        self.assertEqual(
+            [(row["name"], row["depth"]) for row in waterfall["rows"]],
+            [("procesar_chat", 0), ("run_safety_analysis", 1), ("ingest", 2), ("upload", 3),
+             ("llm", 2), ("llm:stream", 3), ("predict", 1)],
+        )
+        self.assertEqual(waterfall["rows"][3]["category"], "gcs")
+        by_name = {row["name"]: row for row in waterfall["rows"]}
+        categories = {category["name"]: category["ms"] for category in waterfall["categories"]}
+        # "upload" (gcs) dentro de "ingest" (gcs) y "llm:stream" dentro de "llm" no se cuentan dos veces.
+        self.assertAlmostEqual(categories["gcs"], by_name["ingest"]["duration_ms"])
+        self.assertAlmostEqual(categories["llm"], by_name["llm"]["duration_ms"])
+        self.assertAlmostEqual(categories["vertex"], by_name["predict"]["duration_ms"])
+
+    def test_span_with_unknown_parent_is_shown_at_the_root(self):
+        trace = {
+            "request_id": "r", "name": "procesar_chat", "duration_ms": 10.0,
+            "spans": [{"id": 2, "parent": 99, "name": "predict", "start": 0.001, "duration": 0.002,
+                       "thread": "t", "attrs": {"error": "Timeout"}}],
+        }
+        rows = tracing.build_waterfall(trace)["rows"]
+
+        self.assertEqual([(row["name"], row["depth"]) for row in rows], [("procesar_chat", 0), ("predict", 1)])
+        self.assertEqual(rows[1]["error"], "Timeout")
+
+    def test_ring_buffer_keeps_the_last_traces(self):
+        store = tracing.TraceStore(db_path=os.path.join(self.tmp, "traces.sqlite3"), max_items=3)
+        for number in range(5):
+            store.save(self._trace(lambda: None, request_id=f"t{number}"))
+
+        self.assertEqual([trace["request_id"] for trace in store.recent()], ["t4", "t3", "t2"])
+        self.assertIsNone(store.get("t1"))
+        self.assertEqual(store.get("t2")["name"], "procesar_chat")
+
+    def test_only_slow_traces_are_kept_when_not_sampled(self):
+        with mock.patch.object(tracing, "TRACE_SAMPLE_RATE", 0), mock.patch.object(tracing, "TRACE_SLOW_MS", 50):
+            fast = tracing.start_trace("procesar_chat")
+            slow = tracing.start_trace("procesar_chat")
+            slow.start -= 0.2
+
+            self.assertFalse(fast.sampled)
+            self.assertFalse(tracing.finish_trace(fast))
+            self.assertTrue(tracing.finish_trace(slow))
+            self.assertGreaterEqual(slow.duration, 0.2)
+
+        with mock.patch.object(tracing, "TRACING_ENABLED", False):
+            self.assertIsNone(tracing.start_trace("procesar_chat"))
+
+
+class ProfilingTests(SimpleTestCase):
+    """Activación de perfiles, nombres de archivo servidos y liberación del lock."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="baysafe_profiles_")
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        self.profile_dir = os.path.join(self.tmp, "perfiles")
+        os.makedirs(self.profile_dir)
+        patches = [
+            mock.patch.object(profiling, "PROFILE_DIR", self.profile_dir),
+            mock.patch.object(profiling, "_ARMED_FLAG", os.path.join(self.profile_dir, "armed")),
+            mock.patch.object(profiling, "_ARM_DB", os.path.join(self.profile_dir, "armed.sqlite3")),
+            mock.patch.object(profiling, "PROFILE_TOKEN", "secreto"),
+        ]
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_armed_requests_count_down_and_remove_the_flag(self):
+        self.assertFalse(profiling._take_armed())
+        profiling.arm_profiling(2)
+        self.assertTrue(os.path.exists(profiling._ARMED_FLAG))
+
+        self.assertTrue(profiling._take_armed())
+        self.assertEqual(profiling.armed_remaining(), 1)
+        self.assertTrue(os.path.exists(profiling._ARMED_FLAG))
+        self.assertTrue(profiling._take_armed())
+
+        self.assertFalse(os.path.exists(profiling._ARMED_FLAG))
+        self.assertEqual(profiling.armed_remaining(), 0)
+        self.assertFalse(profiling._take_armed())
+
+    def test_arming_zero_cancels_pending_requests(self):
+        profiling.arm_profiling(5)
+        profiling.arm_profiling(0)
+
+        self.assertFalse(os.path.exists(profiling._ARMED_FLAG))
+        self.assertFalse(profiling.profiling_requested(None))
+        self.assertFalse(profiling.profiling_requested("otro"))
+        self.assertTrue(profiling.profiling_requested(" secreto "))
+
+    def test_profile_file_path_rejects_traversal(self):
+        outside = os.path.join(self.tmp, "fuera.collapsed.txt")
+        inside = os.path.join(self.profile_dir, "p1.collapsed.txt")
+        for path in (outside, inside):
+            with open(path, "w") as profile_file:
+                profile_file.write("main 1\n")
+
+        self.assertEqual(profiling.profile_file_path("p1.collapsed.txt"), inside)
+        self.assertIsNone(profiling.profile_file_path("../fuera.collapsed.txt"))
+        self.assertIsNone(profiling.profile_file_path(outside))
+        self.assertIsNone(profiling.profile_file_path("..%2Ffuera.collapsed.txt"))
+        self.assertIsNone(profiling.profile_file_path("armed.sqlite3"))
+        self.assertIsNone(profiling.profile_file_path("p2.collapsed.txt"))
+
+    def test_lock_is_released_on_finish_even_if_stop_fails(self):
+        profile = profiling.start_profile("../otro/perfil")
+        self.assertNotIn("/", profile.profile_id)
+        self.assertIsNone(profiling.start_profile("segundo"))
+
+        files = profiling.finish_profile(profile)
+        self.assertFalse(profiling._active_lock.locked())
+        self.assertTrue(all(os.path.dirname(path) == self.profile_dir for path in files.values()))
+
+        failing = profiling.start_profile("fallido")
+        with mock.patch.object(failing, "stop", side_effect=RuntimeError("disco lleno")), \
+                self.assertRaises(RuntimeError):
+            profiling.finish_profile(failing)
+        self.assertFalse(profiling._active_lock.locked())
+        failing.stop()
+
+
+def _textured_jpeg(seed: int, size=(320, 240), quality=90) -> bytes:
+    """Foto con estructura (formas nítidas de alto contraste), distinta por semilla."""
+    rng = np.random.default_rng(seed)
+    pixels = np.kron(rng.integers(0, 256, (6, 8), dtype=np.uint8), np.ones((size[1] // 6, size[0] // 8), np.uint8))
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).convert("RGB").save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+class MultiIndexHashIndexTests(SimpleTestCase):
+    """Búsqueda por distancia de Hamming del índice multi-índice."""
+
+    def _flip(self, value, *bits):
+        for bit in bits:
+            value ^= 1 << bit
+        return value
+
+    def test_finds_neighbours_up_to_max_distance(self):
+        index = near_duplicates.MultiIndexHashIndex(max_distance=4)
+        stored = 0x0123456789ABCDEF
+        index.add(stored, ["silla"])
+
+        self.assertEqual(index.query(stored), (0, ["silla"]))
+        # Los 4 bits invertidos caen en segmentos distintos o en el mismo.
+        self.assertEqual(index.query(self._flip(stored, 0, 17, 33, 63)), (4, ["silla"]))
+        self.assertEqual(index.query(self._flip(stored, 0, 1, 2, 3)), (4, ["silla"]))
+        self.assertIsNone(index.query(self._flip(stored, 0, 13, 26, 39, 52)))
+        self.assertIsNone(index.query(self._flip(stored, 0, 17, 33), max_distance=2))
+
+    def test_returns_the_closest_match(self):
+        index = near_duplicates.MultiIndexHashIndex(max_distance=4)
+        index.add(self._flip(0xFFFF0000FFFF0000, 1, 2, 3), ["lejos"])
+        index.add(self._flip(0xFFFF0000FFFF0000, 40), ["cerca"])
+
+        self.assertEqual(index.query(0xFFFF0000FFFF0000), (1, ["cerca"]))
+        self.assertEqual(len(index), 2)
+
+
+class NearDuplicateHashTests(SimpleTestCase):
+    """dHash y filtro de fotos sin contraste."""
+
+    def test_recompressed_and_resized_copy_stays_close(self):
+        original = near_duplicates.dhash(_textured_jpeg(1))
+        copy = near_duplicates.dhash(_textured_jpeg(1, size=(160, 120), quality=60))
+
+        self.assertLessEqual((original ^ copy).bit_count(), near_duplicates.NEAR_DUPLICATE_MAX_DISTANCE)
+        self.assertGreater((original ^ near_duplicates.dhash(_textured_jpeg(2))).bit_count(), 8)
+
+    def test_flat_and_dark_photos_are_not_distinctive(self):
+        value, contrast_bits = near_duplicates.dhash_with_contrast(_jpeg(3, size=(320, 240)))
+        dark = Image.effect_noise((320, 240), 2).point(lambda level: level // 16).convert("RGB")
+        buffer = io.BytesIO()
+        dark.save(buffer, format="JPEG")
+
+        self.assertEqual(contrast_bits, 0)
+        self.assertEqual(value, 0)
+        self.assertIsNone(near_duplicates.distinctive_hash(_jpeg(3, size=(320, 240))))
+        self.assertIsNone(near_duplicates.distinctive_hash(buffer.getvalue()))
+        self.assertIsNotNone(near_duplicates.distinctive_hash(_textured_jpeg(1)))
+
+
+class NearDuplicateStoreTests(SimpleTestCase):
+    """Índice de casi-duplicados por worker sincronizado con SQLite."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="baysafe_near_")
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        self.store = near_duplicates.NearDuplicateStore(db_path=os.path.join(self.tmp, "cache.sqlite3"))
+
+    def test_lookup_finds_added_hash_in_its_namespace_only(self):
+        self.assertIsNone(self.store.lookup(0xF0F0F0F0F0F0F0F0, "vertex"))
+
+        self.store.add(0xF0F0F0F0F0F0F0F0, "vertex", ["bateria", "silla"])
+
+        self.assertEqual(self.store.lookup(0xF0F0F0F0F0F0F0F1, "vertex"), ["bateria", "silla"])
+        self.assertIsNone(self.store.lookup(0xF0F0F0F0F0F0F0F0, "fake"))
+        self.assertEqual(self.store.stats(), {"hits": 1, "misses": 2, "errors": 0, "items": 1})
+
+    def test_other_workers_rows_are_loaded_with_unsigned_hashes(self):
+        other = near_duplicates.NearDuplicateStore(db_path=self.store.db_path)
+        other.add(0xFFFFFFFFFFFFFFFF, "vertex", [])
+
+        self.assertEqual(self.store.lookup(0xFFFFFFFFFFFFFFFF, "vertex"), [])
+
+    def test_index_over_max_items_is_rebuilt_with_recent_half(self):
+        store = near_duplicates.NearDuplicateStore(db_path=self.store.db_path, max_items=10)
+        for value in range(11):
+            store.add(value << 48 | 0x00FF00FF00FF, "vertex", [f"objeto{value}"])
+
+        self.assertIsNone(store.lookup(0, "vertex"))
+        self.assertEqual(store.stats()["items"], 0)
+        # La siguiente sincronización carga solo las filas más recientes.
+        self.assertEqual(store.lookup(10 << 48 | 0x00FF00FF00FF, "vertex"), ["objeto10"])
+        self.assertEqual(store.stats()["items"], 5)
+
+    def test_sync_racing_with_a_new_row_adds_each_row_once(self):
+        for value in range(50):
+            self.store.add(value << 40 | 0x5A5A5A5A, "ns", ["silla"])
+        selecting = threading.Event()
+        connection = self.store._connection
+
+        class SlowSelect:
+            """Conexión cuyo SELECT tarda: deja a otro hilo sincronizar a la vez."""
+
+            def __init__(self, conn):
+                self.conn = conn
+
+            def execute(self, sql, params=()):
+                if sql.lstrip().startswith("SELECT"):
+                    selecting.set()
+                    time.sleep(0.2)
+                return self.conn.execute(sql, params)
+
+        self.store._connection = lambda: SlowSelect(connection())
+        first = threading.Thread(target=self.store._sync)
+        first.start()
+        selecting.wait(5)
+        # Otro hilo guarda un hash (fuerza la próxima sincronización) y consulta.
+        self.store.add(0xFFFF << 40, "ns", ["jarron"])
+        self.store._sync()
+        first.join()
+
+        self.assertEqual(self.store.stats()["items"], 51)
+
+
+def _user_event(invocation_id, text, *extra_parts):
+    return Event(author="user", invocation_id=invocation_id,
+                 content=types.Content(role="user", parts=[types.Part(text=text), *extra_parts]))
+
+
+def _agent_event(invocation_id, *parts):
+    return Event(author="baysafe", invocation_id=invocation_id, content=types.Content(role="model", parts=list(parts)))
+
+
+class CompactingSessionServiceTests(SimpleTestCase):
+    """Historial acotado de las sesiones del agente."""
+
+    def _session(self, service):
+        return asyncio.run(service.create_session(app_name="agents", user_id="u", session_id="s"))
+
+    def _stored(self, service):
+        return asyncio.run(service.get_session(app_name="agents", user_id="u", session_id="s")).events
+
+    def test_inline_image_is_dropped_from_history_after_the_turn(self):
+        service = sessions.CompactingSessionService()
+        session = self._session(service)
+        image = types.Part.from_bytes(data=b"\xff\xd8" + b"x" * 5000, mime_type="image/jpeg")
+
+        async def turn():
+            await service.append_event(session, _user_event("i1", "gs://b/foto.jpg", image))
+            during = service.sessions["agents"]["u"]["s"].events[0].content.parts[1].inline_data
+            await service.append_event(session, _agent_event("i1", types.Part(text="Informe")))
+            return during
+
+        # Durante el turno el LLM todavía la recibe.
+        self.assertIsNotNone(asyncio.run(turn()))
+        user_parts = self._stored(service)[0].content.parts
+        self.assertEqual([part.text for part in user_parts], ["gs://b/foto.jpg", sessions.INLINE_IMAGE_PLACEHOLDER])
+        self.assertTrue(all(part.inline_data is None for part in user_parts))
+        self.assertLess(service.memory_usage("agents", "u", "s"), 1000)
+
+
+    def _turn(self, service, session, number, labels):
+        """Un análisis en modo "tool": mensaje, llamada a la herramienta, su respuesta e informe."""
+        invocation = f"i{number}"
+        call_id = f"call-{number}"
+        tool = sessions.DETECTION_TOOL_NAME
+
+        async def append():
+            await service.append_event(session, _user_event(invocation, f"gs://b/foto{number}.jpg"))
+            await service.append_event(session, _agent_event(
+                invocation, types.Part(function_call=types.FunctionCall(id=call_id, name=tool, args={}))))
+            await service.append_event(session, _agent_event(invocation, types.Part(
+                function_response=types.FunctionResponse(id=call_id, name=tool, response={"result": labels}))))
+            await service.append_event(session, _agent_event(invocation, types.Part(text=f"Informe {number}")))
+        asyncio.run(append())
+
+    def test_no_compaction_below_the_event_threshold(self):
+        service = sessions.CompactingSessionService(max_events=8, keep_turns=1)
+        session = self._session(service)
+
+        for number in range(2):
+            self._turn(service, session, number, ["silla"])
+
+        self.assertEqual(len(self._stored(service)), 8)
+        self.assertEqual(service.compactions, 0)
+
+    def test_compaction_keeps_last_turns_and_summarizes_the_rest(self):
+        service = sessions.CompactingSessionService(max_events=6, keep_turns=2)
+        session = self._session(service)
+
+        for number in range(3):
+            self._turn(service, session, number, ["bateria", "silla"] if number == 0 else ["jarron"])
+
+        events = self._stored(service)
+        self.assertEqual(service.compactions, 1)
+        self.assertEqual(events[0].invocation_id, sessions.COMPACTION_INVOCATION_ID)
+        self.assertIn("- Objetos detectados: bateria, silla. Veredicto: Informe 0", events[0].content.parts[0].text)
+        self.assertEqual([e.invocation_id for e in events[1:]], ["i1"] * 4 + ["i2"] * 4)
+        self.assertEqual(session.events, events)
+
+    def test_compaction_never_splits_a_tool_call_from_its_response(self):
+        service = sessions.CompactingSessionService(max_events=5, keep_turns=1)
+        session = self._session(service)
+
+        for number in range(5):
+            self._turn(service, session, number, ["silla"])
+
+        events = self._stored(service)
+        calls = [call.id for event in events for call in event.get_function_calls()]
+        responses = [response.id for event in events for response in event.get_function_responses()]
+        self.assertEqual(calls, responses)
+        self.assertEqual(calls, ["call-4"])
+        # Los resúmenes anteriores se arrastran: una línea por turno compactado.
+        self.assertEqual(events[0].content.parts[0].text.count("\n- "), 4)
+
+class SessionRegistryTests(SimpleTestCase):
+    """Sesiones del agente acotadas por inactividad, número y memoria."""
+
+    def setUp(self):
+        patcher = mock.patch.object(sessions, "time")
+        self.clock = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.clock.monotonic.return_value = 0.0
+        self.service = sessions.CompactingSessionService()
+
+    def _registry(self, **limits):
+        return sessions.SessionRegistry(self.service, **{"idle_seconds": 60, **limits})
+
+    def _use(self, registry, session_id, ephemeral=False, text=None):
+        """Un turno en la sesión; `text` se guarda en su historial (ocupa memoria)."""
+        async def use():
+            async with registry.session("u", session_id, ephemeral) as active_id:
+                if text is not None:
+                    stored = await self.service.get_session(app_name="agents", user_id="u", session_id=active_id)
+                    await self.service.append_event(stored, _user_event("i", text))
+                return active_id
+        return asyncio.run(use())
+
+    def _exists(self, session_id):
+        return asyncio.run(self.service.get_session(app_name="agents", user_id="u", session_id=session_id)) is not None
+
+    def _exists_in(self, session_id):
+        """Como `_exists`, desde dentro de un event loop."""
+        return session_id in self.service.sessions.get("agents", {}).get("u", {})
+
+    def test_idle_sessions_expire(self):
+        registry = self._registry(idle_seconds=10)
+        self._use(registry, "vieja")
+        self.clock.monotonic.return_value = 5.0
+        self._use(registry, "reciente")
+
+        self.clock.monotonic.return_value = 12.0
+        self._use(registry, "nueva")
+
+        self.assertFalse(self._exists("vieja"))
+        self.assertTrue(self._exists("reciente"))
+        self.assertEqual(registry.stats()["expired"], 1)
+        self.assertEqual(registry.stats()["active"], 2)
+
+    def test_least_recently_used_is_evicted_over_the_memory_budget(self):
+        registry = self._registry(memory_budget=3000)
+        self._use(registry, "a", text="x" * 2000)
+        self._use(registry, "b", text="x" * 2000)
+
+        self._use(registry, "c")
+
+        self.assertFalse(self._exists("a"))
+        self.assertTrue(self._exists("b"))
+        self.assertEqual(registry.stats()["evicted"], 1)
+        self.assertEqual(registry.stats()["memory_bytes"], 2000)
+
+    def test_least_recently_used_is_evicted_over_max_active(self):
+        registry = self._registry(max_active=2)
+        for session_id in ("a", "b"):
+            self._use(registry, session_id)
+        self._use(registry, "a")
+
+        self._use(registry, "c")
+
+        self.assertEqual([self._exists(session_id) for session_id in ("a", "b", "c")], [True, False, True])
+
+    def test_ephemeral_sessions_are_deleted_on_exit(self):
+        registry = self._registry()
+
+        active_id = self._use(registry, "lote-0", ephemeral=True, text="informe")
+
+        self.assertEqual(active_id, "lote-0")
+        self.assertFalse(self._exists("lote-0"))
+        self.assertEqual(registry.stats()["active"], 0)
+        self.assertEqual(registry.stats()["memory_bytes"], 0)
+
+    def test_concurrent_turn_of_the_same_chat_uses_a_throwaway_session(self):
+        registry = self._registry()
+
+        async def overlapping():
+            async with registry.session("u", "chat") as first:
+                async with registry.session("u", "chat") as second:
+                    self.assertTrue(self._exists_in(second))
+                return first, second
+        first, second = asyncio.run(overlapping())
+
+        self.assertEqual(first, "chat")
+        self.assertTrue(second.startswith("chat-"))
+        self.assertTrue(self._exists("chat"))
+        self.assertFalse(self._exists(second))
+        self.assertEqual(registry.stats()["ephemeral"], 1)
+        self.assertEqual(registry.stats()["in_use"], 0)
+
+class TieredCacheTests(SimpleTestCase):
+    """Caché de dos niveles: LRU en memoria por worker y SQLite compartido."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="baysafe_cache_")
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        self.db_path = os.path.join(self.tmp, "cache.sqlite3")
+        patcher = mock.patch.object(result_cache, "time")
+        self.clock = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.clock.time.return_value = 1000.0
+
+    def _cache(self, namespace="tests", ttl=60, memory_items=2, disk_items=10):
+        return TieredCache(namespace, ttl, memory_items, disk_items, db_path=self.db_path)
+
+    def _disk_keys(self, namespace="tests"):
+        conn = sqlite3.connect(self.db_path)
+        self.addCleanup(conn.close)
+        return {row[0] for row in conn.execute("SELECT key FROM cache_entries WHERE namespace = ?", (namespace,))}
+
+    def test_memory_lru_evicts_least_recently_used(self):
+        cache = self._cache()
+        cache.set("a", 1)
+        cache.set("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+
+        cache.set("c", 3)
+
+        self.assertEqual(list(cache._memory), ["a", "c"])
+        self.assertEqual(cache.stats()["memory_items"], 2)
+        # Lo expulsado de memoria sigue en disco.
+        self.assertEqual(cache.get("b"), 2)
+        self.assertEqual(cache.stats()["disk_hits"], 1)
+
+    def test_disk_hit_from_another_worker_is_promoted_to_memory(self):
+        self._cache().set("clave", {"labels": ["silla"]})
+        other_worker = self._cache()
+
+        self.assertEqual(other_worker.get("clave"), {"labels": ["silla"]})
+        self.assertEqual(other_worker.get("clave"), {"labels": ["silla"]})
+
+        stats = other_worker.stats()
+        self.assertEqual((stats["disk_hits"], stats["memory_hits"], stats["misses"]), (1, 1, 0))
+        self.assertEqual(stats["hit_rate"], 1.0)
+
+    def test_expired_entries_miss_in_both_levels(self):
+        cache = self._cache(ttl=10)
+        cache.set("clave", "valor")
+        other_worker = self._cache(ttl=10)
+
+        self.clock.time.return_value = 1010.0
+
+        self.assertIsNone(cache.get("clave"))
+        self.assertIsNone(other_worker.get("clave"))
+        self.assertEqual(cache.stats()["memory_items"], 0)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def test_prune_drops_expired_then_least_recently_accessed(self):
+        cache = self._cache(ttl=100, disk_items=2)
+        for offset, key in enumerate(("vieja", "a", "b", "c")):
+            self.clock.time.return_value = 1000.0 + offset
+            cache.set(key, key)
+        cache._memory.clear()
+        # "vieja" expira; "a" se lee y pasa a ser la más reciente.
+        self.clock.time.return_value = 1100.5
+        self.assertEqual(cache.get("a"), "a")
+
+        cache.prune()
+
+        self.assertEqual(self._disk_keys(), {"a", "c"})
+
+    def test_namespaces_are_isolated_and_clear_only_its_own(self):
+        detections, reports = self._cache("detections"), self._cache("reports")
+        detections.set("clave", "deteccion")
+        reports.set("clave", "informe")
+
+        reports.clear()
+
+        self.assertIsNone(reports.get("clave"))
+        self.assertEqual(self._cache("detections").get("clave"), "deteccion")
+
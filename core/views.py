@@ -1,33 +1,74 @@
-import asyncio
+import mimetypes
 import os
+import threading
+import time
+import zipfile
+from datetime import datetime
 
-from django.shortcuts import render
-from django.http import JsonResponse
+from django.contrib.admin.views.decorators import staff_member_required
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.shortcuts import redirect, render
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils import timezone
 from django.views.decorators.csrf import csrf_exempt
-from .adk.adk_main import run_safety_analysis
+from .adk.executor import run_blocking
+from .adk.metrics import METRICS_ENABLED, render_metrics
+from .adk.profiling import (
+    PROFILE_HEADER,
+    arm_profiling,
+    armed_remaining,
+    finish_profile,
+    list_profiles,
+    profile_file_path,
+    profiling_requested,
+    start_profile,
+)
+from .adk.timing import SERVER_TIMING_ENABLED, format_server_timing, start_stage_timings
+from .adk.tracing import build_waterfall, finish_trace, start_trace, trace_store
+from .adk.warmup import readiness, start_warmup
 import json
 
+# Límites del análisis por lote
+BULK_MAX_IMAGES = int(os.environ.get("BAYSAFE_BULK_MAX_IMAGES", "100"))
+BULK_MAX_ZIP_BYTES = int(os.environ.get("BAYSAFE_BULK_MAX_ZIP_BYTES", str(200 * 1024 * 1024)))
+BULK_IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".gif"}
+
 
 # --- AGENTE VERTEX AI (PLACEHOLDER) ---
-def agente_vertex_ai(imagen_presente, texto_usuario, imagen=None):
+async def agente_vertex_ai(imagen_presente, texto_usuario, imagen=None, session_key=None, modo=None):
     """
     Simulación del agente IA.
+
+    `session_key` es la clave de la sesión de Django: de ella se derivan el
+    usuario y la sesión del agente, de modo que cada chat tiene su propio
+    historial y los análisis concurrentes de distintos usuarios no chocan.
+
+    `modo` elige el informe: "fast" (tabla de riesgos, sin LLM) o "rich"
+    (redactado por el agente); por defecto BAYSAFE_REPORT_MODE.
+
+    Es una corrutina: bajo ASGI se ejecuta en el event loop del worker, sin
+    crear un loop nuevo ni bloquear un hilo mientras esperamos a Vertex y al LLM.
     """
     if imagen:
+        # El orquestador (ADK, Vertex AI, GCS) se importa al primer uso, no al
+        # cargar las vistas; normalmente ya lo importó el calentamiento del worker.
+        from .adk.adk_main import run_safety_analysis
+        from .adk.sessions import session_ids_for
+
         # Lógica si hay imagen
         print(type(imagen))
         imagen_a_analizar = imagen  # Asegúrate que esta imagen exista
-        usuario = "padre_preocupado_1"
-        sesion = "analisis_001"
+        usuario, sesion = session_ids_for(session_key or "anonimo")
 
         print(f"--- Iniciando análisis para {imagen_a_analizar} ---")
 
         # Llamamos a la función asíncrona del módulo
-        resultado = asyncio.run(run_safety_analysis(
+        resultado = await run_safety_analysis(
             image_file=imagen_a_analizar,
             user_id=usuario,
-            session_id=sesion
-        ))
+            session_id=sesion,
+            mode=modo
+        )
         print("\n--- REPORTE DE SEGURIDAD ---")
         print(resultado)
         print("-----------------------------")
@@ -52,32 +93,354 @@ def vista_clasificacion(request):
     # La lógica de carga del chat se movió a clasificacion.html (JavaScript)
     return render(request, 'core/clasificacion.html')
 
+def _iniciar_traza(request, nombre):
+    """
+    Abre la traza de la petición (None si el trazado está desactivado). Continúa
+    el X-Request-ID del cliente o del proxy, si lo trae.
+    """
+    return start_trace(nombre, request.headers.get('X-Request-ID'))
+
+
+async def _cerrar_traza(traza):
+    """Guarda la traza en el buffer si fue muestreada o superó BAYSAFE_TRACE_SLOW_MS."""
+    if traza is not None and finish_trace(traza):
+        await run_blocking(trace_store.save, traza)
+
+
+def _cierre_unico(response, traza, perfil=None):
+    """
+    Cierre de la traza y del perfil de una respuesta en streaming, que se ejecuta
+    una sola vez (bloqueante): desde el `finally` del generador o, si el cliente
+    se desconecta antes de que el generador arranque (y su `finally` nunca
+    corre), desde el cierre de la respuesta, que Django llama también en ese caso.
+    """
+    lock = threading.Lock()
+    pendiente = [(traza, perfil)]
+
+    def cerrar():
+        with lock:
+            traza_abierta, perfil_abierto = pendiente.pop() if pendiente else (None, None)
+        try:
+            if traza_abierta is not None and finish_trace(traza_abierta):
+                trace_store.save(traza_abierta)
+        finally:
+            # Un perfil abierto retiene el lock del worker y deja el muestreo activo.
+            if perfil_abierto is not None:
+                finish_profile(perfil_abierto)
+
+    response._resource_closers.append(cerrar)
+    return cerrar
+
+
+async def _iniciar_perfil(request, traza):
+    """
+    Empieza a perfilar la petición si trae el secreto en X-BaySafe-Profile o si
+    el admin pidió perfilar las próximas N. El perfil usa el id de la traza.
+    """
+    # Consumir una petición pendiente escribe en SQLite: fuera del event loop.
+    if not await run_blocking(profiling_requested, request.headers.get(PROFILE_HEADER)):
+        return None
+    return start_profile(traza.request_id if traza is not None else None)
+
+
+async def _cerrar_perfil(perfil):
+    """Detiene el perfil y guarda la pila colapsada y el informe de memoria."""
+    if perfil is not None:
+        await run_blocking(finish_profile, perfil)
+
+
+async def _chat_session_key(request):
+    """Garantiza que el navegador tenga sesión de Django y retorna su clave."""
+    if not request.session.session_key:
+        await request.session.asave()
+    return request.session.session_key
+
+
 @csrf_exempt
-def procesar_chat(request):
+async def procesar_chat(request):
     """
     API endpoint de Django que simula la respuesta de la IA.
+
+    Vista asíncrona nativa: servida por `mi_proyecto.asgi` comparte el event loop
+    del worker con el resto de análisis en curso. Bajo WSGI Django la adapta
+    automáticamente (async_to_sync), por compatibilidad.
     """
     if request.method == 'POST':
         # El frontend solo envía texto plano y un flag 'tiene_imagen'
-        print(request.POST.get)
-
         texto = request.POST.get('mensaje', '')
         tiene_imagen = request.POST.get('tiene_imagen', 'False')
 
         if not texto and tiene_imagen == 'False':
             return JsonResponse({'status': 'error', 'mensaje': 'Contenido vacío'})
 
-        # 1. Procesar con IA
-        if tiene_imagen == "True":
-            archivo_imagen = request.FILES.get("imagen")
-            print(archivo_imagen)
-            respuesta_ia = agente_vertex_ai(tiene_imagen, texto, archivo_imagen)
-        else:
-            respuesta_ia = agente_vertex_ai(tiene_imagen, texto)
+        # Tiempos por etapa del análisis (subida, detección, LLM, total...),
+        # devueltos en la cabecera Server-Timing (los muestran las DevTools).
+        tiempos = start_stage_timings()
+        traza = _iniciar_traza(request, 'procesar_chat')
+        perfil = await _iniciar_perfil(request, traza)
+
+        try:
+            # 1. Procesar con IA
+            if tiene_imagen == "True":
+                archivo_imagen = request.FILES.get("imagen")
+                print(archivo_imagen)
+                respuesta_ia = await agente_vertex_ai(
+                    tiene_imagen, texto, archivo_imagen, await _chat_session_key(request),
+                    request.POST.get('modo')
+                )
+            else:
+                respuesta_ia = await agente_vertex_ai(tiene_imagen, texto)
+
+            response = JsonResponse({
+                'status': 'ok',
+                'respuesta': respuesta_ia,
+            })
+            if SERVER_TIMING_ENABLED and tiempos:
+                response['Server-Timing'] = format_server_timing(tiempos)
+            if traza is not None:
+                response['X-Request-ID'] = traza.request_id
+            if perfil is not None:
+                response['X-BaySafe-Profile-Id'] = perfil.profile_id
+        finally:
+            # Aunque el análisis falle o se cancele (cliente desconectado): esas
+            # trazas son las que más interesan, y un perfil abierto bloquea los
+            # siguientes y deja el muestreo activo.
+            await _cerrar_traza(traza)
+            await _cerrar_perfil(perfil)
+        return response
+
+    return JsonResponse({'status': 'error', 'mensaje': 'Método no permitido'})
+
+def _sse(evento, datos):
+    """Serializa un evento en formato Server-Sent Events."""
+    return f"event: {evento}\ndata: {json.dumps(datos, ensure_ascii=False)}\n\n"
+
+
+@csrf_exempt
+async def procesar_chat_stream(request):
+    """
+    Variante en streaming de `procesar_chat` (Server-Sent Events).
+
+    Emite las etapas a medida que ocurren: `subida`, `herramienta`,
+    `detecciones` y fragmentos `texto` del informe. El último evento, `final`,
+    trae exactamente el mismo JSON que responde `procesar_chat`.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'status': 'error', 'mensaje': 'Método no permitido'})
+
+    texto = request.POST.get('mensaje', '')
+    tiene_imagen = request.POST.get('tiene_imagen', 'False')
+    archivo_imagen = request.FILES.get("imagen") if tiene_imagen == "True" else None
+    modo = request.POST.get('modo')
+
+    if not texto and tiene_imagen == 'False':
+        return JsonResponse({'status': 'error', 'mensaje': 'Contenido vacío'})
+
+    session_key = await _chat_session_key(request) if archivo_imagen else None
+    traza = _iniciar_traza(request, 'procesar_chat_stream')
+    perfil = await _iniciar_perfil(request, traza)
+
+    async def eventos():
+        try:
+            # Primer byte inmediato: el navegador muestra el progreso desde ya.
+            yield _sse('inicio', {'status': 'ok'})
+
+            if not archivo_imagen:
+                respuesta_ia = await agente_vertex_ai(tiene_imagen, texto)
+                yield _sse('final', {'status': 'ok', 'respuesta': respuesta_ia})
+                return
+
+            from .adk.adk_main import run_safety_analysis_stream
+            from .adk.sessions import session_ids_for
+
+            usuario, sesion = session_ids_for(session_key)
+            async for evento in run_safety_analysis_stream(archivo_imagen, usuario, sesion, mode=modo):
+                nombre = evento.pop('evento')
+                if nombre == 'final':
+                    yield _sse('final', {'status': 'ok', 'respuesta': evento['respuesta']})
+                else:
+                    yield _sse(nombre, evento)
+        finally:
+            await run_blocking(cerrar)
+
+    response = StreamingHttpResponse(eventos(), content_type='text/event-stream')
+    cerrar = _cierre_unico(response, traza, perfil)
+    response['Cache-Control'] = 'no-cache'
+    # Evita que un proxy (nginx) acumule la respuesta antes de enviarla.
+    response['X-Accel-Buffering'] = 'no'
+    if traza is not None:
+        response['X-Request-ID'] = traza.request_id
+    if perfil is not None:
+        response['X-BaySafe-Profile-Id'] = perfil.profile_id
+    return response
+
+
+def _extract_zip_images(zip_file):
+    """
+    Extrae las imágenes de un .zip como archivos de Django en memoria.
+
+    Ignora carpetas, archivos ocultos y extensiones que no son de imagen, y
+    corta antes de descomprimir más de BULK_MAX_ZIP_BYTES (protección zip-bomb).
+    """
+    images = []
+    total = 0
+    with zipfile.ZipFile(zip_file) as archive:
+        for info in archive.infolist():
+            name = os.path.basename(info.filename)
+            _, extension = os.path.splitext(name.lower())
+            if info.is_dir() or not name or name.startswith(".") or "__MACOSX" in info.filename:
+                continue
+            if extension not in BULK_IMAGE_EXTENSIONS:
+                continue
+            total += info.file_size
+            if total > BULK_MAX_ZIP_BYTES or len(images) >= BULK_MAX_IMAGES:
+                raise ValueError("El archivo .zip supera el límite permitido")
+            content_type = mimetypes.guess_type(name)[0] or "image/jpeg"
+            images.append(SimpleUploadedFile(name, archive.read(info), content_type=content_type))
+    return images
+
+
+@csrf_exempt
+async def procesar_chat_lote(request):
+    """
+    API endpoint para analizar muchas imágenes en una sola petición.
+
+    Acepta varias imágenes en el campo `imagenes` y/o un `.zip` en el campo `zip`.
+    Responde en streaming (NDJSON, una línea por imagen) a medida que cada
+    análisis termina; la última línea trae el resumen del lote.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'status': 'error', 'mensaje': 'Método no permitido'})
+
+    imagenes = list(request.FILES.getlist('imagenes'))
+    archivo_zip = request.FILES.get('zip')
+    if archivo_zip:
+        try:
+            imagenes += await run_blocking(_extract_zip_images, archivo_zip)
+        except (zipfile.BadZipFile, ValueError) as e:
+            return JsonResponse({'status': 'error', 'mensaje': f'Zip inválido: {e}'})
+
+    if not imagenes:
+        return JsonResponse({'status': 'error', 'mensaje': 'No se recibieron imágenes'})
+    if len(imagenes) > BULK_MAX_IMAGES:
+        return JsonResponse({'status': 'error', 'mensaje': f'Máximo {BULK_MAX_IMAGES} imágenes por lote'})
+
+    from .adk.adk_main import run_bulk_safety_analysis
+    from .adk.sessions import session_ids_for
+
+    usuario, sesion = session_ids_for(await _chat_session_key(request))
+    concurrencia = request.POST.get('concurrencia')
+    modo = request.POST.get('modo')
+    traza = _iniciar_traza(request, 'procesar_chat_lote')
+
+    async def resultados():
+        # La traza se guarda también si el lote falla o el cliente se desconecta.
+        try:
+            inicio = time.monotonic()
+            opciones = {'concurrency': int(concurrencia)} if concurrencia and concurrencia.isdigit() else {}
+            async for indice, respuesta in run_bulk_safety_analysis(imagenes, usuario, sesion, mode=modo, **opciones):
+                yield json.dumps({
+                    'status': 'ok',
+                    'indice': indice,
+                    'nombre': imagenes[indice].name,
+                    'respuesta': respuesta,
+                }, ensure_ascii=False) + "\n"
+            yield json.dumps({
+                'status': 'fin',
+                'total': len(imagenes),
+                'duracion_s': round(time.monotonic() - inicio, 3),
+            }) + "\n"
+        finally:
+            await run_blocking(cerrar)
+
+    response = StreamingHttpResponse(resultados(), content_type='application/x-ndjson')
+    cerrar = _cierre_unico(response, traza)
+    if traza is not None:
+        response['X-Request-ID'] = traza.request_id
+    return response
+
+
+def preparado(request):
+    """
+    Readiness del worker: 200 cuando terminó de calentarse sin errores (agentes,
+    clientes de GCS y canal de Vertex AI), 503 mientras tanto o si algún paso
+    falló. El cuerpo trae el tiempo de cada paso y sus errores.
+    """
+    # Tras un fork (gunicorn --preload) el calentamiento empieza con la primera
+    # sonda; tras un fallo, cada sonda lo reintenta.
+    start_warmup()
+    estado = readiness()
+    listo = estado['status'] in ('ready', 'disabled') and not estado['errors']
+    return JsonResponse(estado, status=200 if listo else 503)
+
+
+def metricas(request):
+    """
+    Métricas de la app en el formato de texto de Prometheus: latencias por
+    etapa, errores, aciertos de caché, análisis en curso y etiquetas detectadas,
+    sumadas entre todos los workers del host.
+    """
+    if not METRICS_ENABLED:
+        return HttpResponse(status=404)
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+# --- TRAZAS (ADMIN) ---
+
+def _fecha_local(timestamp):
+    return datetime.fromtimestamp(timestamp, tz=timezone.get_current_timezone())
+
+
+@staff_member_required
+def trazas(request):
+    """Últimas trazas guardadas (muestreadas o lentas), de la más reciente a la más antigua."""
+    recientes = trace_store.recent()
+    for traza in recientes:
+        traza['fecha'] = _fecha_local(traza['started_at'])
+    return render(request, 'core/trazas.html', {'trazas': recientes, 'title': 'Trazas de análisis'})
+
+
+@staff_member_required
+def traza_detalle(request, request_id):
+    """Waterfall de una traza: cada span con su inicio, duración y categoría (GCS, Vertex, LLM)."""
+    traza = trace_store.get(request_id)
+    if traza is None:
+        raise Http404('Traza no encontrada')
+    traza['fecha'] = _fecha_local(traza['started_at'])
+    return render(request, 'core/traza.html', {
+        'traza': traza,
+        'waterfall': build_waterfall(traza),
+        'title': f"Traza {traza['request_id']}",
+    })
+
+
+# --- PERFILES (ADMIN) ---
+
+@staff_member_required
+def perfiles(request):
+    """
+    Perfiles guardados (pila colapsada para flamegraph e informe de memoria) y
+    formulario para perfilar las próximas N peticiones de análisis.
+    """
+    if request.method == 'POST':
+        cantidad = request.POST.get('cantidad', '0')
+        arm_profiling(int(cantidad) if cantidad.isdigit() else 0)
+        return redirect('perfiles')
+
+    guardados = list_profiles()
+    for perfil in guardados:
+        perfil['fecha'] = _fecha_local(perfil['created_at'])
+    return render(request, 'core/perfiles.html', {
+        'perfiles': guardados,
+        'pendientes': armed_remaining(),
+        'title': 'Perfiles de análisis',
+    })
 
-        return JsonResponse({
-            'status': 'ok',
-            'respuesta': respuesta_ia,
-        })
 
-    return JsonResponse({'status': 'error', 'mensaje': 'Método no permitido'})
\ No newline at end of file
+@staff_member_required
+def perfil_descarga(request, nombre):
+    """Descarga un archivo de perfil (`.collapsed.txt` o `.alloc.txt`)."""
+    ruta = profile_file_path(nombre)
+    if ruta is None:
+        raise Http404('Perfil no encontrado')
+    return FileResponse(open(ruta, 'rb'), as_attachment=True, filename=nombre, content_type='text/plain')
@@ -3,6 +3,12 @@ ASGI config for mi_proyecto project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Es el punto de entrada recomendado en producción: las vistas asíncronas
+(`core.views.procesar_chat`) corren sobre un único event loop de larga vida
+por worker, p.ej.:
+
+    gunicorn mi_proyecto.asgi:application -k uvicorn.workers.UvicornWorker
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 """
@@ -14,3 +20,12 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mi_proyecto.settings')
 
 application = get_asgi_application()
+
+# Intervalo de cesión del GIL (opcional, BAYSAFE_GIL_SWITCH_INTERVAL_MS) y
+# calentamiento del worker en segundo plano (agentes, clientes de GCP); `/ready`
+# responde 503 hasta que termina.
+from core.adk.executor import apply_gil_switch_interval  # noqa: E402
+from core.adk.warmup import start_warmup  # noqa: E402
+
+apply_gil_switch_interval()
+start_warmup()
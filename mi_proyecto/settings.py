@@ -2,8 +2,6 @@ from dotenv import load_dotenv
 from pathlib import Path
 import os
 
-from google.cloud import aiplatform
-
 load_dotenv()
 
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -21,15 +19,18 @@ INSTALLED_APPS = [
     'core', # <--- APP AGREGADA
 ]
 
-try:
-    # Inicializar Vertex AI explícitamente
-    aiplatform.init(
-        project=os.environ.get("GOOGLE_CLOUD_PROJECT"),
-        location=os.environ.get("GOOGLE_CLOUD_LOCATION")
-    )
-    print(f"✅ Autenticación Global Exitosa para Vertex AI")
-except Exception as e:
-    print(f"❌ Error configurando autenticación: {e}")
+# Los SDK de Vertex AI, GCS y el ADK no se importan aquí (cuestan segundos y
+# cientos de MB en cada `manage.py`): los clientes se crean con la primera
+# petición o al calentar el worker (core/adk/warmup.py, BAYSAFE_WARMUP).
+
+# --- BACKENDS DEL ANÁLISIS ---
+# "gcp": Cloud Storage + Vertex AI + Gemini. "fake": dobles en proceso, sin red ni
+# credenciales (core/adk/backends/fakes.py), para pruebas de carga y perfilado.
+# BAYSAFE_BACKENDS fija los tres a la vez; cada uno se puede cambiar por separado.
+BAYSAFE_BACKENDS = os.environ.get("BAYSAFE_BACKENDS", "gcp")
+BAYSAFE_STORAGE_BACKEND = os.environ.get("BAYSAFE_STORAGE_BACKEND", BAYSAFE_BACKENDS)
+BAYSAFE_DETECTOR_BACKEND = os.environ.get("BAYSAFE_DETECTOR_BACKEND", BAYSAFE_BACKENDS)
+BAYSAFE_LLM_BACKEND = os.environ.get("BAYSAFE_LLM_BACKEND", BAYSAFE_BACKENDS)
 
 
 MIDDLEWARE = [
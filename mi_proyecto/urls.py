@@ -6,11 +6,19 @@ from django.conf.urls.static import static
 from core import views
 
 urlpatterns = [
+    path('admin/trazas/', views.trazas, name='trazas'),
+    path('admin/trazas/<str:request_id>/', views.traza_detalle, name='traza_detalle'),
+    path('admin/perfiles/', views.perfiles, name='perfiles'),
+    path('admin/perfiles/<str:nombre>', views.perfil_descarga, name='perfil_descarga'),
     path('admin/', admin.site.urls),
     path('', views.home, name='home'),
     path('clasificacion/', views.vista_clasificacion, name='clasificacion'),
     path('api/chat/', views.procesar_chat, name='procesar_chat'),
+    path('api/chat/stream/', views.procesar_chat_stream, name='procesar_chat_stream'),
+    path('api/chat/lote/', views.procesar_chat_lote, name='procesar_chat_lote'),
     path('historial/', views.historial, name='historial'),
+    path('metrics', views.metricas, name='metricas'),
+    path('ready', views.preparado, name='preparado'),
 ]
 
 if settings.DEBUG:
@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mi_proyecto.settings')
 
 application = get_wsgi_application()
+
+# Calienta el worker en segundo plano; `/ready` responde 503 hasta que termina.
+from core.adk.warmup import start_warmup  # noqa: E402
+
+start_warmup()
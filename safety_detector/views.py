@@ -4,12 +4,15 @@ import base64
 from django.shortcuts import render, redirect
 # from google.cloud import aiplatform  <-- Importación tardía
 from datetime import datetime 
+from core.adk.ingestion import ingest_upload, open_upload
+from core.adk.preprocessing import preprocess_image
 
 # --- CONFIGURACIÓN GLOBAL (Debe estar aquí) ---
 PROJECT_ID = os.environ.get("GCP_PROJECT_ID", "") 
 REGION = os.environ.get("GCP_REGION", "") 
 ENDPOINT_ID = os.environ.get("VERTEX_ENDPOINT_ID", "") 
 HISTORY_SESSION_KEY = 'safety_history'
+HISTORY_THUMBNAIL_SIDE = 480 # La sesión guarda una miniatura, no la foto completa
 # ----------------------------------------------
 
 def home(request):
@@ -55,8 +58,13 @@ def predict_safety(request):
         try:
             # Lógica completa de POST (incluyendo la codificación base64 y Vertex AI/Simulación)
             image_file = request.FILES['image_file']
-            image_bytes = image_file.read()
-            image_b64 = base64.b64encode(image_bytes).decode('utf-8')
+            # Ingesta por bloques: valida tipo y tamaño y calcula el hash sin
+            # cargar el archivo completo en memoria.
+            ingested = ingest_upload(image_file)
+            with open_upload(image_file) as reader:
+                thumbnail = preprocess_image(reader, max_side=HISTORY_THUMBNAIL_SIDE, max_bytes=60_000)
+            if thumbnail is not None:
+                image_b64 = base64.b64encode(thumbnail.data).decode('utf-8')
 
             # SIMULACIÓN (porque la IA no está configurada)
             is_safe = True
@@ -68,6 +76,7 @@ def predict_safety(request):
                 'is_safe': is_safe,
                 'result': prediction_result,
                 'image_b64': image_b64,
+                'sha256': ingested.sha256,
             }
             request.session[HISTORY_SESSION_KEY].insert(0, history_entry)
             request.session.modified = True